@@ -0,0 +1,104 @@
+"""Join table primary keys and indexes
+
+Revision ID: 2e31e5a50813
+Revises: fcdf7873db3f
+Create Date: 2026-10-16 09:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2e31e5a50813'
+down_revision: Union[str, None] = 'fcdf7873db3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, primary key columns) for each join table.
+# The primary key index serves lookups by the first column,
+# and a secondary index in the reverse order serves lookups by user.
+JOIN_TABLES = [
+    ('users_subgroups_join_table', ('subgroup_id', 'user_id')),
+    ('users_group_chats_join_table', ('group_chat_id', 'user_id')),
+]
+
+
+def _primary_key_name(table: str) -> str:
+    return f'{table}_pkey'
+
+
+def _reverse_index_name(table: str, columns: tuple[str, str]) -> str:
+    return f'ix_{table}_{columns[1]}_{columns[0]}'
+
+
+def _not_null_check_name(table: str, column: str) -> str:
+    return f'{table}_{column}_not_null'
+
+
+def upgrade() -> None:
+    # Every statement in an autocommit block commits on its own, so none of them
+    # holds its locks until the end of the migration.
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, but it doesn't
+    # block writes to the tables while the indexes are built.
+    with op.get_context().autocommit_block():
+        for table, (first_column, second_column) in JOIN_TABLES:
+            # Stops new rows without both ids, without checking the existing ones yet.
+            # Dropping it first lets a failed upgrade be run again.
+            for column in (first_column, second_column):
+                check = _not_null_check_name(table, column)
+                op.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}')
+                op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID')
+
+            # Rows without both ids can't be part of a primary key, and never meant anything.
+            op.execute(f'DELETE FROM {table} WHERE {first_column} IS NULL OR {second_column} IS NULL')
+
+            # Nothing stopped duplicate rows from being inserted, keep one of each.
+            op.execute(
+                f'DELETE FROM {table} a USING {table} b '
+                f'WHERE a.ctid > b.ctid '
+                f'AND a.{first_column} = b.{first_column} '
+                f'AND a.{second_column} = b.{second_column}'
+            )
+
+            # Validating only takes a lock that lets writes through,
+            # and lets SET NOT NULL below skip scanning the table
+            for column in (first_column, second_column):
+                op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {_not_null_check_name(table, column)}')
+
+        for table, columns in JOIN_TABLES:
+            op.create_index(
+                _primary_key_name(table),
+                table,
+                list(columns),
+                unique=True,
+                postgresql_concurrently=True,
+                if_not_exists=True
+            )
+            op.create_index(
+                _reverse_index_name(table, columns),
+                table,
+                list(reversed(columns)),
+                postgresql_concurrently=True,
+                if_not_exists=True
+            )
+
+    # Setting NOT NULL and promoting the unique index to the primary key only take a brief lock
+    for table, columns in JOIN_TABLES:
+        for column in columns:
+            op.alter_column(table, column, existing_type=sa.String(), nullable=False)
+            op.drop_constraint(_not_null_check_name(table, column), table, type_='check')
+
+        primary_key = _primary_key_name(table)
+        op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {primary_key} PRIMARY KEY USING INDEX {primary_key}')
+
+
+def downgrade() -> None:
+    for table, (first_column, second_column) in JOIN_TABLES:
+        op.drop_index(_reverse_index_name(table, (first_column, second_column)), table_name=table)
+        # Dropping the primary key constraint drops its index too
+        op.drop_constraint(_primary_key_name(table), table, type_='primary')
+        op.alter_column(table, first_column, existing_type=sa.String(), nullable=True)
+        op.alter_column(table, second_column, existing_type=sa.String(), nullable=True)
@@ -0,0 +1,203 @@
+"""Native uuid keys
+
+Revision ID: 6d0f2b8c4e19
+Revises: a1c93e5f0b27
+Create Date: 2026-10-16 14:20:37.118452
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from shout_subgroup.uuid_key_backfill import (
+    KEY_COLUMNS,
+    shadow_column,
+    backfill_uuid_keys,
+    create_fill_triggers,
+    drop_fill_triggers
+)
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6d0f2b8c4e19'
+down_revision: Union[str, None] = 'a1c93e5f0b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, column, referenced table) of every foreign key
+FOREIGN_KEYS = [
+    ('subgroups', 'group_chat_id', 'group_chats'),
+    ('users_group_chats_join_table', 'group_chat_id', 'group_chats'),
+    ('users_group_chats_join_table', 'user_id', 'users'),
+    ('users_subgroups_join_table', 'subgroup_id', 'subgroups'),
+    ('users_subgroups_join_table', 'user_id', 'users'),
+]
+# (table, primary key columns) for each join table, see 2e31e5a50813
+JOIN_TABLES = [
+    ('users_subgroups_join_table', ('subgroup_id', 'user_id')),
+    ('users_group_chats_join_table', ('group_chat_id', 'user_id')),
+]
+ENTITY_TABLES = [
+    ('group_chats', 'group_chat_id'),
+    ('users', 'user_id'),
+    ('subgroups', 'subgroup_id'),
+]
+
+
+def _foreign_key_name(table: str, column: str) -> str:
+    return f'{table}_{column}_fkey'
+
+
+def _primary_key_name(table: str) -> str:
+    return f'{table}_pkey'
+
+
+def _reverse_index_name(table: str, columns: tuple[str, str]) -> str:
+    return f'ix_{table}_{columns[1]}_{columns[0]}'
+
+
+def _shadow_index_name(name: str) -> str:
+    # The index is built on the shadow columns, while the index it replaces still exists
+    return f'{name}_uuid'
+
+
+def _not_null_check_name(table: str, column: str) -> str:
+    return f'{table}_{column}_not_null'
+
+
+def _prepare_shadow_columns() -> None:
+    """
+    Everything the swap needs that would otherwise block writes while it runs.
+    Must run in an autocommit block, every statement commits on its own.
+    """
+    # Whatever uuid_key_backfill hasn't done yet. Every batch commits on its own,
+    # and the triggers keep new rows filled until the swap.
+    backfill_uuid_keys(op.get_bind(), commit=False)
+
+    # A validated CHECK lets SET NOT NULL skip scanning the table during the swap.
+    # Validating it only takes a lock that lets writes through.
+    # Dropping it first lets a failed upgrade be run again.
+    for table, columns in KEY_COLUMNS:
+        for column in columns:
+            check = _not_null_check_name(table, column)
+            op.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}')
+            op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({shadow_column(column)} IS NOT NULL) NOT VALID')
+            op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {check}')
+
+    # CREATE INDEX CONCURRENTLY doesn't block writes to the tables while the indexes are built, see 2e31e5a50813
+    for table, column in ENTITY_TABLES:
+        op.create_index(
+            _shadow_index_name(_primary_key_name(table)),
+            table,
+            [shadow_column(column)],
+            unique=True,
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+
+    for table, columns in JOIN_TABLES:
+        op.create_index(
+            _shadow_index_name(_primary_key_name(table)),
+            table,
+            [shadow_column(column) for column in columns],
+            unique=True,
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+        op.create_index(
+            _shadow_index_name(_reverse_index_name(table, columns)),
+            table,
+            [shadow_column(column) for column in reversed(columns)],
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+
+
+def _swap_shadow_columns() -> None:
+    """
+    Swaps the shadow columns in, only taking brief locks: no index is built and no table is scanned.
+    """
+    drop_fill_triggers(op.get_bind())
+    _drop_keys()
+
+    for table, columns in KEY_COLUMNS:
+        for column in columns:
+            op.drop_column(table, column)
+            op.alter_column(table, shadow_column(column), new_column_name=column)
+            op.alter_column(table, column, nullable=False)
+            op.drop_constraint(_not_null_check_name(table, column), table, type_='check')
+
+    # Promoting the unique indexes to primary keys renames them too
+    for table, _ in ENTITY_TABLES + JOIN_TABLES:
+        primary_key = _primary_key_name(table)
+        op.execute(
+            f'ALTER TABLE {table} ADD CONSTRAINT {primary_key} PRIMARY KEY USING INDEX {_shadow_index_name(primary_key)}'
+        )
+
+    for table, columns in JOIN_TABLES:
+        reverse_index = _reverse_index_name(table, columns)
+        op.execute(f'ALTER INDEX {_shadow_index_name(reverse_index)} RENAME TO {reverse_index}')
+
+    # NOT VALID skips checking the existing rows, they're validated once the swap is committed
+    for table, column, referenced_table in FOREIGN_KEYS:
+        op.execute(
+            f'ALTER TABLE {table} ADD CONSTRAINT {_foreign_key_name(table, column)} '
+            f'FOREIGN KEY ({column}) REFERENCES {referenced_table} ({column}) NOT VALID'
+        )
+
+
+def _validate_foreign_keys() -> None:
+    """
+    Checks the existing rows against the foreign keys, which doesn't block writes.
+    Must run in an autocommit block, so each table is only locked while its own foreign keys are validated.
+    """
+    for table, column, _ in FOREIGN_KEYS:
+        op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {_foreign_key_name(table, column)}')
+
+
+def _drop_keys() -> None:
+    for table, column, _ in FOREIGN_KEYS:
+        op.drop_constraint(_foreign_key_name(table, column), table, type_='foreignkey')
+
+    for table, columns in JOIN_TABLES:
+        op.drop_index(_reverse_index_name(table, columns), table_name=table)
+        op.drop_constraint(_primary_key_name(table), table, type_='primary')
+
+    for table, _ in ENTITY_TABLES:
+        op.drop_constraint(_primary_key_name(table), table, type_='primary')
+
+
+def _create_keys() -> None:
+    for table, column in ENTITY_TABLES:
+        op.create_primary_key(_primary_key_name(table), table, [column])
+
+    for table, columns in JOIN_TABLES:
+        op.create_primary_key(_primary_key_name(table), table, list(columns))
+        op.create_index(_reverse_index_name(table, columns), table, list(reversed(columns)))
+
+    for table, column, referenced_table in FOREIGN_KEYS:
+        op.create_foreign_key(_foreign_key_name(table, column), table, referenced_table, [column], [column])
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        _prepare_shadow_columns()
+
+    _swap_shadow_columns()
+
+    with op.get_context().autocommit_block():
+        _validate_foreign_keys()
+
+
+def downgrade() -> None:
+    _drop_keys()
+    for table, columns in KEY_COLUMNS:
+        for column in columns:
+            op.alter_column(table, column, new_column_name=shadow_column(column), nullable=True)
+            op.add_column(table, sa.Column(column, sa.String(), nullable=True))
+            op.execute(f'UPDATE {table} SET {column} = {shadow_column(column)}::text')
+            op.alter_column(table, column, existing_type=sa.String(), nullable=False)
+    _create_keys()
+
+    create_fill_triggers(op.get_bind())
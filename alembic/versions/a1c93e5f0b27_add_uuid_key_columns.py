@@ -0,0 +1,38 @@
+"""Add uuid key columns
+
+Revision ID: a1c93e5f0b27
+Revises: 2e31e5a50813
+Create Date: 2026-10-16 14:02:11.540913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from shout_subgroup.uuid_key_backfill import KEY_COLUMNS, shadow_column, create_fill_triggers, drop_fill_triggers
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a1c93e5f0b27'
+down_revision: Union[str, None] = '2e31e5a50813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Nullable columns without a default are only a catalog change, the tables aren't rewritten.
+    # Existing rows are filled by shout_subgroup.uuid_key_backfill, new ones by the triggers.
+    for table, columns in KEY_COLUMNS:
+        for column in columns:
+            op.add_column(table, sa.Column(shadow_column(column), sa.Uuid(), nullable=True))
+
+    create_fill_triggers(op.get_bind())
+
+
+def downgrade() -> None:
+    drop_fill_triggers(op.get_bind())
+
+    for table, columns in KEY_COLUMNS:
+        for column in columns:
+            op.drop_column(table, shadow_column(column))
@@ -0,0 +1,39 @@
+"""Processed updates and chat affinity
+
+Revision ID: b7e4d1a9c352
+Revises: 6d0f2b8c4e19
+Create Date: 2026-10-16 16:45:09.283716
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e4d1a9c352'
+down_revision: Union[str, None] = '6d0f2b8c4e19'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('processed_updates',
+    sa.Column('update_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('processed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('update_id')
+    )
+    op.create_index(op.f('ix_processed_updates_processed_at'), 'processed_updates', ['processed_at'], unique=False)
+    op.create_table('chat_affinity',
+    sa.Column('telegram_chat_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('instance_id', sa.String(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('telegram_chat_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('chat_affinity')
+    op.drop_index(op.f('ix_processed_updates_processed_at'), table_name='processed_updates')
+    op.drop_table('processed_updates')
@@ -0,0 +1,44 @@
+"""Normalize usernames and index them
+
+Revision ID: c3f8a2d6e914
+Revises: b7e4d1a9c352
+Create Date: 2026-10-16 18:12:40.518302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f8a2d6e914'
+down_revision: Union[str, None] = 'b7e4d1a9c352'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Usernames are stored in lower case from now on,
+    # so the ones stored before are lowered once here.
+    op.execute("UPDATE users SET username = lower(username) WHERE username <> lower(username)")
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction,
+    # but it doesn't block writes to users while the index is built.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_users_username',
+            'users',
+            ['username'],
+            postgresql_concurrently=True,
+            if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_users_username',
+            table_name='users',
+            postgresql_concurrently=True,
+            if_exists=True
+        )
@@ -0,0 +1,42 @@
+"""Nested subgroups
+
+Revision ID: d8b2e6f1a047
+Revises: c3f8a2d6e914
+Create Date: 2026-10-16 19:03:27.664018
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8b2e6f1a047'
+down_revision: Union[str, None] = 'c3f8a2d6e914'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('subgroups_subgroups_join_table',
+    sa.Column('parent_subgroup_id', sa.Uuid(as_uuid=False), nullable=False),
+    sa.Column('child_subgroup_id', sa.Uuid(as_uuid=False), nullable=False),
+    sa.ForeignKeyConstraint(['child_subgroup_id'], ['subgroups.subgroup_id'], ),
+    sa.ForeignKeyConstraint(['parent_subgroup_id'], ['subgroups.subgroup_id'], ),
+    sa.PrimaryKeyConstraint('parent_subgroup_id', 'child_subgroup_id')
+    )
+    op.create_index(
+        'ix_subgroups_subgroups_join_table_child_parent',
+        'subgroups_subgroups_join_table',
+        ['child_subgroup_id', 'parent_subgroup_id'],
+        unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        'ix_subgroups_subgroups_join_table_child_parent',
+        table_name='subgroups_subgroups_join_table'
+    )
+    op.drop_table('subgroups_subgroups_join_table')
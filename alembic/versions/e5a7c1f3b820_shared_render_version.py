@@ -0,0 +1,30 @@
+"""Shared render version
+
+Revision ID: e5a7c1f3b820
+Revises: d8b2e6f1a047
+Create Date: 2026-10-16 22:41:52.310845
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a7c1f3b820'
+down_revision: Union[str, None] = 'd8b2e6f1a047'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('shared_render_version',
+    sa.Column('shared_render_version_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('shared_render_version_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('shared_render_version')
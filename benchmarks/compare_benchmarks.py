@@ -0,0 +1,77 @@
+"""
+Compares two benchmark runs of benchmarks/run_benchmarks.py, e.g. from two commits.
+
+Exits with 1 if any benchmark runs more queries per call than the baseline,
+or if its p50 latency got slower than the allowed regression.
+
+Usage:
+    python benchmarks/compare_benchmarks.py baseline.json results.json --max-latency-regression 0.2
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+DEFAULT_MAX_LATENCY_REGRESSION = 0.2
+# Latencies this small are mostly noise, they're never reported as regressions
+MIN_COMPARABLE_LATENCY_MS = 1.0
+
+
+def _load_results(path: Path) -> dict[tuple[str, int], dict]:
+    results = json.loads(path.read_text())["results"]
+    return {(result["benchmark"], result["members"]): result for result in results}
+
+
+def compare(baseline: dict[tuple[str, int], dict], current: dict[tuple[str, int], dict], max_latency_regression: float) -> list[str]:
+    """
+    Prints a comparison of every benchmark in both runs.
+    :param baseline: results by (benchmark, members)
+    :param current: results by (benchmark, members)
+    :param max_latency_regression: e.g. 0.2 allows the p50 latency to be 20% slower
+    :return: a description of every regression
+    """
+    regressions = []
+    print(f"{'benchmark':<30} {'members':>8} {'queries/call':>16} {'p50 ms':>22}")
+
+    for key in sorted(baseline.keys() & current.keys()):
+        name, members = key
+        before, after = baseline[key], current[key]
+        before_queries, after_queries = before["queries_per_call"], after["queries_per_call"]
+        before_p50, after_p50 = before["latency_ms"]["p50"], after["latency_ms"]["p50"]
+        change = (after_p50 - before_p50) / before_p50 if before_p50 else 0.0
+
+        print(f"{name:<30} {members:>8} {before_queries:>7g} -> {after_queries:<6g} "
+              f"{before_p50:>8.2f} -> {after_p50:<8.2f} ({change:+.0%})")
+
+        if after_queries > before_queries:
+            regressions.append(f"{name} with {members} members runs {after_queries:g} queries per call, "
+                               f"up from {before_queries:g}")
+
+        if change > max_latency_regression and after_p50 >= MIN_COMPARABLE_LATENCY_MS:
+            regressions.append(f"{name} with {members} members is {change:.0%} slower at p50")
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument(
+        "--max-latency-regression",
+        type=float,
+        default=DEFAULT_MAX_LATENCY_REGRESSION,
+        help="how much slower the p50 latency can get, as a fraction of the baseline"
+    )
+    args = parser.parse_args()
+
+    regressions = compare(_load_results(args.baseline), _load_results(args.current), args.max_latency_regression)
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"- {regression}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
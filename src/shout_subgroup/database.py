@@ -1,12 +1,176 @@
+import asyncio
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from shout_subgroup.metrics import LatencySamples
+from shout_subgroup.query_metrics import instrument_query_timing, DEFAULT_SLOW_QUERY_SECONDS
 
 logger = logging.getLogger(__name__)
 
+Session: async_sessionmaker | None = None
+# Sessions on the read replica, None when there's no replica
+ReadOnlySession: async_sessionmaker | None = None
+_replica_failed_at: float | None = None
+
+# After the replica fails, reads go to the primary for this long before the replica is tried again
+REPLICA_RETRY_SECONDS = 30
+# How far behind the primary we expect the replica to be at worst.
+# Chats that changed more recently than this are read from the primary.
+REPLICA_LAG_SECONDS = 5
+
+# Checkouts slower than this are logged, they mean handlers are waiting on the pool
+SLOW_CHECKOUT_WARNING_SECONDS = 0.5
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    # Connections kept open
+    pool_size: int = 5
+    # Extra connections opened when all pool_size connections are in use
+    max_overflow: int = 10
+    # Seconds to wait for a connection before giving up
+    pool_timeout: float = 30
+    # Seconds before a connection is replaced, so it doesn't outlive server or proxy timeouts
+    pool_recycle: int = 1800
+    # Test connections when they're checked out, so a dropped connection isn't handed to a handler
+    pool_pre_ping: bool = True
+    # Logs every statement, only meant for debugging
+    echo: bool = False
+
+
+def get_bool_env(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def load_pool_config() -> PoolConfig:
+    """
+    Reads the connection pool settings from the environment,
+    anything that isn't set keeps its default.
+    :return:
+    """
+    defaults = PoolConfig()
+    return PoolConfig(
+        pool_size=int(os.getenv('DATABASE_POOL_SIZE') or defaults.pool_size),
+        max_overflow=int(os.getenv('DATABASE_MAX_OVERFLOW') or defaults.max_overflow),
+        pool_timeout=float(os.getenv('DATABASE_POOL_TIMEOUT') or defaults.pool_timeout),
+        pool_recycle=int(os.getenv('DATABASE_POOL_RECYCLE') or defaults.pool_recycle),
+        pool_pre_ping=get_bool_env('DATABASE_POOL_PRE_PING', defaults.pool_pre_ping),
+        echo=get_bool_env('DATABASE_ECHO', defaults.echo)
+    )
+
+
+class PoolMetrics:
+    """
+    How long handlers wait to check out a connection, and how often they time out.
+    """
+
+    def __init__(self):
+        self.checkout_count = 0
+        self.checkout_timeout_count = 0
+        self.checkout_wait_sum = 0.0
+        self.checkout_waits = LatencySamples()
+
+    def record_checkout(self, wait: float) -> None:
+        self.checkout_count += 1
+        self.checkout_wait_sum += wait
+        self.checkout_waits.record(wait)
+
+        if wait >= SLOW_CHECKOUT_WARNING_SECONDS:
+            logger.warning(f"Waited {wait:.3f} seconds for a database connection, the pool may be too small")
+
+    def checkout_wait_percentile(self, percentile: float) -> float | None:
+        return self.checkout_waits.percentile(percentile)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    The default pool of async engines, that also times every checkout.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        started_at = time.monotonic()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.checkout_timeout_count += 1
+            raise
+
+        self.metrics.record_checkout(time.monotonic() - started_at)
+        return connection
+
+    def capacity(self) -> int | None:
+        """
+        The most connections the pool opens at once
+        :return: None when the overflow is unlimited
+        """
+        if self._max_overflow < 0:
+            return None
+        return self.size() + self._max_overflow
+
+    def recreate(self):
+        # Keep the metrics when the pool is recreated, e.g. after a disconnect
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def create_engine(url: str, pool_config: PoolConfig) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        echo=pool_config.echo,
+        poolclass=InstrumentedQueuePool,
+        pool_size=pool_config.pool_size,
+        max_overflow=pool_config.max_overflow,
+        pool_timeout=pool_config.pool_timeout,
+        pool_recycle=pool_config.pool_recycle,
+        pool_pre_ping=pool_config.pool_pre_ping
+    )
+
+
+def get_pool_status(engine: AsyncEngine) -> dict[str, float | int | None]:
+    """
+    A snapshot of the engine's connection pool.
+    in_use close to size + max_overflow, with growing checkout waits, means handlers are starved of connections.
+    :param engine:
+    :return:
+    """
+    pool = engine.sync_engine.pool
+    status = {
+        "size": pool.size(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+
+    metrics = getattr(pool, "metrics", None)
+    if metrics is not None:
+        status |= {
+            "checkout_count": metrics.checkout_count,
+            "checkout_timeout_count": metrics.checkout_timeout_count,
+            "checkout_wait_sum": metrics.checkout_wait_sum,
+            "checkout_wait_p50": metrics.checkout_wait_percentile(50),
+            "checkout_wait_p99": metrics.checkout_wait_percentile(99),
+        }
+
+    return status
+
 
 def configure_database() -> bool:
     load_dotenv()
@@ -24,21 +188,121 @@ def configure_database() -> bool:
     }
     logger.info(f"Loaded Database configs {db_configs}")
 
+    # Optional. Read only commands are sent to this host, e.g. a streaming replica of the primary
+    POSTGRES_REPLICA_CONTAINER = os.getenv('POSTGRES_REPLICA_CONTAINER')
+    if POSTGRES_REPLICA_CONTAINER:
+        logger.info(f"Loaded read replica host {POSTGRES_REPLICA_CONTAINER}")
+
     try:
+        pool_config = load_pool_config()
+        logger.info(f"Loaded connection pool configs {pool_config}")
+        slow_query_seconds = float(os.getenv('DATABASE_SLOW_QUERY_SECONDS') or DEFAULT_SLOW_QUERY_SECONDS)
+
         engine = create_engine(
-            f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_CONTAINER}:5432/{POSTGRES_DB}", echo=True
+            f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_CONTAINER}:5432/{POSTGRES_DB}",
+            pool_config
         )
+        instrument_query_timing(engine, slow_query_seconds=slow_query_seconds)
         logger.info("Created database engine")
+
+        replica_engine = None
+        if POSTGRES_REPLICA_CONTAINER:
+            replica_engine = create_engine(
+                f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_REPLICA_CONTAINER}:5432/{POSTGRES_DB}",
+                pool_config
+            )
+            instrument_query_timing(replica_engine, slow_query_seconds=slow_query_seconds)
+            logger.info("Created read replica engine")
+
+        logger.info(f"Logging queries slower than {slow_query_seconds} seconds")
     except Exception as ex:
         logger.exception(f"Unable to connect to postgreSQL. See exception details ... {ex}")
         return False
 
-    global Session
-
-    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    use_engines(engine, replica_engine)
 
     return True
 
 
-def get_database():
+def use_engines(engine: AsyncEngine, replica_engine: AsyncEngine | None = None) -> None:
+    """
+    Sets the engines every session is created from
+    :param engine: the primary, every write goes here
+    :param replica_engine: optional, read only sessions go here
+    :return:
+    """
+    global Session, ReadOnlySession, _replica_failed_at
+
+    # Sessions are AsyncSessions backed by asyncpg, so every query
+    # is awaited instead of blocking the telegram bot's event loop.
+    Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+    ReadOnlySession = async_sessionmaker(bind=replica_engine, expire_on_commit=False) if replica_engine else None
+    _replica_failed_at = None
+
+
+def get_database() -> async_sessionmaker:
     return Session
+
+
+def _is_replica_available() -> bool:
+    return _replica_failed_at is None or time.monotonic() - _replica_failed_at >= REPLICA_RETRY_SECONDS
+
+
+async def _connect_to_replica() -> AsyncSession | None:
+    """
+    :return: a session with a connection to the replica, None if the replica can't be reached
+    """
+    global _replica_failed_at
+
+    session = ReadOnlySession()
+    try:
+        await session.connection()
+    except (exc.DBAPIError, OSError, asyncio.TimeoutError) as ex:
+        await session.close()
+        _replica_failed_at = time.monotonic()
+        logger.warning(f"Unable to connect to the read replica, reading from the primary "
+                       f"for the next {REPLICA_RETRY_SECONDS} seconds. {ex}")
+        return None
+
+    _replica_failed_at = None
+    return session
+
+
+@asynccontextmanager
+async def read_only_session(prefer_primary: bool = False) -> AsyncIterator[AsyncSession]:
+    """
+    A session for handlers that only read, e.g. /shout and /list.
+    It's on the read replica when there is one, otherwise, or when the replica
+    can't be reached, it's on the primary. Nothing is committed.
+    :param prefer_primary: read from the primary anyway, e.g. to see a write the replica may not have yet
+    :return:
+    """
+    session = None
+    if ReadOnlySession is not None and not prefer_primary and _is_replica_available():
+        session = await _connect_to_replica()
+
+    if session is None:
+        session = Session()
+
+    async with session:
+        yield session
+
+
+def get_database_pool_status() -> dict[str, float | int | None] | None:
+    """
+    :return: the status of the database's connection pool, None if the database isn't configured
+    """
+    if Session is None:
+        return None
+
+    return get_pool_status(Session.kw["bind"])
+
+
+def get_replica_pool_status() -> dict[str, float | int | None] | None:
+    """
+    :return: the status of the read replica's connection pool, None if there's no replica
+    """
+    if ReadOnlySession is None:
+        return None
+
+    return get_pool_status(ReadOnlySession.kw["bind"])
@@ -1,17 +1,19 @@
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from shout_subgroup.exceptions import SubGroupDoesNotExistsError, NotGroupChatError
+from shout_subgroup.render_cache import invalidate_chat_on_commit
 from shout_subgroup.repository import find_subgroup_by_telegram_group_chat_id_and_subgroup_name, delete_subgroup
+from shout_subgroup.send_scheduler import defer_replies
 from shout_subgroup.utils import is_group_chat
 
 from shout_subgroup.database import get_database
 
 
-async def remove_subgroup(db: Session, telegram_chat_id: int, subgroup_name: str) -> bool:
+async def remove_subgroup(db: AsyncSession, telegram_chat_id: int, subgroup_name: str) -> bool:
     if not await is_group_chat(telegram_chat_id):
         msg = f"Can't kick members from subgroup because telegram chat id {telegram_chat_id} is not a group chat."
         logging.info(msg)
@@ -26,6 +28,7 @@ async def remove_subgroup(db: Session, telegram_chat_id: int, subgroup_name: str
 
     # Perform the deletion
     is_deleted = await delete_subgroup(db, telegram_chat_id, subgroup_name)
+    invalidate_chat_on_commit(db, telegram_chat_id)
 
     return is_deleted
 
@@ -44,12 +47,12 @@ async def remove_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_
     args = context.args
     db_session = get_database()
 
-    with db_session.begin() as session:
+    async with defer_replies(update) as replies, db_session.begin() as session:
 
         # Quick guard clause
         if len(args) < 1:
             msg = "You didn't use this command correctly. Please type /delete <group_name>"
-            await update.message.reply_text(msg)
+            replies.add(msg)
             return
 
         subgroup_name = args[0]
@@ -58,7 +61,7 @@ async def remove_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_
             is_deleted = await remove_subgroup(session, update.effective_chat.id, subgroup_name)
 
             if is_deleted:
-                await update.message.reply_text(f"Subgroup '{subgroup_name}' was deleted")
+                replies.add(f"Subgroup '{subgroup_name}' was deleted")
                 return
 
             msg = (f"The remove_subgroup function returned {is_deleted}, when it should have returned True or throw an "
@@ -68,14 +71,14 @@ async def remove_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_
             raise RuntimeError(msg)
 
         except NotGroupChatError:
-            await update.message.reply_text("Sorry, you can only create or modify subgroups in group chats.")
+            replies.add("Sorry, you can only create or modify subgroups in group chats.")
             return
 
         except SubGroupDoesNotExistsError:
             msg = f"I can't delete subgroup '{subgroup_name}' because it does not exist"
-            await update.message.reply_text(msg)
+            replies.add(msg)
             return
 
         except Exception:
             logging.exception("An unexpected exception occurred")
-            await update.message.reply_text("Whoops 😅, something went wrong on our side.")
+            replies.add("Whoops 😅, something went wrong on our side.")
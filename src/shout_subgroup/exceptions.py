@@ -32,3 +32,27 @@ class UserDoesNotExistsError(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class InvalidWebhookConfigError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SubGroupNestingCycleError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SubGroupNestingTooDeepError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class SendSchedulerStoppedError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
@@ -1,53 +1,75 @@
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update, Chat
 from telegram.ext import ContextTypes
 
 from shout_subgroup.database import get_database
 from shout_subgroup.exceptions import NotGroupChatError
+from shout_subgroup.membership_cache import chat_membership_cache, add_member_on_commit
 from shout_subgroup.models import UserModel
+from shout_subgroup.profile_fingerprints import profile_fingerprint_cache, record_profile_on_commit
+from shout_subgroup.registration_queue import registration_queue
+from shout_subgroup.render_cache import invalidate_chat_on_commit, invalidate_all_on_commit
 from shout_subgroup.repository import (
-    find_all_users_in_group_chat,
     find_group_chat_by_telegram_group_chat_id,
     insert_group_chat,
     add_user_to_group_chat as add_user_to_group_chat_repo, remove_user_from_all_sub_groups_in_group_chat,
     remove_user_from_group_chat as remove_user_from_group_chat_repo, find_user_by_telegram_user_id
 )
+from shout_subgroup.send_scheduler import defer_replies
 from shout_subgroup.utils import is_group_chat
 
 logger = logging.getLogger(__name__)
 
 
-async def add_user_to_group_chat(db: Session, chat: Chat, current_user: UserModel) -> UserModel | None:
+async def add_user_to_group_chat(db: AsyncSession, chat: Chat, current_user: UserModel) -> UserModel | None:
     if not await is_group_chat(chat.id):
         msg = f"Can't add user to group because telegram chat id {chat.id} is not a group chat."
         logger.info(msg)
         raise NotGroupChatError(msg)
 
+    # Almost every message is from someone we've already registered, with the same profile,
+    # so we don't need to touch the database for them.
+    if (chat_membership_cache.contains(chat.id, current_user.telegram_user_id)
+            and not profile_fingerprint_cache.has_changed(current_user)):
+        return None
+
     # Check if the group chat exists in our system, if not we need to add it
     group_chat = await find_group_chat_by_telegram_group_chat_id(db, chat.id)
     if not group_chat:
         group_chat = await insert_group_chat(db, chat.id, chat.title, chat.description)
 
-    # Add the user to the group chat if they're not already in it
-    all_users = await find_all_users_in_group_chat(db, chat.id)
-    telegram_user_ids_in_group_chat = {user.telegram_user_id for user in all_users}
-
-    if current_user.telegram_user_id not in telegram_user_ids_in_group_chat:
-        added_user = await add_user_to_group_chat_repo(db, group_chat, current_user)
+    # Add the user to the group chat if they're not already in it.
+    # This also keeps the profile of users we already know up to date.
+    added_user, profile_changed = await add_user_to_group_chat_repo(db, group_chat, current_user)
+    add_member_on_commit(db, chat.id, current_user.telegram_user_id)
+    record_profile_on_commit(db, current_user)
+    # A new profile shows in every chat the user is in, while a new member only shows in this chat
+    if profile_changed:
+        await invalidate_all_on_commit(db)
+    elif added_user:
+        invalidate_chat_on_commit(db, chat.id)
+
+    if added_user:
         logger.info(f"Adding user_id '{added_user.user_id}' to group_chat_id '{group_chat.group_chat_id}'")
         return added_user
 
     return None
 
 
-async def remove_user_from_group_chat(db: Session, chat: Chat, current_user: UserModel) -> UserModel | None:
+async def remove_user_from_group_chat(db: AsyncSession, chat: Chat, current_user: UserModel) -> UserModel | None:
     if not await is_group_chat(chat.id):
         msg = f"Can't remove user from chat because telegram chat id {chat.id} is not a group chat."
         logger.info(msg)
         raise NotGroupChatError(msg)
 
+    # We shouldn't register the user from a message that is still queued,
+    # and a registration that's being written has to land before we remove them.
+    await registration_queue.discard(chat.id, current_user.telegram_user_id)
+    # The user is leaving, so the cache can't vouch for them anymore
+    chat_membership_cache.discard(chat.id, current_user.telegram_user_id)
+
     # Check if the group chat exists in our system, if not then there's nothing to be done
     group_chat = await find_group_chat_by_telegram_group_chat_id(db, chat.id)
     if not group_chat:
@@ -63,6 +85,7 @@ async def remove_user_from_group_chat(db: Session, chat: Chat, current_user: Use
         # Remove user from all subgroups as well
         await remove_user_from_all_sub_groups_in_group_chat(db, chat.id, user_to_be_removed)
         removed_user = await remove_user_from_group_chat_repo(db, group_chat, user_to_be_removed)
+        invalidate_chat_on_commit(db, chat.id)
         return removed_user
 
     return None
@@ -72,8 +95,11 @@ async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFA
     """
     Handles listening to messages sent by users.
 
-    The handler listens to messages, then adds sender of the message to
-    the group chat table if they do not exist.
+    The handler listens to messages, then queues the sender of the message to
+    be added to the group chat table if they do not exist.
+    The registration queue writes them in batches, so a burst of messages
+    doesn't cost a transaction per message.
+    Senders we already registered are only queued again when their profile changed.
 
     This is needed b/c the system requires data about the members in a group chat
     in order to reference them.
@@ -81,6 +107,10 @@ async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFA
     :param context:
     :return:
     """
+    chat = update.effective_chat
+    if not await is_group_chat(chat.id):
+        return
+
     user_who_sent_the_message = UserModel(
         telegram_user_id=update.message.from_user.id,
         username=update.message.from_user.username,
@@ -88,22 +118,20 @@ async def listen_for_messages_handler(update: Update, context: ContextTypes.DEFA
         last_name=update.message.from_user.last_name
     )
 
-    db_session = get_database()
+    # Almost every message is from someone we've already registered, with the same profile,
+    # so we don't need to queue them again. Registering them again is what updates their profile.
+    if (chat_membership_cache.contains(chat.id, user_who_sent_the_message.telegram_user_id)
+            and not profile_fingerprint_cache.has_changed(user_who_sent_the_message)):
+        return
 
-    with db_session.begin() as session:
-        try:
-            maybe_added_user = await add_user_to_group_chat(session, update.effective_chat, user_who_sent_the_message)
-            # TODO: Add message like "The bot has recognized John Doe"
-            return
-        except NotGroupChatError:
-            # await update.message.reply_text("Sorry, you can only create or modify subgroups in group chats.")
-            return
+    # TODO: Add message like "The bot has recognized John Doe"
+    registration_queue.enqueue(chat, user_who_sent_the_message)
 
 
 async def listen_for_new_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db_session = get_database()
 
-    with db_session.begin() as session:
+    async with defer_replies(update) as replies, db_session.begin() as session:
         for member in update.message.new_chat_members:
             new_user = UserModel(
                 telegram_user_id=member.id,
@@ -111,16 +139,18 @@ async def listen_for_new_member_handler(update: Update, context: ContextTypes.DE
                 first_name=member.first_name,
                 last_name=member.last_name)
 
+            # Joins are rare, so always check the database for them
+            chat_membership_cache.discard(update.effective_chat.id, member.id)
             maybe_added_user = await add_user_to_group_chat(session, update.effective_chat, new_user)
 
             if maybe_added_user is not None:
-                await update.message.reply_text(f'Welcome {maybe_added_user.username}!')
+                replies.add(f'Welcome {maybe_added_user.username}!')
 
 
 async def listen_for_left_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db_session = get_database()
 
-    with db_session.begin() as session:
+    async with defer_replies(update) as replies, db_session.begin() as session:
         member = update.message.left_chat_member
         left_user = UserModel(
             telegram_user_id=member.id,
@@ -130,4 +160,4 @@ async def listen_for_left_member_handler(update: Update, context: ContextTypes.D
 
         maybe_removed_user = await remove_user_from_group_chat(session, update.effective_chat, left_user)
         if maybe_removed_user is not None:
-            await update.message.reply_text(f'Goodbye {maybe_removed_user.username}!')
+            replies.add(f'Goodbye {maybe_removed_user.username}!')
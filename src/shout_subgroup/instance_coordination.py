@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, AsyncConnection
+
+from shout_subgroup.database import get_database, create_engine, PoolConfig, load_pool_config, get_bool_env
+from shout_subgroup.membership_cache import chat_membership_cache
+from shout_subgroup.registration_queue import registration_queue
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.repository import claim_update, delete_processed_updates_before, take_over_chat, release_update, \
+    find_shared_render_version
+
+logger = logging.getLogger(__name__)
+
+# Telegram gives up on delivering an update after 24 hours,
+# so it can't be delivered again once it's older than that.
+PROCESSED_UPDATE_RETENTION = timedelta(days=1)
+# How many updates we claim between deleting the expired ones
+PRUNE_EVERY_CLAIMS = 1_000
+# Every chat being processed holds one of these connections, on top of the handlers' pool.
+# Once they're all in use, more chats wait for one to be released.
+DEFAULT_CHAT_LOCK_CONNECTIONS = 20
+
+
+def _utc_now() -> datetime:
+    # The columns are timestamps without a time zone, they're always in UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class InstanceCoordinator:
+    """
+    Lets several instances of the bot share one database.
+
+    - Every update is claimed in processed_updates before it's processed,
+      so an update delivered to two instances, e.g. when Telegram retries a webhook, is processed once.
+      The claim is committed first, so updates are processed at most once: if an instance crashes
+      mid-update, the update is lost. If processing raises, the claim is released again.
+    - A chat is processed by one instance at a time. Each instance holds a postgreSQL advisory lock,
+      keyed on the telegram chat id, while it processes one of the chat's updates.
+    - Render and membership caches are per instance. When an instance takes a chat over from
+      another one, it forgets what it cached about the chat. Profile changes affect every chat,
+      so every claim checks the shared render version, and forgets every rendered output when it changed.
+    - Registrations are written behind, so a chat's are written before its lock is released.
+      Otherwise one could land after another instance processed the user leaving.
+
+    On SQLite there's only ever one instance, so no locks are taken.
+    """
+
+    def __init__(self, lock_engine: AsyncEngine | None = None, instance_id: str | None = None):
+        """
+        :param lock_engine: holds the chats' advisory locks, None to not take any
+        :param instance_id: identifies this instance, defaults to the host name and a random suffix
+        """
+        self.lock_engine = lock_engine
+        # Chats wait here for a lock connection, instead of timing out waiting on the pool
+        self._lock_connections = asyncio.Semaphore(lock_engine.sync_engine.pool.size()) if lock_engine else None
+        self.instance_id = instance_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.duplicate_count = 0
+        self.take_over_count = 0
+        self._claims_since_prune = 0
+        # The shared render version at the last claim, None before the first one
+        self._shared_render_version: int | None = None
+
+    @asynccontextmanager
+    async def chat_lock(self, telegram_chat_id: int | None) -> AsyncIterator[AsyncSession]:
+        """
+        Holds the chat's lock, so no other instance processes it at the same time
+        :param telegram_chat_id: None if the update didn't come from a chat, nothing is locked then
+        :return: a session to claim the update in, on the lock's connection when there is one
+        """
+        if self.lock_engine is None or telegram_chat_id is None:
+            async with get_database()() as db:
+                yield db
+            return
+
+        async with self._lock_connections, self.lock_engine.connect() as connection:
+            # Session level, so it's held across the commits of the claim
+            await connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": telegram_chat_id})
+            await connection.commit()
+            try:
+                async with AsyncSession(bind=connection, expire_on_commit=False) as db:
+                    yield db
+
+                if registration_queue.has_pending(telegram_chat_id):
+                    await registration_queue.flush()
+            finally:
+                await self._unlock(connection, telegram_chat_id)
+
+    @staticmethod
+    async def _unlock(connection: AsyncConnection, telegram_chat_id: int) -> None:
+        # The connection goes back to the pool, it must not keep the lock
+        try:
+            await connection.execute(text("SELECT pg_advisory_unlock_all()"))
+            await connection.commit()
+        except Exception:
+            # Don't hide why the update failed, if it did. Closing the connection releases its locks.
+            logger.exception(f"Unable to release the lock of telegram chat id {telegram_chat_id}, closing its connection")
+            await connection.invalidate()
+
+    async def claim(self, db: AsyncSession, update_id: int, telegram_chat_id: int | None) -> bool:
+        """
+        Claims the update, and takes the chat over from whichever instance processed it last.
+        :param db: the session from chat_lock
+        :param update_id:
+        :param telegram_chat_id: None if the update didn't come from a chat
+        :return: False if the update was already claimed, and mustn't be processed
+        """
+        now = _utc_now()
+        if not await claim_update(db, update_id, now):
+            await db.commit()
+            self.duplicate_count += 1
+            logger.info(f"Skipping update {update_id}, it was already processed")
+            return False
+
+        if telegram_chat_id is not None and await take_over_chat(db, telegram_chat_id, self.instance_id, now):
+            self.take_over_count += 1
+            chat_membership_cache.invalidate(telegram_chat_id)
+            rendered_output_cache.bump(telegram_chat_id)
+
+        shared_render_version = await find_shared_render_version(db)
+        if self._shared_render_version is not None and shared_render_version != self._shared_render_version:
+            rendered_output_cache.bump_all()
+        self._shared_render_version = shared_render_version
+
+        self._claims_since_prune += 1
+        if self._claims_since_prune >= PRUNE_EVERY_CLAIMS:
+            self._claims_since_prune = 0
+            await delete_processed_updates_before(db, now - PROCESSED_UPDATE_RETENTION)
+
+        await db.commit()
+        return True
+
+    async def release(self, db: AsyncSession, update_id: int) -> None:
+        """
+        Releases a claim after processing the update failed, so it's processed again if it's delivered again
+        :param db: the session from chat_lock
+        :param update_id:
+        :return:
+        """
+        try:
+            await db.rollback()
+            await release_update(db, update_id)
+            await db.commit()
+        except Exception:
+            # Don't hide why the update failed
+            logger.exception(f"Unable to release the claim of update {update_id}")
+
+    async def close(self) -> None:
+        if self.lock_engine is not None:
+            await self.lock_engine.dispose()
+
+
+def create_lock_engine(
+        engine: AsyncEngine,
+        connection_count: int = DEFAULT_CHAT_LOCK_CONNECTIONS,
+        pool_config: PoolConfig | None = None
+) -> AsyncEngine | None:
+    """
+    :param engine: the primary
+    :param connection_count: how many chats can hold their lock at the same time
+    :param pool_config: defaults to the environment's
+    :return: an engine for the chats' advisory locks, None if the database doesn't have them
+    """
+    if engine.dialect.name != "postgresql":
+        return None
+
+    pool_config = pool_config or load_pool_config()
+    return create_engine(
+        engine.url,
+        PoolConfig(
+            pool_size=connection_count,
+            max_overflow=0,
+            pool_timeout=pool_config.pool_timeout,
+            pool_recycle=pool_config.pool_recycle,
+            pool_pre_ping=pool_config.pool_pre_ping
+        )
+    )
+
+
+def load_instance_coordinator() -> InstanceCoordinator | None:
+    """
+    Reads MULTI_INSTANCE and CHAT_LOCK_CONNECTIONS from the environment.
+    The database must be configured first.
+    :return: the coordinator, None unless MULTI_INSTANCE is true
+    """
+    load_dotenv()
+
+    if not get_bool_env('MULTI_INSTANCE', False):
+        return None
+
+    connection_count = int(os.getenv('CHAT_LOCK_CONNECTIONS') or DEFAULT_CHAT_LOCK_CONNECTIONS)
+    coordinator = InstanceCoordinator(create_lock_engine(get_database().kw["bind"], connection_count))
+    # The other instances have to hear about profile changes too
+    rendered_output_cache.is_shared = True
+    logger.info(f"Coordinating with other instances as {coordinator.instance_id}")
+    return coordinator
@@ -1,51 +1,49 @@
 import logging
 from typing import Type
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from shout_subgroup.exceptions import NotGroupChatError, SubGroupDoesNotExistsError
 from shout_subgroup.models import SubgroupModel, UserModel
+from shout_subgroup.render_cache import rendered_output_cache
 from shout_subgroup.repository import (find_all_subgroups_in_group_chat,
                                        find_subgroup_by_telegram_group_chat_id_and_subgroup_name,
                                        find_all_users_in_subgroup)
+from shout_subgroup.send_scheduler import defer_replies
 from shout_subgroup.utils import is_group_chat
 
-from shout_subgroup.database import get_database
+from shout_subgroup.database import read_only_session, REPLICA_LAG_SECONDS
 
 
-async def _handle_list_subgroups(update: Update, db: Session, telegram_group_chat_id: int):
+async def render_subgroups(db: AsyncSession, telegram_group_chat_id: int) -> str:
     """
-       Handles the listing of subgroups for a given Telegram group chat.
+       Renders the listing of subgroups for a given Telegram group chat.
 
        Args:
-           update (Update): The update object from the Telegram bot.
-           db (Session): The SQLAlchemy session object.
+           db (AsyncSession): The SQLAlchemy async session object.
            telegram_group_chat_id (int): The ID of the Telegram group chat.
 
        Returns:
-           List[str]: A list of subgroup names.
+           str: The reply listing the subgroup names.
 
        Raises:
            NotGroupChatError: If the provided chat ID is not a group chat.
-           SubGroupExistsError: If a subgroup already exists for the provided chat ID and name.
        """
     subgroups = await list_subgroups(db, telegram_group_chat_id)
 
     if not subgroups:
-        await update.message.reply_text(f"There are no subgroups in this chat")
-        return
+        return f"There are no subgroups in this chat"
 
     # "mock-subgroup-1, mock-subgroup-2, mock-subgroup-3"
     subgroups_names = [f"'{sub.name}'" for sub in subgroups]
     joined_subgroup_names = ", ".join(subgroups_names)
 
-    await update.message.reply_text(f"Here are the subgroups for this chat: {joined_subgroup_names}")
-    return
+    return f"Here are the subgroups for this chat: {joined_subgroup_names}"
 
 
-async def list_subgroups(db: Session, telegram_group_chat_id: int) -> list[Type[SubgroupModel]]:
+async def list_subgroups(db: AsyncSession, telegram_group_chat_id: int) -> list[Type[SubgroupModel]]:
     # Guard Clauses
     if not await is_group_chat(telegram_group_chat_id):
         msg = f"Can't list subgroups because telegram chat id {telegram_group_chat_id} is not a group chat."
@@ -57,22 +55,20 @@ async def list_subgroups(db: Session, telegram_group_chat_id: int) -> list[Type[
     return subgroups
 
 
-async def _handle_list_subgroup_members(update: Update, db: Session, telegram_group_chat_id: int, subgroup_name: str):
+async def render_subgroup_members(db: AsyncSession, telegram_group_chat_id: int, subgroup_name: str) -> str:
     members = await list_subgroup_members(db, telegram_group_chat_id, subgroup_name)
 
     if not members:
-        await update.message.reply_text(f"'{subgroup_name}' subgroup does not have any members")
-        return
+        return f"'{subgroup_name}' subgroup does not have any members"
 
     # "@username1, @username2, @username3"
     usernames = [f"@{member.username}" for member in members]
     joined_usernames = ", ".join(usernames)
 
-    await update.message.reply_text(f"'{subgroup_name}' subgroup has these members: {joined_usernames}")
-    return
+    return f"'{subgroup_name}' subgroup has these members: {joined_usernames}"
 
 
-async def list_subgroup_members(db: Session, telegram_group_chat_id: int, subgroup_name: str) -> list[Type[UserModel]]:
+async def list_subgroup_members(db: AsyncSession, telegram_group_chat_id: int, subgroup_name: str) -> list[Type[UserModel]]:
     # Guard Clauses
     if not await is_group_chat(telegram_group_chat_id):
         msg = f"Can't list subgroups because telegram chat id {telegram_group_chat_id} is not a group chat."
@@ -109,24 +105,29 @@ async def list_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TY
     args = context.args
     chat_id = update.effective_chat.id
     subgroup_name = args[0] if len(args) == 1 else ""
-    db_session = get_database()
 
-    with db_session.begin() as session:
-
-        try:
+    async def render_list() -> str:
+        # The replica may not have a change that was just made
+        prefer_primary = rendered_output_cache.changed_within(chat_id, REPLICA_LAG_SECONDS)
+        async with read_only_session(prefer_primary) as session:
             # If the subgroup name doesn't exist, we'll default to listing the subgroups
             if subgroup_name:
-                await _handle_list_subgroup_members(update, session, chat_id, subgroup_name)
-            else:
-                await _handle_list_subgroups(update, session, chat_id)
+                return await render_subgroup_members(session, chat_id, subgroup_name)
+            return await render_subgroups(session, chat_id)
+
+    async with defer_replies(update) as replies:
+        try:
+            # Subgroups rarely change between lists, so repeated lists are served without touching the database
+            text = await rendered_output_cache.get_or_render(chat_id, ("list", subgroup_name), render_list)
+            replies.add(text)
 
         except NotGroupChatError:
-            await update.message.reply_text("Sorry, you can only list subgroups in group chats.")
+            replies.add("Sorry, you can only list subgroups in group chats.")
             return
         except SubGroupDoesNotExistsError:
-            await update.message.reply_text(f"Subgroup '{subgroup_name}' does not exist.")
+            replies.add(f"Subgroup '{subgroup_name}' does not exist.")
             return
         except Exception:
             logging.exception("An unexpected exception occurred")
-            await update.message.reply_text("Whoops 😅, something went wrong on our side.")
+            replies.add("Whoops 😅, something went wrong on our side.")
             return
@@ -2,23 +2,70 @@ import logging
 import os
 
 from dotenv import load_dotenv
-from telegram.ext import ApplicationBuilder, CommandHandler, filters, MessageHandler
+from telegram.ext import ApplicationBuilder, CommandHandler, filters, MessageHandler, Application
 
-from group_chat_listener import listen_for_messages_handler, listen_for_new_member_handler, \
+from shout_subgroup.group_chat_listener import listen_for_messages_handler, listen_for_new_member_handler, \
     listen_for_left_member_handler
-from modify_subgroup import subgroup_handler
+from shout_subgroup.modify_subgroup import subgroup_handler
 from shout_subgroup.remove_subgroup_members import remove_subgroup_member_handler
-from shout import shout_handler
+from shout_subgroup.shout import shout_handler
 from shout_subgroup.delete_subgroup import remove_subgroup_handler
 from shout_subgroup.list_subgroup import list_subgroup_handler
+from shout_subgroup.nest_subgroup import nest_subgroup_handler, unnest_subgroup_handler
 
 from shout_subgroup.database import configure_database
+from shout_subgroup.registration_queue import registration_queue
+from shout_subgroup.send_scheduler import send_scheduler
+from shout_subgroup.exceptions import InvalidWebhookConfigError
+from shout_subgroup.webhook import load_webhook_config, run_application
+from shout_subgroup.metrics import metrics_registry, TimedUpdateQueue
+from shout_subgroup.metrics_server import load_metrics_server, MetricsServer
+from shout_subgroup.update_processor import load_update_processor
 
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_API_KEY')
 
 logger = logging.getLogger(__name__)
 
+metrics_server: MetricsServer | None = None
+
+
+async def on_startup(app: Application) -> None:
+    registration_queue.start()
+    logger.info("Started registration queue")
+
+    if metrics_server is not None:
+        await metrics_server.start()
+
+
+async def on_shutdown(app: Application) -> None:
+    # The application has stopped processing updates by now,
+    # so this writes every registration that is still waiting.
+    await registration_queue.stop()
+    logger.info("Drained registration queue")
+
+    await send_scheduler.stop()
+    logger.info("Stopped send scheduler")
+
+    if metrics_server is not None:
+        await metrics_server.stop()
+        logger.info("Stopped metrics server")
+
+
+def register_handlers(app: Application) -> None:
+    # Every handler is instrumented, so its latency and queue lag show up in the metrics
+    instrument = metrics_registry.instrument
+    app.add_handler(CommandHandler("shout", instrument(shout_handler)))
+    app.add_handler(CommandHandler("group", instrument(subgroup_handler)))
+    app.add_handler(CommandHandler("list", instrument(list_subgroup_handler)))
+    app.add_handler(CommandHandler("kick", instrument(remove_subgroup_member_handler)))
+    app.add_handler(CommandHandler("delete", instrument(remove_subgroup_handler)))
+    app.add_handler(CommandHandler("nest", instrument(nest_subgroup_handler)))
+    app.add_handler(CommandHandler("unnest", instrument(unnest_subgroup_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), instrument(listen_for_messages_handler)))
+    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, instrument(listen_for_new_member_handler)))
+    app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, instrument(listen_for_left_member_handler)))
+
 
 def main() -> None:
     # Set up logging configuration
@@ -30,20 +77,30 @@ def main() -> None:
     if not configure_database():
         exit(1)
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    try:
+        webhook_config = load_webhook_config()
+    except InvalidWebhookConfigError as ex:
+        logger.error(f"Unable to configure the webhook. {ex.message}")
+        exit(1)
+
+    global metrics_server
+    metrics_server = load_metrics_server()
+
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .update_queue(TimedUpdateQueue())
+        # Chats are processed concurrently, but each chat's updates stay in order
+        .concurrent_updates(load_update_processor())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
-    app.add_handler(CommandHandler("shout", shout_handler))
-    app.add_handler(CommandHandler("group", subgroup_handler))
-    app.add_handler(CommandHandler("list", list_subgroup_handler))
-    app.add_handler(CommandHandler("kick", remove_subgroup_member_handler))
-    app.add_handler(CommandHandler("delete", remove_subgroup_handler))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), listen_for_messages_handler))
-    app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, listen_for_new_member_handler))
-    app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, listen_for_left_member_handler))
+    register_handlers(app)
 
     logger.info("Built application")
-    logger.info("Starting application")
-    app.run_polling()
+    run_application(app, webhook_config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Roughly how many group chats we'll remember members for.
+# Once we go over, the least recently used chat is evicted.
+DEFAULT_MAX_CHATS = 1024
+# Where a session keeps the members it registered, until it commits
+_REGISTERED_MEMBERS_KEY = "membership_cache_registered_members"
+
+
+class ChatMembershipCache:
+    """
+    Bounded LRU cache of telegram_group_chat_id -> known telegram_user_ids.
+
+    The message listener runs on every message, and almost every message
+    comes from someone we've already registered. This cache lets us skip
+    the database entirely for those senders.
+
+    A cache miss is never wrong, it only costs us a database lookup,
+    so anything that could make an entry stale should just invalidate it.
+    """
+
+    def __init__(self, max_chats: int = DEFAULT_MAX_CHATS):
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, set[int]] = OrderedDict()
+
+    def contains(self, telegram_group_chat_id: int, telegram_user_id: int) -> bool:
+        """
+        Checks if we know the user is already registered in the group chat
+        :param telegram_group_chat_id:
+        :param telegram_user_id:
+        :return: True if the user is known to be in the group chat
+        """
+        members = self._chats.get(telegram_group_chat_id)
+        if members is None:
+            return False
+
+        self._chats.move_to_end(telegram_group_chat_id)
+        return telegram_user_id in members
+
+    def add(self, telegram_group_chat_id: int, *telegram_user_ids: int) -> None:
+        """
+        Records that the users are registered in the group chat
+        :param telegram_group_chat_id:
+        :param telegram_user_ids:
+        :return:
+        """
+        members = self._chats.setdefault(telegram_group_chat_id, set())
+        members.update(telegram_user_ids)
+        self._chats.move_to_end(telegram_group_chat_id)
+
+        while len(self._chats) > self.max_chats:
+            evicted_chat_id, _ = self._chats.popitem(last=False)
+            logger.debug(f"Evicted telegram chat id '{evicted_chat_id}' from the membership cache")
+
+    def discard(self, telegram_group_chat_id: int, telegram_user_id: int) -> None:
+        """
+        Forgets a single user for a group chat, e.g. when they leave
+        :param telegram_group_chat_id:
+        :param telegram_user_id:
+        :return:
+        """
+        members = self._chats.get(telegram_group_chat_id)
+        if members is not None:
+            members.discard(telegram_user_id)
+
+    def invalidate(self, telegram_group_chat_id: int) -> None:
+        """
+        Forgets everything we know about a group chat
+        :param telegram_group_chat_id:
+        :return:
+        """
+        self._chats.pop(telegram_group_chat_id, None)
+
+    def clear(self) -> None:
+        self._chats.clear()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+
+chat_membership_cache = ChatMembershipCache()
+
+
+def add_member_on_commit(db: AsyncSession, telegram_group_chat_id: int, telegram_user_id: int) -> None:
+    """
+    Caches the user as a member of the group chat once the session commits.
+    Caching any earlier would vouch for a registration that may still be rolled back.
+    :param db:
+    :param telegram_group_chat_id:
+    :param telegram_user_id:
+    :return:
+    """
+    db.sync_session.info.setdefault(_REGISTERED_MEMBERS_KEY, set()).add((telegram_group_chat_id, telegram_user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _add_registered_members(session: Session) -> None:
+    registered_members = session.info.pop(_REGISTERED_MEMBERS_KEY, None)
+    if not registered_members:
+        return
+
+    for telegram_group_chat_id, telegram_user_id in registered_members:
+        chat_membership_cache.add(telegram_group_chat_id, telegram_user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_registered_members(session: Session) -> None:
+    # Nothing was registered after all
+    session.info.pop(_REGISTERED_MEMBERS_KEY, None)
@@ -0,0 +1,154 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque, OrderedDict
+from typing import Awaitable, Callable
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# How many recent samples we keep for percentiles
+DEFAULT_SAMPLE_SIZE = 1000
+# How many received updates we remember until a handler picks them up.
+# Updates that no handler matches are forgotten once we go over.
+MAX_PENDING_UPDATES = 10_000
+
+Handler = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+
+class LatencySamples:
+    """
+    The most recent latencies of something, in seconds, for percentiles.
+    Older samples are dropped, so percentiles follow recent behaviour.
+    """
+
+    def __init__(self, sample_size: int = DEFAULT_SAMPLE_SIZE):
+        self._samples: deque[float] = deque(maxlen=sample_size)
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def percentile(self, percentile: float) -> float | None:
+        """
+        :param percentile: between 0 and 100
+        :return: the latency in seconds, None if nothing has been recorded
+        """
+        if not self._samples:
+            return None
+
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class HandlerMetrics:
+    """
+    How often a handler ran, how often it failed, how long it took,
+    and how long updates waited before it started on them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.error_count = 0
+        self.duration_sum = 0.0
+        self.durations = LatencySamples()
+        self.queue_lag_sum = 0.0
+        self.queue_lag_count = 0
+        self.queue_lags = LatencySamples()
+
+    def record_queue_lag(self, lag: float) -> None:
+        self.queue_lag_sum += lag
+        self.queue_lag_count += 1
+        self.queue_lags.record(lag)
+
+    def record_duration(self, duration: float, failed: bool) -> None:
+        self.count += 1
+        self.duration_sum += duration
+        self.durations.record(duration)
+        if failed:
+            self.error_count += 1
+
+
+class MetricsRegistry:
+    """
+    Metrics of every instrumented handler, by handler name.
+    """
+
+    def __init__(self, max_pending_updates: int = MAX_PENDING_UPDATES):
+        self.max_pending_updates = max_pending_updates
+        self.handlers: dict[str, HandlerMetrics] = {}
+        self._received_at: OrderedDict[int, float] = OrderedDict()
+
+    def update_received(self, update: Update) -> None:
+        """
+        Records when an update arrived, so we can tell how long it waited for a handler.
+        Only the first arrival counts, put() may hand the update on to put_nowait().
+        :param update:
+        :return:
+        """
+        if update.update_id in self._received_at:
+            return
+
+        self._received_at[update.update_id] = time.monotonic()
+        while len(self._received_at) > self.max_pending_updates:
+            self._received_at.popitem(last=False)
+
+    def instrument(self, handler: Handler) -> Handler:
+        """
+        Wraps a handler to record its metrics under its name
+        :param handler:
+        :return: the wrapped handler
+        """
+        metrics = self.handlers.setdefault(handler.__name__, HandlerMetrics())
+
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            started_at = time.monotonic()
+            received_at = self._received_at.pop(update.update_id, None)
+            if received_at is not None:
+                metrics.record_queue_lag(started_at - received_at)
+
+            failed = True
+            try:
+                await handler(update, context)
+                failed = False
+            finally:
+                metrics.record_duration(time.monotonic() - started_at, failed)
+
+        return wrapper
+
+    def clear(self) -> None:
+        self.handlers.clear()
+        self._received_at.clear()
+
+
+metrics_registry = MetricsRegistry()
+
+
+class TimedUpdateQueue(asyncio.Queue):
+    """
+    The application's update queue, that records when each update arrived,
+    whether it came from polling or the webhook.
+    """
+
+    def __init__(self, registry: MetricsRegistry = metrics_registry):
+        super().__init__()
+        self.registry = registry
+
+    async def put(self, item) -> None:
+        self._record_arrival(item)
+        await super().put(item)
+
+    def put_nowait(self, item) -> None:
+        self._record_arrival(item)
+        super().put_nowait(item)
+
+    def _record_arrival(self, item) -> None:
+        if isinstance(item, Update):
+            self.registry.update_received(item)
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from shout_subgroup.database import get_database_pool_status, get_replica_pool_status
+from shout_subgroup.metrics import MetricsRegistry, LatencySamples, metrics_registry
+from shout_subgroup.query_metrics import QueryMetrics, query_metrics
+from shout_subgroup.registration_queue import registration_queue
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.send_scheduler import SendScheduler, Priority, send_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Only reachable from the same host by default, scrapers can run next to the bot
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9100
+METRIC_PREFIX = "shout_subgroup"
+QUANTILES = (0.5, 0.95, 0.99)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_sample(name: str, value: float | int | None, labels: dict[str, str] | None = None) -> str:
+    formatted_value = "NaN" if value is None else repr(float(value))
+    if not labels:
+        return f"{name} {formatted_value}"
+
+    formatted_labels = ",".join(f'{key}="{_escape_label_value(str(label))}"' for key, label in labels.items())
+    return f"{name}{{{formatted_labels}}} {formatted_value}"
+
+
+class PrometheusTextWriter:
+    """
+    Writes metrics in the Prometheus text exposition format
+    """
+
+    def __init__(self):
+        self._lines: list[str] = []
+
+    def metric(self, name: str, metric_type: str, help_text: str) -> None:
+        self._lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        self._lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+
+    def sample(self, name: str, value: float | int | None, labels: dict[str, str] | None = None) -> None:
+        self._lines.append(_format_sample(f"{METRIC_PREFIX}_{name}", value, labels))
+
+    def summary(
+            self,
+            name: str,
+            samples: LatencySamples,
+            total: float,
+            count: int,
+            labels: dict[str, str] | None = None
+    ) -> None:
+        quantiles = {quantile: samples.percentile(quantile * 100) for quantile in QUANTILES}
+        self.summary_quantiles(name, quantiles, total, count, labels)
+
+    def summary_quantiles(
+            self,
+            name: str,
+            quantiles: dict[float, float | None],
+            total: float,
+            count: int,
+            labels: dict[str, str] | None = None
+    ) -> None:
+        labels = labels or {}
+        for quantile, value in quantiles.items():
+            self.sample(name, value, labels | {"quantile": str(quantile)})
+        self.sample(f"{name}_sum", total, labels)
+        self.sample(f"{name}_count", count, labels)
+
+    def text(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+def _write_handler_metrics(writer: PrometheusTextWriter, registry: MetricsRegistry) -> None:
+    handlers = sorted(registry.handlers.items())
+
+    writer.metric("handler_updates_total", "counter", "Updates handled")
+    for name, metrics in handlers:
+        writer.sample("handler_updates_total", metrics.count, {"handler": name})
+
+    writer.metric("handler_errors_total", "counter", "Updates the handler raised an error for")
+    for name, metrics in handlers:
+        writer.sample("handler_errors_total", metrics.error_count, {"handler": name})
+
+    writer.metric("handler_duration_seconds", "summary", "Time spent in the handler")
+    for name, metrics in handlers:
+        writer.summary("handler_duration_seconds", metrics.durations, metrics.duration_sum, metrics.count,
+                       {"handler": name})
+
+    writer.metric("handler_queue_lag_seconds", "summary", "Time between receiving an update and the handler starting on it")
+    for name, metrics in handlers:
+        writer.summary("handler_queue_lag_seconds", metrics.queue_lags, metrics.queue_lag_sum,
+                       metrics.queue_lag_count, {"handler": name})
+
+
+def _write_send_scheduler_metrics(writer: PrometheusTextWriter, scheduler: SendScheduler) -> None:
+    metrics = scheduler.metrics
+
+    writer.metric("messages_sent_total", "counter", "Messages Telegram accepted")
+    writer.sample("messages_sent_total", metrics.sent_count)
+    writer.metric("message_retries_total", "counter", "Messages retried after a flood limit")
+    writer.sample("message_retries_total", metrics.retry_count)
+    writer.metric("message_failures_total", "counter", "Messages that couldn't be sent")
+    writer.sample("message_failures_total", metrics.failed_count)
+
+    writer.metric("send_queue_depth", "gauge", "Messages waiting to be sent")
+    for priority in Priority:
+        writer.sample("send_queue_depth", scheduler.queue_depth(priority), {"priority": priority.name.lower()})
+
+    writer.metric("send_latency_seconds", "summary", "Time between queueing a message and Telegram accepting it")
+    writer.summary("send_latency_seconds", metrics.latencies, metrics.latency_sum, metrics.sent_count)
+
+
+def _write_query_metrics(writer: PrometheusTextWriter, metrics: QueryMetrics) -> None:
+    callers = sorted(metrics.query_counts)
+
+    writer.metric("queries_total", "counter", "Statements executed, by repository function")
+    for caller in callers:
+        writer.sample("queries_total", metrics.query_counts[caller], {"function": caller})
+
+    writer.metric("slow_queries_total", "counter", "Statements slower than the slow query threshold")
+    for caller in callers:
+        writer.sample("slow_queries_total", metrics.slow_query_counts.get(caller, 0), {"function": caller})
+
+    writer.metric("query_duration_seconds", "summary", "Statement durations, by repository function")
+    for caller in callers:
+        writer.summary("query_duration_seconds", metrics.latencies[caller], metrics.duration_sums[caller],
+                       metrics.query_counts[caller], {"function": caller})
+
+
+def _write_pool_metrics(writer: PrometheusTextWriter) -> None:
+    statuses = {
+        role: status
+        for role, status in (("primary", get_database_pool_status()), ("replica", get_replica_pool_status()))
+        if status is not None
+    }
+    if not statuses:
+        return
+
+    writer.metric("db_pool_connections", "gauge", "Database connections, by state")
+    for role, status in statuses.items():
+        writer.sample("db_pool_connections", status["in_use"], {"role": role, "state": "in_use"})
+        writer.sample("db_pool_connections", status["idle"], {"role": role, "state": "idle"})
+
+    writer.metric("db_pool_size", "gauge", "Connections the pool keeps open")
+    for role, status in statuses.items():
+        writer.sample("db_pool_size", status["size"], {"role": role})
+
+    writer.metric("db_pool_overflow", "gauge", "Connections opened beyond the pool size")
+    for role, status in statuses.items():
+        writer.sample("db_pool_overflow", status["overflow"], {"role": role})
+
+    instrumented = {role: status for role, status in statuses.items() if "checkout_count" in status}
+    if not instrumented:
+        return
+
+    writer.metric("db_pool_checkouts_total", "counter", "Connections checked out of the pool")
+    for role, status in instrumented.items():
+        writer.sample("db_pool_checkouts_total", status["checkout_count"], {"role": role})
+
+    writer.metric("db_pool_checkout_timeouts_total", "counter", "Checkouts that timed out waiting for a connection")
+    for role, status in instrumented.items():
+        writer.sample("db_pool_checkout_timeouts_total", status["checkout_timeout_count"], {"role": role})
+
+    writer.metric("db_pool_checkout_wait_seconds", "summary", "Time spent waiting for a connection")
+    for role, status in instrumented.items():
+        quantiles = {0.5: status["checkout_wait_p50"], 0.99: status["checkout_wait_p99"]}
+        writer.summary_quantiles("db_pool_checkout_wait_seconds", quantiles, status["checkout_wait_sum"],
+                                 status["checkout_count"], {"role": role})
+
+
+def render_metrics(
+        registry: MetricsRegistry = metrics_registry,
+        scheduler: SendScheduler = send_scheduler,
+        queries: QueryMetrics = query_metrics
+) -> str:
+    """
+    :return: every metric of the bot in the Prometheus text format
+    """
+    writer = PrometheusTextWriter()
+    _write_handler_metrics(writer, registry)
+    _write_send_scheduler_metrics(writer, scheduler)
+    _write_query_metrics(writer, queries)
+    _write_pool_metrics(writer)
+
+    writer.metric("registrations_pending", "gauge", "Registrations waiting to be written")
+    writer.sample("registrations_pending", len(registration_queue))
+
+    writer.metric("render_cache_requests_total", "counter", "Rendered /shout and /list outputs asked for, by result")
+    writer.sample("render_cache_requests_total", rendered_output_cache.hit_count, {"result": "hit"})
+    writer.sample("render_cache_requests_total", rendered_output_cache.miss_count, {"result": "miss"})
+
+    return writer.text()
+
+
+class MetricsServer:
+    """
+    A minimal HTTP server for Prometheus to scrape, answering GET /metrics.
+    It runs on the bot's event loop, so it needs no extra threads or dependencies.
+    """
+
+    def __init__(self, host: str = DEFAULT_METRICS_HOST, port: int = DEFAULT_METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def bound_port(self) -> int | None:
+        if self._server is None or not self._server.sockets:
+            return None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers, nothing in them matters to us
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render_metrics().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Unable to serve metrics")
+        finally:
+            writer.close()
+
+
+def load_metrics_server() -> MetricsServer | None:
+    """
+    Reads the metrics server settings from the environment.
+    Setting METRICS_PORT to 0 turns the server off.
+    :return: the metrics server, None if it's turned off
+    """
+    load_dotenv()
+
+    port = int(os.getenv('METRICS_PORT') or DEFAULT_METRICS_PORT)
+    if port == 0:
+        return None
+
+    return MetricsServer(os.getenv('METRICS_HOST') or DEFAULT_METRICS_HOST, port)
@@ -1,31 +1,72 @@
 from datetime import datetime, timezone
 from uuid import uuid4
 
-from sqlalchemy import Column, String, Integer, BigInteger, DateTime, ForeignKey, Table, UniqueConstraint
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import Column, String, Integer, BigInteger, DateTime, ForeignKey, Table, UniqueConstraint, Index, Uuid
+from sqlalchemy.ext.asyncio import AsyncAttrs
+from sqlalchemy.orm import relationship, declarative_base, validates
+
+# AsyncAttrs gives every model an `awaitable_attrs` accessor,
+# so relationships can be lazy loaded from an AsyncSession.
+# E.g. users = await subgroup.awaitable_attrs.users
+Base = declarative_base(cls=AsyncAttrs)
+
+# Keys are native UUIDs in postgreSQL, 16 bytes instead of 36 characters,
+# but they're still read and written as strings.
+UuidKey = Uuid(as_uuid=False)
+
+
+def normalize_username(username: str | None) -> str | None:
+    """
+    Telegram usernames are case insensitive, so we store and look them up in lower case
+    :param username: e.g. JohnDoe
+    :return: e.g. johndoe
+    """
+    return username.lower() if username else username
 
-Base = declarative_base()
 
 # Needed for the many-to-many relationship between
-# Users and Subgroups
+# Users and Subgroups.
+# The primary key serves lookups by subgroup,
+# and the reverse index serves lookups by user.
 users_subgroups_join_table = Table(
     'users_subgroups_join_table', Base.metadata,
-    Column('subgroup_id', String, ForeignKey('subgroups.subgroup_id')),
-    Column('user_id', String, ForeignKey('users.user_id'))
+    Column('subgroup_id', UuidKey, ForeignKey('subgroups.subgroup_id'), primary_key=True),
+    Column('user_id', UuidKey, ForeignKey('users.user_id'), primary_key=True),
+    Index('ix_users_subgroups_join_table_user_id_subgroup_id', 'user_id', 'subgroup_id')
 )
 
 # Needed for the many-to-many relationship between
-# Users and GroupChats
+# Users and GroupChats.
+# The primary key serves lookups by group chat,
+# and the reverse index serves lookups by user.
 users_group_chats_join_table = Table(
     'users_group_chats_join_table', Base.metadata,
-    Column('group_chat_id', String, ForeignKey('group_chats.group_chat_id')),
-    Column('user_id', String, ForeignKey('users.user_id'))
+    Column('group_chat_id', UuidKey, ForeignKey('group_chats.group_chat_id'), primary_key=True),
+    Column('user_id', UuidKey, ForeignKey('users.user_id'), primary_key=True),
+    Index('ix_users_group_chats_join_table_user_id_group_chat_id', 'user_id', 'group_chat_id')
+)
+
+
+# Needed for subgroups that contain other subgroups, e.g. backend = api + db.
+# The primary key serves expanding a subgroup into the ones it contains,
+# and the reverse index serves finding the subgroups that contain one.
+subgroups_subgroups_join_table = Table(
+    'subgroups_subgroups_join_table', Base.metadata,
+    Column('parent_subgroup_id', UuidKey, ForeignKey('subgroups.subgroup_id'), primary_key=True),
+    Column('child_subgroup_id', UuidKey, ForeignKey('subgroups.subgroup_id'), primary_key=True),
+    Index(
+        'ix_subgroups_subgroups_join_table_child_parent',
+        'child_subgroup_id',
+        'parent_subgroup_id'
+    )
 )
 
 
 class UserModel(Base):
     __tablename__ = 'users'
-    user_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    # Usernames are normalized, so mentions are resolved with a plain index probe
+    __table_args__ = (Index('ix_users_username', 'username'),)
+    user_id = Column(UuidKey, primary_key=True, default=lambda: str(uuid4()))
     telegram_user_id = Column(BigInteger, nullable=False, unique=True)
     username = Column(String, nullable=True)
     first_name = Column(String, nullable=False)
@@ -33,11 +74,15 @@ class UserModel(Base):
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
     updated_at = Column(DateTime)
 
+    @validates('username')
+    def validate_username(self, key: str, username: str | None) -> str | None:
+        return normalize_username(username)
+
 
 class SubgroupModel(Base):
     __tablename__ = 'subgroups'
-    subgroup_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
-    group_chat_id = Column(String, ForeignKey('group_chats.group_chat_id'), nullable=False)
+    subgroup_id = Column(UuidKey, primary_key=True, default=lambda: str(uuid4()))
+    group_chat_id = Column(UuidKey, ForeignKey('group_chats.group_chat_id'), nullable=False)
     name = Column(String, nullable=False)
     description = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
@@ -48,7 +93,7 @@ class SubgroupModel(Base):
 
 class GroupChatModel(Base):
     __tablename__ = 'group_chats'
-    group_chat_id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    group_chat_id = Column(UuidKey, primary_key=True, default=lambda: str(uuid4()))
     telegram_group_chat_id = Column(BigInteger, nullable=False, unique=True)
     name = Column(String, nullable=False)
     description = Column(String, nullable=True)
@@ -56,3 +101,35 @@ class GroupChatModel(Base):
     updated_at = Column(DateTime)
     subgroups = relationship("SubgroupModel", backref="group_chat")
     users = relationship("UserModel", secondary=users_group_chats_join_table, backref="group_chats")
+
+
+class ProcessedUpdateModel(Base):
+    """
+    Every telegram update an instance of the bot has started processing,
+    so an update delivered to two instances is only processed once.
+    """
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime, nullable=False, index=True)
+
+
+class ChatAffinityModel(Base):
+    """
+    The instance of the bot that processed a chat's latest update.
+    An instance taking a chat over from another can't trust what it cached about the chat.
+    """
+    __tablename__ = 'chat_affinity'
+    telegram_chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    instance_id = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class SharedRenderVersionModel(Base):
+    """
+    A version bumped whenever a change affects every chat's rendered output, e.g. a new username.
+    Every instance of the bot checks it, so it knows when another instance made such a change.
+    There's only ever one row.
+    """
+    __tablename__ = 'shared_render_version'
+    shared_render_version_id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(BigInteger, nullable=False)
@@ -1,6 +1,6 @@
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update, Chat
 from telegram.ext import ContextTypes
 
@@ -11,25 +11,28 @@ from shout_subgroup.exceptions import (
     SubGroupDoesNotExistsError, InvalidSubGroupNameError
 )
 from shout_subgroup.models import SubgroupModel
+from shout_subgroup.render_cache import invalidate_chat_on_commit
 from shout_subgroup.repository import (find_subgroup_by_telegram_group_chat_id_and_subgroup_name,
                                        find_group_chat_by_telegram_group_chat_id, insert_subgroup,
                                        insert_group_chat, find_users_by_user_ids, add_users_to_subgroup)
+from shout_subgroup.send_scheduler import defer_replies, DeferredReplies
 from shout_subgroup.utils import (
     are_mentions_valid,
     is_group_chat,
     replace_me_mentions,
-    get_user_id_from_mention,
+    get_user_ids_from_mentions,
     UserIdMentionMapping,
     get_mention_from_user_id_mention_mappings,
-    create_mention_from_user_id
+    create_mention_from_user
 )
 
 from shout_subgroup.database import get_database
 
 
 async def _handle_create_subgroup(
-        db: Session,
+        db: AsyncSession,
         update: Update,
+        replies: DeferredReplies,
         subgroup_name: str,
         users_ids_and_mentions: set[UserIdMentionMapping]
 ):
@@ -40,10 +43,10 @@ async def _handle_create_subgroup(
     # b/c we'd have thrown a UserDoesNotExistsError during create_subgroup
     subgroup_mentions: list[str | None] = [
         await get_mention_from_user_id_mention_mappings(user.user_id, users_ids_and_mentions)
-        for user in subgroup.users
+        for user in await subgroup.awaitable_attrs.users
     ]
     joined_usernames = ", ".join(subgroup_mentions)
-    await update.message.reply_text(
+    replies.add(
         f"Subgroup {subgroup.name} was created with users {joined_usernames}",
         parse_mode="markdown"
     )
@@ -55,7 +58,7 @@ def _is_valid_subgroup_name(subgroup_name: str) -> bool:
 
 
 async def create_subgroup(
-        db: Session,
+        db: AsyncSession,
         telegram_chat: Chat,
         subgroup_name: str,
         user_ids: set[int | None]
@@ -99,15 +102,18 @@ async def create_subgroup(
         )
 
         created_subgroup = await insert_subgroup(db, subgroup_name, created_group_chat.group_chat_id, users_to_be_added)
+        invalidate_chat_on_commit(db, telegram_chat_id)
         return created_subgroup
 
     created_subgroup = await insert_subgroup(db, subgroup_name, group_chat.group_chat_id, users_to_be_added)
+    invalidate_chat_on_commit(db, telegram_chat_id)
     return created_subgroup
 
 
 async def _handle_add_users_to_existing_subgroup(
-        db: Session,
+        db: AsyncSession,
         update: Update,
+        replies: DeferredReplies,
         subgroup_name: str,
         users_ids_and_mentions: set[UserIdMentionMapping]
 ) -> None:
@@ -118,14 +124,13 @@ async def _handle_add_users_to_existing_subgroup(
         subgroup_name,
         user_ids
     )
-    # Note: This list shouldn't have a None value
-    # b/c we'd have thrown a UserDoesNotExistsError during create_subgroup
-    subgroup_mentions: list[str | None] = [
-        await create_mention_from_user_id(db, user.user_id)
-        for user in subgroup.users
+    # The members were loaded while adding the users, so this doesn't query them again
+    subgroup_mentions: list[str] = [
+        create_mention_from_user(user)
+        for user in await subgroup.awaitable_attrs.users
     ]
     joined_usernames = ", ".join(subgroup_mentions)
-    await update.message.reply_text(
+    replies.add(
         f"Subgroup '{subgroup.name}' now has the following members {joined_usernames}",
         parse_mode="markdown"
     )
@@ -133,7 +138,7 @@ async def _handle_add_users_to_existing_subgroup(
 
 
 async def add_users_to_existing_subgroup(
-        db: Session,
+        db: AsyncSession,
         telegram_chat_id: int,
         subgroup_name: str,
         user_ids: set[int | None]
@@ -152,11 +157,12 @@ async def add_users_to_existing_subgroup(
         raise UserDoesNotExistsError("All the usernames are not in the database.")
 
     await add_users_to_subgroup(db, subgroup, user_ids)
+    invalidate_chat_on_commit(db, telegram_chat_id)
 
     return subgroup
 
 
-async def does_subgroup_exist(db: Session, telegram_group_chat_id: int, subgroup_name: str) -> bool:
+async def does_subgroup_exist(db: AsyncSession, telegram_group_chat_id: int, subgroup_name: str) -> bool:
     if not await is_group_chat(telegram_group_chat_id):
         msg = f"Can't list subgroups because telegram chat id {telegram_group_chat_id} is not a group chat."
         logging.info(msg)
@@ -185,12 +191,12 @@ async def subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     args = context.args
     db_session = get_database()
 
-    with db_session.begin() as session:
+    async with defer_replies(update) as replies, db_session.begin() as session:
 
         # Quick guard clause
         if len(args) < 2:
             msg = "You didn't use this command correctly. Please type /group <group_name> @alice @bob ... @zack"
-            await update.message.reply_text(msg)
+            replies.add(msg)
             return
 
         subgroup_name = args[0]
@@ -203,29 +209,32 @@ async def subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         formatted_user_mentions = await replace_me_mentions(user_mentions, update.effective_user)
 
         if not await are_mentions_valid(formatted_user_mentions):
-            await update.message.reply_text("Not all the usernames are valid. Please re-check what you entered.")
+            replies.add("Not all the usernames are valid. Please re-check what you entered.")
 
-        users_ids_and_mentions: set[UserIdMentionMapping] = {
-            await get_user_id_from_mention(session, mention)
-            for mention in formatted_user_mentions
-        }
+        users_ids_and_mentions: set[UserIdMentionMapping] = await get_user_ids_from_mentions(
+            session,
+            update.effective_chat.id,
+            formatted_user_mentions
+        )
 
         try:
 
             is_existing_subgroup = await does_subgroup_exist(session, update.effective_chat.id, subgroup_name)
             if is_existing_subgroup:
-                await _handle_add_users_to_existing_subgroup(session, update, subgroup_name, users_ids_and_mentions)
+                await _handle_add_users_to_existing_subgroup(
+                    session, update, replies, subgroup_name, users_ids_and_mentions
+                )
                 return
             else:
-                await _handle_create_subgroup(session, update, subgroup_name, users_ids_and_mentions)
+                await _handle_create_subgroup(session, update, replies, subgroup_name, users_ids_and_mentions)
                 return
 
         except NotGroupChatError:
-            await update.message.reply_text("Sorry, you can only create or modify subgroups in group chats.")
+            replies.add("Sorry, you can only create or modify subgroups in group chats.")
             return
 
         except SubGroupExistsError:
-            await update.message.reply_text(
+            replies.add(
                 f'"{subgroup_name}" group already exists. Remove the group if you want to recreate it'
             )
 
@@ -233,18 +242,18 @@ async def subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             msg = (f"We don't have a record for some of the users. "
                    f"We can only add users we know about. "
                    f"Please tell some or all the users to send a message to this chat.")
-            await update.message.reply_text(msg)
+            replies.add(msg)
 
         except SubGroupDoesNotExistsError:
             msg = f"Whoops 🧐, we couldn't find subgroup {subgroup_name}. Something went wrong on our side."
-            await update.message.reply_text(msg)
+            replies.add(msg)
 
         except InvalidSubGroupNameError:
             msg = f"'{subgroup_name}' has a @ in the name. That's not allowed, please use a different name."
-            await update.message.reply_text(msg)
+            replies.add(msg)
 
         except Exception:
             logging.exception("An unexpected exception occurred")
-            await update.message.reply_text("Whoops 😅, something went wrong on our side.")
+            replies.add("Whoops 😅, something went wrong on our side.")
 
 
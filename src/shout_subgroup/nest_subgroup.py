@@ -0,0 +1,209 @@
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from shout_subgroup.database import get_database
+from shout_subgroup.exceptions import (
+    NotGroupChatError,
+    SubGroupDoesNotExistsError,
+    SubGroupNestingCycleError,
+    SubGroupNestingTooDeepError
+)
+from shout_subgroup.models import SubgroupModel
+from shout_subgroup.render_cache import invalidate_chat_on_commit
+from shout_subgroup.repository import (
+    find_subgroup_by_telegram_group_chat_id_and_subgroup_name,
+    find_subgroups_by_names,
+    find_subgroup_nesting_depths,
+    nest_subgroups,
+    unnest_subgroups,
+    MAX_SUBGROUP_NESTING_DEPTH
+)
+from shout_subgroup.send_scheduler import defer_replies
+from shout_subgroup.utils import is_group_chat
+
+
+async def _find_parent_and_child_subgroups(
+        db: AsyncSession,
+        telegram_chat_id: int,
+        subgroup_name: str,
+        nested_subgroup_names: set[str]
+) -> tuple[SubgroupModel, list[SubgroupModel]]:
+    if not await is_group_chat(telegram_chat_id):
+        msg = f"Can't nest subgroups because telegram chat id {telegram_chat_id} is not a group chat."
+        logging.info(msg)
+        raise NotGroupChatError(msg)
+
+    subgroup = await find_subgroup_by_telegram_group_chat_id_and_subgroup_name(db, telegram_chat_id, subgroup_name)
+    if not subgroup:
+        msg = f"Subgroup {subgroup_name} does not exist."
+        logging.info(msg)
+        raise SubGroupDoesNotExistsError(msg)
+
+    nested_subgroups = await find_subgroups_by_names(db, telegram_chat_id, nested_subgroup_names)
+    missing_names = nested_subgroup_names - {nested_subgroup.name for nested_subgroup in nested_subgroups}
+    if missing_names:
+        msg = f"Subgroups {', '.join(sorted(missing_names))} do not exist."
+        logging.info(msg)
+        raise SubGroupDoesNotExistsError(msg)
+
+    return subgroup, list(nested_subgroups)
+
+
+async def nest_subgroups_in_subgroup(
+        db: AsyncSession,
+        telegram_chat_id: int,
+        subgroup_name: str,
+        nested_subgroup_names: set[str]
+) -> SubgroupModel:
+    """
+    Nests subgroups in a subgroup, so shouting the subgroup also shouts their members.
+    :param db:
+    :param telegram_chat_id:
+    :param subgroup_name: e.g. backend
+    :param nested_subgroup_names: e.g. api and db
+    :return: the subgroup
+    """
+    subgroup, nested_subgroups = await _find_parent_and_child_subgroups(
+        db,
+        telegram_chat_id,
+        subgroup_name,
+        nested_subgroup_names
+    )
+
+    # How many levels there already are above the subgroup
+    containing_depths = await find_subgroup_nesting_depths(db, subgroup.subgroup_id, downwards=False)
+    depth_above = max(containing_depths.values())
+
+    for nested_subgroup in nested_subgroups:
+        nested_depths = await find_subgroup_nesting_depths(db, nested_subgroup.subgroup_id)
+
+        if subgroup.subgroup_id in nested_depths:
+            msg = f"Subgroup {subgroup_name} is already nested in {nested_subgroup.name}, or is {nested_subgroup.name}."
+            logging.info(msg)
+            raise SubGroupNestingCycleError(msg)
+
+        if depth_above + 1 + max(nested_depths.values()) > MAX_SUBGROUP_NESTING_DEPTH:
+            msg = f"Nesting {nested_subgroup.name} in {subgroup_name} goes over {MAX_SUBGROUP_NESTING_DEPTH} levels."
+            logging.info(msg)
+            raise SubGroupNestingTooDeepError(msg)
+
+    await nest_subgroups(db, subgroup.subgroup_id, {nested_subgroup.subgroup_id for nested_subgroup in nested_subgroups})
+    invalidate_chat_on_commit(db, telegram_chat_id)
+
+    return subgroup
+
+
+async def unnest_subgroups_from_subgroup(
+        db: AsyncSession,
+        telegram_chat_id: int,
+        subgroup_name: str,
+        nested_subgroup_names: set[str]
+) -> SubgroupModel:
+    """
+    Takes subgroups out of a subgroup. The subgroups themselves are kept.
+    :param db:
+    :param telegram_chat_id:
+    :param subgroup_name:
+    :param nested_subgroup_names:
+    :return: the subgroup
+    """
+    subgroup, nested_subgroups = await _find_parent_and_child_subgroups(
+        db,
+        telegram_chat_id,
+        subgroup_name,
+        nested_subgroup_names
+    )
+
+    await unnest_subgroups(db, subgroup.subgroup_id, {nested_subgroup.subgroup_id for nested_subgroup in nested_subgroups})
+    invalidate_chat_on_commit(db, telegram_chat_id)
+
+    return subgroup
+
+
+async def nest_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles nesting subgroups in a subgroup, e.g. /nest backend api db
+    This function should not handle business logic,
+    or storing data. It will delegate that responsibility
+    to other functions. Similar to controllers from the MVC pattern.
+    :param update:
+    :param context:
+    :return:
+    """
+    args = context.args
+    db_session = get_database()
+
+    async with defer_replies(update) as replies, db_session.begin() as session:
+
+        # Quick guard clause
+        if len(args) < 2:
+            msg = "You didn't use this command correctly. Please type /nest <group_name> <subgroup_name> ..."
+            replies.add(msg)
+            return
+
+        subgroup_name = args[0]
+        nested_subgroup_names = set(args[1:])
+
+        try:
+            await nest_subgroups_in_subgroup(session, update.effective_chat.id, subgroup_name, nested_subgroup_names)
+            joined_names = ", ".join(f"'{name}'" for name in sorted(nested_subgroup_names))
+            replies.add(f"Shouting '{subgroup_name}' now also shouts {joined_names}")
+
+        except NotGroupChatError:
+            replies.add("Sorry, you can only create or modify subgroups in group chats.")
+
+        except SubGroupDoesNotExistsError:
+            msg = "I can't nest these subgroups because some of them don't exist. Create them with /group first."
+            replies.add(msg)
+
+        except SubGroupNestingCycleError:
+            msg = f"I can't nest these subgroups, '{subgroup_name}' would end up inside itself."
+            replies.add(msg)
+
+        except SubGroupNestingTooDeepError:
+            msg = f"I can't nest these subgroups, they would be more than {MAX_SUBGROUP_NESTING_DEPTH} levels deep."
+            replies.add(msg)
+
+        except Exception:
+            logging.exception("An unexpected exception occurred")
+            replies.add("Whoops 😅, something went wrong on our side.")
+
+
+async def unnest_subgroup_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles taking subgroups out of a subgroup, e.g. /unnest backend db
+    :param update:
+    :param context:
+    :return:
+    """
+    args = context.args
+    db_session = get_database()
+
+    async with defer_replies(update) as replies, db_session.begin() as session:
+
+        # Quick guard clause
+        if len(args) < 2:
+            msg = "You didn't use this command correctly. Please type /unnest <group_name> <subgroup_name> ..."
+            replies.add(msg)
+            return
+
+        subgroup_name = args[0]
+        nested_subgroup_names = set(args[1:])
+
+        try:
+            await unnest_subgroups_from_subgroup(session, update.effective_chat.id, subgroup_name, nested_subgroup_names)
+            joined_names = ", ".join(f"'{name}'" for name in sorted(nested_subgroup_names))
+            replies.add(f"Shouting '{subgroup_name}' no longer shouts {joined_names}")
+
+        except NotGroupChatError:
+            replies.add("Sorry, you can only create or modify subgroups in group chats.")
+
+        except SubGroupDoesNotExistsError:
+            replies.add("I can't take out these subgroups because some of them don't exist.")
+
+        except Exception:
+            logging.exception("An unexpected exception occurred")
+            replies.add("Whoops 😅, something went wrong on our side.")
@@ -0,0 +1,71 @@
+import asyncio
+from functools import partial
+from typing import Awaitable, Callable, Sequence
+
+from shout_subgroup.send_scheduler import SendScheduler, Priority, send_scheduler
+
+
+class PacedSender:
+    """
+    Sends a series of messages to a chat, in order, through the send scheduler.
+
+    The scheduler paces the messages to stay under Telegram's flood limits.
+    On top of that, a series for the same chat is sent one at a time,
+    so two shouts in the same chat won't interleave.
+    """
+
+    def __init__(self, scheduler: SendScheduler, priority: Priority = Priority.SHOUT):
+        self.scheduler = scheduler
+        self.priority = priority
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        # Series holding or waiting on each chat's lock, the lock is dropped once it's 0
+        self._chat_series_counts: dict[int, int] = {}
+
+    async def send(
+            self,
+            telegram_chat_id: int,
+            messages: Sequence[str],
+            send_message: Callable[[str], Awaitable],
+            on_progress: Callable[[int, int], Awaitable] | None = None
+    ) -> int:
+        """
+        Sends the messages in order.
+        :param telegram_chat_id: the chat the messages are sent to
+        :param messages:
+        :param send_message: sends a single message, e.g. update.message.reply_text
+        :param on_progress: called with (messages sent, total messages) after each message
+        :return: the number of messages that were sent
+        """
+        lock = self._chat_locks.setdefault(telegram_chat_id, asyncio.Lock())
+        self._chat_series_counts[telegram_chat_id] = self._chat_series_counts.get(telegram_chat_id, 0) + 1
+        try:
+            async with lock:
+                for sent_count, message in enumerate(messages, start=1):
+                    await self.scheduler.send(telegram_chat_id, partial(send_message, message), self.priority)
+
+                    if on_progress:
+                        await on_progress(sent_count, len(messages))
+        finally:
+            self._chat_series_counts[telegram_chat_id] -= 1
+            if self._chat_series_counts[telegram_chat_id] == 0:
+                del self._chat_series_counts[telegram_chat_id]
+                del self._chat_locks[telegram_chat_id]
+
+        return len(messages)
+
+    def start(
+            self,
+            telegram_chat_id: int,
+            messages: Sequence[str],
+            send_message: Callable[[str], Awaitable],
+            on_progress: Callable[[int, int], Awaitable] | None = None
+    ) -> asyncio.Task:
+        """
+        Hands the messages to the scheduler, which sends them in the background like send does.
+        Series started one after the other in the same chat are still sent in that order.
+        :return: the task sending the messages
+        """
+        return self.scheduler.run_in_background(self.send(telegram_chat_id, messages, send_message, on_progress))
+
+
+shout_sender = PacedSender(send_scheduler)
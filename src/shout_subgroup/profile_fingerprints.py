@@ -0,0 +1,106 @@
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from shout_subgroup.models import UserModel, normalize_username
+
+logger = logging.getLogger(__name__)
+
+# Roughly how many users we'll remember profiles for.
+# Once we go over, the least recently seen user is evicted.
+DEFAULT_MAX_USERS = 65_536
+# Where a session keeps the profiles it stored, until it commits
+_STORED_PROFILES_KEY = "profile_fingerprints_stored_profiles"
+
+
+def profile_fingerprint(user: UserModel) -> int:
+    """
+    Hashes the parts of a profile we store, so a profile can be compared without keeping it around
+    :param user:
+    :return: the fingerprint
+    """
+    return hash((normalize_username(user.username), user.first_name, user.last_name))
+
+
+class ProfileFingerprintCache:
+    """
+    Bounded LRU cache of telegram_user_id -> fingerprint of the profile we last stored.
+
+    The message listener skips senders it already registered, which used to mean
+    their username and name were never updated, and shouts pinged usernames that no longer exist.
+    Comparing fingerprints tells the listener which senders changed their profile,
+    so only those are written, batched with the other registrations.
+
+    An unknown user counts as changed, so a cache miss only costs us a write.
+    """
+
+    def __init__(self, max_users: int = DEFAULT_MAX_USERS):
+        self.max_users = max_users
+        self._fingerprints: OrderedDict[int, int] = OrderedDict()
+
+    def has_changed(self, user: UserModel) -> bool:
+        """
+        Checks if the user's profile differs from the one we last stored
+        :param user: the profile Telegram sent us
+        :return: True if it changed, or we don't know what we stored
+        """
+        fingerprint = self._fingerprints.get(user.telegram_user_id)
+        if fingerprint is None:
+            return True
+
+        self._fingerprints.move_to_end(user.telegram_user_id)
+        return fingerprint != profile_fingerprint(user)
+
+    def record(self, *users: UserModel) -> None:
+        """
+        Records the profiles that were stored
+        :param users:
+        :return:
+        """
+        self._record_fingerprints({user.telegram_user_id: profile_fingerprint(user) for user in users})
+
+    def _record_fingerprints(self, fingerprints: dict[int, int]) -> None:
+        for telegram_user_id, fingerprint in fingerprints.items():
+            self._fingerprints[telegram_user_id] = fingerprint
+            self._fingerprints.move_to_end(telegram_user_id)
+
+        while len(self._fingerprints) > self.max_users:
+            evicted_user_id, _ = self._fingerprints.popitem(last=False)
+            logger.debug(f"Evicted telegram user id '{evicted_user_id}' from the profile fingerprints")
+
+    def clear(self) -> None:
+        self._fingerprints.clear()
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+
+profile_fingerprint_cache = ProfileFingerprintCache()
+
+
+def record_profile_on_commit(db: AsyncSession, user: UserModel) -> None:
+    """
+    Records the user's profile as stored once the session commits.
+    Recording it any earlier would skip the profile for good if the write is rolled back.
+    The fingerprint is taken now, the user may be expired by the time the session commits.
+    :param db:
+    :param user:
+    :return:
+    """
+    db.sync_session.info.setdefault(_STORED_PROFILES_KEY, {})[user.telegram_user_id] = profile_fingerprint(user)
+
+
+@event.listens_for(Session, "after_commit")
+def _record_stored_profiles(session: Session) -> None:
+    stored_profiles = session.info.pop(_STORED_PROFILES_KEY, None)
+    if stored_profiles:
+        profile_fingerprint_cache._record_fingerprints(stored_profiles)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_stored_profiles(session: Session) -> None:
+    # Nothing was stored after all
+    session.info.pop(_STORED_PROFILES_KEY, None)
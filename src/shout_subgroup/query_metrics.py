@@ -0,0 +1,224 @@
+import asyncio
+import functools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, TypeVar, ParamSpec
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from shout_subgroup.metrics import LatencySamples
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged with their plan
+DEFAULT_SLOW_QUERY_SECONDS = 0.2
+# Queries that weren't made by a repository function, e.g. lazy loading a relationship
+UNTRACKED_CALLER = "untracked"
+# Only these can be explained
+EXPLAINABLE_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+# A statement that keeps being slow is only explained once per this many seconds
+DEFAULT_EXPLAIN_INTERVAL_SECONDS = 300
+# When we remember when this many statements were explained, we forget the ones we could explain again
+MAX_REMEMBERED_EXPLAINS = 1_000
+# Slow statements are often a sign of a busy pool, so they're only explained while at least this share of
+# the pool's connections is free, to keep them for the handlers
+MIN_FREE_POOL_SHARE_TO_EXPLAIN = 0.25
+
+# The repository function whose queries are being executed
+_current_caller: ContextVar[str | None] = ContextVar("current_repository_function", default=None)
+# Set while a slow statement is explained, so the EXPLAIN itself isn't timed
+_is_explaining: ContextVar[bool] = ContextVar("is_explaining_slow_query", default=False)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def track_queries(function: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+    """
+    Records the time of every statement the repository function executes under its name.
+    When tracked functions call each other, the statements belong to the innermost one.
+    :param function:
+    :return:
+    """
+
+    @functools.wraps(function)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        token = _current_caller.set(function.__name__)
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            _current_caller.reset(token)
+
+    return wrapper
+
+
+class QueryMetrics:
+    """
+    Statement counts and latencies, per repository function.
+    """
+
+    def __init__(self):
+        self.query_counts: dict[str, int] = {}
+        self.slow_query_counts: dict[str, int] = {}
+        self.duration_sums: dict[str, float] = {}
+        self.latencies: dict[str, LatencySamples] = {}
+
+    def record(self, caller: str, duration: float, is_slow: bool = False) -> None:
+        self.query_counts[caller] = self.query_counts.get(caller, 0) + 1
+        self.duration_sums[caller] = self.duration_sums.get(caller, 0.0) + duration
+        self.latencies.setdefault(caller, LatencySamples()).record(duration)
+        if is_slow:
+            self.slow_query_counts[caller] = self.slow_query_counts.get(caller, 0) + 1
+
+    def latency_percentile(self, caller: str, percentile: float) -> float | None:
+        samples = self.latencies.get(caller)
+        return samples.percentile(percentile) if samples else None
+
+    def clear(self) -> None:
+        self.query_counts.clear()
+        self.slow_query_counts.clear()
+        self.duration_sums.clear()
+        self.latencies.clear()
+
+
+query_metrics = QueryMetrics()
+
+
+class SlowQueryExplainer:
+    """
+    Logs the plans of slow statements.
+
+    The plan is fetched in the background, on a connection of its own, so the transaction
+    that ran the statement isn't touched, and a failed EXPLAIN doesn't fail the request.
+    A statement is explained at most once per explain_interval seconds, and not while the pool is nearly
+    exhausted, in which case it's explained the next time it's slow.
+    EXPLAIN doesn't run the statement, so this is safe for writes too.
+    """
+
+    def __init__(self, engine: AsyncEngine, explain_interval: float = DEFAULT_EXPLAIN_INTERVAL_SECONDS):
+        self.engine = engine
+        self.explain_interval = explain_interval
+        self._explained_at: dict[str, float] = {}
+        self._explaining: set[asyncio.Task] = set()
+
+    def explain_later(self, caller: str, statement: str, parameters, executemany: bool) -> None:
+        """
+        Starts explaining the statement, unless it can't be explained or was explained recently
+        :param caller: the repository function that ran the statement
+        :param statement:
+        :param parameters: the statement's DBAPI parameters
+        :param executemany:
+        :return:
+        """
+        if executemany or not statement.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS):
+            return
+
+        now = time.monotonic()
+        explained_at = self._explained_at.get(statement)
+        if explained_at is not None and now - explained_at < self.explain_interval:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Only statements run by the async engine can be explained in the background
+            return
+
+        self._remember_explained(statement, now)
+        task = loop.create_task(self._explain(caller, statement, parameters))
+        self._explaining.add(task)
+        task.add_done_callback(self._explaining.discard)
+
+    async def drain(self) -> None:
+        """
+        Waits until every statement being explained is logged
+        :return:
+        """
+        while self._explaining:
+            await asyncio.gather(*self._explaining, return_exceptions=True)
+
+    async def _explain(self, caller: str, statement: str, parameters) -> None:
+        _is_explaining.set(True)
+        if not self._has_free_connections():
+            # Forget it, so it's explained once the pool is less busy
+            self._explained_at.pop(statement, None)
+            logger.info(f"Skipped explaining slow query in {caller}, the connection pool is busy")
+            return
+
+        explain = "EXPLAIN QUERY PLAN" if self.engine.dialect.name == "sqlite" else "EXPLAIN"
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.exec_driver_sql(f"{explain} {statement}", parameters)
+                plan = "\n".join(" ".join(str(column) for column in row) for row in result.fetchall())
+        except Exception as ex:
+            logger.warning(f"Unable to explain slow query in {caller}. {ex}")
+            return
+
+        logger.warning(f"Plan of slow query in {caller}\n{statement}\nPlan:\n{plan}")
+
+    def _has_free_connections(self) -> bool:
+        pool = self.engine.sync_engine.pool
+        capacity = getattr(pool, "capacity", lambda: None)()
+        if capacity is None:
+            # There's no limit we know of, e.g. a single shared connection in tests
+            return True
+
+        return capacity - pool.checkedout() > capacity * MIN_FREE_POOL_SHARE_TO_EXPLAIN
+
+    def _remember_explained(self, statement: str, now: float) -> None:
+        if len(self._explained_at) >= MAX_REMEMBERED_EXPLAINS:
+            self._explained_at = {
+                remembered: explained_at
+                for remembered, explained_at in self._explained_at.items()
+                if now - explained_at < self.explain_interval
+            }
+
+        self._explained_at[statement] = now
+
+
+def instrument_query_timing(
+        engine: AsyncEngine,
+        metrics: QueryMetrics = query_metrics,
+        slow_query_seconds: float = DEFAULT_SLOW_QUERY_SECONDS,
+        explain_interval: float = DEFAULT_EXPLAIN_INTERVAL_SECONDS
+) -> SlowQueryExplainer:
+    """
+    Times every statement the engine executes, and logs slow ones, followed by their plan.
+    :param engine:
+    :param metrics: where the timings are recorded
+    :param slow_query_seconds: statements at least this slow are logged with their plan
+    :param explain_interval: seconds before the same slow statement is explained again
+    :return: the explainer of the slow statements
+    """
+    explainer = SlowQueryExplainer(engine, explain_interval)
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info["query_started_at"].pop()
+        if _is_explaining.get():
+            return
+
+        caller = _current_caller.get() or UNTRACKED_CALLER
+        is_slow = duration >= slow_query_seconds
+        metrics.record(caller, duration, is_slow)
+
+        if is_slow:
+            logger.warning(f"Slow query in {caller} took {duration:.3f} seconds\n{statement}")
+            explainer.explain_later(caller, statement, parameters, executemany)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute doesn't run for failed statements.
+        # ExceptionContext.cursor is never set, so the execution context tells us a statement ran.
+        connection = exception_context.connection
+        if exception_context.execution_context is not None and connection is not None \
+                and connection.info.get("query_started_at"):
+            connection.info["query_started_at"].pop()
+
+    return explainer
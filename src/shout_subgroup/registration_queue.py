@@ -0,0 +1,205 @@
+import asyncio
+import logging
+from typing import Iterable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Chat
+
+from shout_subgroup.database import get_database
+from shout_subgroup.membership_cache import chat_membership_cache
+from shout_subgroup.models import UserModel, GroupChatModel
+from shout_subgroup.profile_fingerprints import profile_fingerprint_cache
+from shout_subgroup.render_cache import invalidate_all_on_commit, invalidate_chat_on_commit
+from shout_subgroup.repository import upsert_group_chats, upsert_users, insert_users_into_group_chats
+
+logger = logging.getLogger(__name__)
+
+# How long registrations wait before they're written, in seconds
+DEFAULT_FLUSH_INTERVAL = 0.5
+# How many registrations we'll hold before writing them early
+DEFAULT_MAX_BATCH_SIZE = 500
+
+
+async def register_users_in_group_chats(
+        db: AsyncSession,
+        registrations: Iterable[tuple[GroupChatModel, UserModel]]
+) -> int:
+    """
+    Saves a batch of (group chat, user) registrations using a handful of bulk statements.
+    Group chats and users we don't know are created, and the users
+    are added to the group chats they aren't in yet.
+    :param db:
+    :param registrations: unsaved group chats and users
+    :return: the number of users that were added to group chats
+    """
+    registrations = list(registrations)
+    group_chats: dict[int, GroupChatModel] = {}
+    users: dict[int, UserModel] = {}
+    for group_chat, user in registrations:
+        group_chats[group_chat.telegram_group_chat_id] = group_chat
+        users[user.telegram_user_id] = user
+
+    group_chat_ids = await upsert_group_chats(db, list(group_chats.values()))
+    user_ids, changed_telegram_user_ids = await upsert_users(db, list(users.values()))
+
+    group_chat_id_user_id_pairs = {
+        (group_chat_ids[group_chat.telegram_group_chat_id], user_ids[user.telegram_user_id])
+        for group_chat, user in registrations
+    }
+    added_count = await insert_users_into_group_chats(db, group_chat_id_user_id_pairs)
+
+    # A new profile shows in every chat the user is in, while new members only show in their chats
+    if changed_telegram_user_ids:
+        await invalidate_all_on_commit(db)
+    elif added_count:
+        for telegram_group_chat_id in group_chats:
+            invalidate_chat_on_commit(db, telegram_group_chat_id)
+
+    return added_count
+
+
+class RegistrationQueue:
+    """
+    Write-behind queue for registering the senders of messages.
+
+    Instead of opening a transaction for every message, the listener
+    enqueues who it saw, and a background task writes the deduplicated
+    registrations in one transaction every flush_interval seconds,
+    or as soon as max_batch_size registrations are waiting.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._pending: dict[tuple[int, int], tuple[GroupChatModel, UserModel]] = {}
+        # The batch being written, and a lock so only one batch is written at a time
+        self._writing: dict[tuple[int, int], tuple[GroupChatModel, UserModel]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wake_up = asyncio.Event()
+        self._is_stopping = False
+        self._task: asyncio.Task | None = None
+
+    def enqueue(self, chat: Chat, user: UserModel) -> None:
+        """
+        Queues a user to be registered in a telegram group chat.
+        If the same user is queued more than once, the latest one wins.
+        :param chat:
+        :param user: the unsaved user
+        :return:
+        """
+        group_chat = GroupChatModel(
+            telegram_group_chat_id=chat.id,
+            name=chat.title,
+            description=chat.description
+        )
+        self._pending[(chat.id, user.telegram_user_id)] = (group_chat, user)
+
+        if len(self._pending) >= self.max_batch_size:
+            self._wake_up.set()
+
+    async def discard(self, telegram_group_chat_id: int, telegram_user_id: int) -> None:
+        """
+        Drops a queued registration, e.g. when the user leaves before it's written.
+        If the registration is already being written, waits for the write,
+        so the caller can undo it afterwards.
+        :param telegram_group_chat_id:
+        :param telegram_user_id:
+        :return:
+        """
+        key = (telegram_group_chat_id, telegram_user_id)
+        self._pending.pop(key, None)
+
+        if key in self._writing:
+            async with self._flush_lock:
+                # A failed write queues its batch again
+                self._pending.pop(key, None)
+
+    def is_pending(self, telegram_group_chat_id: int, telegram_user_id: int) -> bool:
+        return (telegram_group_chat_id, telegram_user_id) in self._pending
+
+    def has_pending(self, telegram_group_chat_id: int) -> bool:
+        """
+        :param telegram_group_chat_id:
+        :return: True if registrations in the chat are queued, or being written
+        """
+        return (any(chat_id == telegram_group_chat_id for chat_id, _ in self._pending)
+                or any(chat_id == telegram_group_chat_id for chat_id, _ in self._writing))
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._is_stopping = False
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """
+        Stops the background task and drains the queue,
+        so that no registrations are lost on shutdown.
+        :return:
+        """
+        if self._task is not None:
+            self._is_stopping = True
+            self._wake_up.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+    async def flush(self) -> int:
+        """
+        Writes all the pending registrations in one transaction.
+        If the write fails, the registrations are queued again.
+        A flush that's already writing is waited for, so everything queued before the call is written by its end.
+        :return: the number of registrations that were written
+        """
+        async with self._flush_lock:
+            return await self._write_pending()
+
+    async def _write_pending(self) -> int:
+        if not self._pending:
+            return 0
+
+        batch, self._pending = self._pending, {}
+        self._writing = batch
+
+        try:
+            db_session = get_database()
+            async with db_session.begin() as session:
+                added_count = await register_users_in_group_chats(session, batch.values())
+        except Exception:
+            # Anything queued while we were writing is newer, so it wins
+            self._pending = batch | self._pending
+            raise
+        finally:
+            self._writing = {}
+
+        # Only cache what was committed
+        for telegram_group_chat_id, telegram_user_id in batch:
+            chat_membership_cache.add(telegram_group_chat_id, telegram_user_id)
+        profile_fingerprint_cache.record(*(user for _, user in batch.values()))
+
+        logger.info(f"Flushed {len(batch)} registrations, {added_count} users were added to group chats")
+        return len(batch)
+
+    async def _flush_periodically(self) -> None:
+        while not self._is_stopping:
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wake_up.clear()
+
+            if self._is_stopping:
+                # stop() drains whatever is left
+                return
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Unable to flush registrations, they'll be retried on the next flush")
+
+
+registration_queue = RegistrationQueue()
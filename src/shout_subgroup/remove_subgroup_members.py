@@ -1,18 +1,20 @@
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from shout_subgroup.database import get_database
 from shout_subgroup.exceptions import NotGroupChatError, SubGroupDoesNotExistsError, UserDoesNotExistsError
 from shout_subgroup.models import SubgroupModel
+from shout_subgroup.render_cache import invalidate_chat_on_commit
 from shout_subgroup.repository import (
     find_subgroup_by_telegram_group_chat_id_and_subgroup_name,
     remove_users_from_subgroup
 )
+from shout_subgroup.send_scheduler import defer_replies
 from shout_subgroup.utils import is_group_chat, replace_me_mentions, are_mentions_valid, UserIdMentionMapping, \
-    get_user_id_from_mention
+    get_user_ids_from_mentions
 
 
 async def remove_subgroup_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -28,12 +30,12 @@ async def remove_subgroup_member_handler(update: Update, context: ContextTypes.D
     args = context.args
     db_session = get_database()
 
-    with db_session.begin() as session:
+    async with defer_replies(update) as replies, db_session.begin() as session:
 
         # Quick guard clause
         if len(args) < 2:
             msg = "You didn't use this command correctly. Please type /kick <group_name> @alice @bob ... @zack"
-            await update.message.reply_text(msg)
+            replies.add(msg)
             return
 
         subgroup_name = args[0]
@@ -46,12 +48,13 @@ async def remove_subgroup_member_handler(update: Update, context: ContextTypes.D
         formatted_user_mentions = await replace_me_mentions(user_mentions, update.effective_user)
 
         if not await are_mentions_valid(formatted_user_mentions):
-            await update.message.reply_text("Not all the usernames are valid. Please re-check what you entered.")
+            replies.add("Not all the usernames are valid. Please re-check what you entered.")
 
-        users_ids_and_mentions: set[UserIdMentionMapping] = {
-            await get_user_id_from_mention(session, mention)
-            for mention in formatted_user_mentions
-        }
+        users_ids_and_mentions: set[UserIdMentionMapping] = await get_user_ids_from_mentions(
+            session,
+            update.effective_chat.id,
+            formatted_user_mentions
+        )
 
         try:
 
@@ -63,37 +66,38 @@ async def remove_subgroup_member_handler(update: Update, context: ContextTypes.D
                 user_ids
             )
 
-            subgroup_usernames = [f"@{user.username}" for user in subgroup.users]
+            subgroup_users = await subgroup.awaitable_attrs.users
+            subgroup_usernames = [f"@{user.username}" for user in subgroup_users]
             joined_usernames = ", ".join(subgroup_usernames)
             msg = (
                 f"Subgroup {subgroup.name} now has the following members {joined_usernames}"
-                if subgroup.users
+                if subgroup_users
                 else f"Subgroup '{subgroup.name}' has no members"
             )
-            await update.message.reply_text(msg)
+            replies.add(msg)
             return
 
         except NotGroupChatError:
-            await update.message.reply_text("Sorry, you can only create or modify subgroups in group chats.")
+            replies.add("Sorry, you can only create or modify subgroups in group chats.")
             return
 
         except SubGroupDoesNotExistsError:
             msg = f"I can't kick members because subgroup '{subgroup_name}' does not exist"
-            await update.message.reply_text(msg)
+            replies.add(msg)
 
         except UserDoesNotExistsError:
             msg = (f"We don't have a record for some of the users. "
                    f"We can only remove users we know about. "
                    f"Please tell some or all the users to send a message to this chat.")
-            await update.message.reply_text(msg)
+            replies.add(msg)
 
         except Exception:
             logging.exception("An unexpected exception occurred")
-            await update.message.reply_text("Whoops 😅, something went wrong on our side.")
+            replies.add("Whoops 😅, something went wrong on our side.")
 
 
 async def remove_users_from_existing_subgroup(
-        db: Session,
+        db: AsyncSession,
         telegram_chat_id: int,
         subgroup_name: str,
         user_ids: set[int | None]
@@ -116,5 +120,6 @@ async def remove_users_from_existing_subgroup(
         raise UserDoesNotExistsError("All the usernames are not in the database.")
 
     await remove_users_from_subgroup(db, subgroup, user_ids)
+    invalidate_chat_on_commit(db, telegram_chat_id)
 
     return subgroup
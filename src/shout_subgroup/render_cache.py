@@ -0,0 +1,160 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from shout_subgroup.repository import bump_shared_render_version
+
+logger = logging.getLogger(__name__)
+
+# How many rendered outputs we keep. Once we go over, the least recently used one is evicted.
+DEFAULT_MAX_ENTRIES = 4096
+# Where a session keeps the chats it changed, until it commits
+_CHANGED_CHATS_KEY = "render_cache_changed_chats"
+_ALL_CHATS = object()
+
+T = TypeVar("T")
+
+
+class RenderedOutputCache:
+    """
+    Bounded LRU cache of rendered command output, e.g. the messages of /shout devs.
+
+    Every chat has a version that is bumped whenever its subgroups or members change.
+    An output is only served while the version it was rendered at is still current,
+    so a change never needs to find and evict the outputs it affects.
+    Profile changes, e.g. a new username, can affect every chat a user is in,
+    so they bump a global version instead. When other instances of the bot run, see is_shared,
+    that version is shared through the database, so they also notice profile changes made by the others.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # Set once the bot coordinates with other instances, nobody reads the shared version otherwise
+        self.is_shared = False
+        self.hit_count = 0
+        self.miss_count = 0
+        self._global_version = 0
+        self._chat_versions: dict[int, int] = {}
+        self._global_changed_at: float | None = None
+        self._chat_changed_at: dict[int, float] = {}
+        self._entries: OrderedDict[tuple[int, Hashable], tuple[tuple[int, int], Any]] = OrderedDict()
+
+    def version(self, telegram_group_chat_id: int) -> tuple[int, int]:
+        return self._global_version, self._chat_versions.get(telegram_group_chat_id, 0)
+
+    def bump(self, telegram_group_chat_id: int) -> None:
+        """
+        Makes every output rendered for the chat so far stale
+        :param telegram_group_chat_id:
+        :return:
+        """
+        self._chat_versions[telegram_group_chat_id] = self._chat_versions.get(telegram_group_chat_id, 0) + 1
+        self._chat_changed_at[telegram_group_chat_id] = time.monotonic()
+
+    def bump_all(self) -> None:
+        """
+        Makes every output rendered so far stale
+        :return:
+        """
+        self._global_version += 1
+        self._global_changed_at = time.monotonic()
+
+    def changed_within(self, telegram_group_chat_id: int, seconds: float) -> bool:
+        """
+        Checks if the chat changed recently, e.g. so reads can avoid a read replica that may not have the change yet
+        :param telegram_group_chat_id:
+        :param seconds:
+        :return: True if the chat changed in the last `seconds` seconds
+        """
+        changed_at = max(self._chat_changed_at.get(telegram_group_chat_id, 0.0), self._global_changed_at or 0.0)
+        return changed_at > 0 and time.monotonic() - changed_at < seconds
+
+    async def get_or_render(self, telegram_group_chat_id: int, key: Hashable, render: Callable[[], Awaitable[T]]) -> T:
+        """
+        Returns the cached output if it's still current, otherwise renders and caches it.
+        Nothing is cached if render raises.
+        :param telegram_group_chat_id:
+        :param key: what was rendered for the chat, e.g. ("shout", "devs")
+        :param render: renders the output, querying whatever it needs
+        :return: the rendered output
+        """
+        entry_key = (telegram_group_chat_id, key)
+        entry = self._entries.get(entry_key)
+        # The version is read before rendering. If the chat changes while we render,
+        # the output is stored under the old version and is never served.
+        version = self.version(telegram_group_chat_id)
+
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(entry_key)
+            self.hit_count += 1
+            return entry[1]
+
+        self.miss_count += 1
+        output = await render()
+
+        self._entries[entry_key] = (version, output)
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        return output
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._chat_versions.clear()
+        self._chat_changed_at.clear()
+        self._global_changed_at = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+rendered_output_cache = RenderedOutputCache()
+
+
+def invalidate_chat_on_commit(db: AsyncSession, telegram_group_chat_id: int) -> None:
+    """
+    Bumps the chat's version once the session commits.
+    Bumping any earlier could let a concurrent render cache the old data under the new version.
+    :param db:
+    :param telegram_group_chat_id:
+    :return:
+    """
+    db.sync_session.info.setdefault(_CHANGED_CHATS_KEY, set()).add(telegram_group_chat_id)
+
+
+async def invalidate_all_on_commit(db: AsyncSession) -> None:
+    """
+    Bumps the global version once the session commits, e.g. when user profiles change.
+    When other instances of the bot run, the shared version is bumped in the same transaction, so they notice too.
+    :param db:
+    :return:
+    """
+    db.sync_session.info.setdefault(_CHANGED_CHATS_KEY, set()).add(_ALL_CHATS)
+    if rendered_output_cache.is_shared:
+        await bump_shared_render_version(db)
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_changed_chats(session: Session) -> None:
+    changed_chats = session.info.pop(_CHANGED_CHATS_KEY, None)
+    if not changed_chats:
+        return
+
+    if _ALL_CHATS in changed_chats:
+        rendered_output_cache.bump_all()
+        return
+
+    for telegram_group_chat_id in changed_chats:
+        rendered_output_cache.bump(telegram_group_chat_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_chats(session: Session) -> None:
+    # Nothing changed after all
+    session.info.pop(_CHANGED_CHATS_KEY, None)
@@ -1,130 +1,349 @@
-from typing import Sequence, Type
+from datetime import datetime
+from typing import Iterable, Sequence, Type
 
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, delete, literal, literal_column, and_, or_, union, intersect, except_, Select, CTE
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
 
 from shout_subgroup.models import (
     SubgroupModel,
     UserModel,
     GroupChatModel,
     users_group_chats_join_table,
-    users_subgroups_join_table
+    users_subgroups_join_table,
+    subgroups_subgroups_join_table,
+    UuidKey,
+    ProcessedUpdateModel,
+    ChatAffinityModel,
+    SharedRenderVersionModel,
+    normalize_username
 )
+from shout_subgroup.query_metrics import track_queries
+from shout_subgroup.subgroup_expression import SubgroupExpression
 
 
-async def find_all_users_in_subgroup(db: Session, group_chat_id: int, subgroup_name: str) -> list[Type[UserModel]]:
-    users = (
-        db.query(UserModel)
-        .join(users_subgroups_join_table)
-        .join(SubgroupModel)
-        .filter(SubgroupModel.name == subgroup_name, SubgroupModel.group_chat_id == group_chat_id)
-        .all()
+def _upsertable_insert(db: AsyncSession, table):
+    """
+    Creates an INSERT statement for the database we're connected to,
+    so that ON CONFLICT clauses work in both PostgreSQL and SQLite (used in tests).
+    :param db:
+    :param table: the table or model to insert into
+    :return: the insert statement
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite_insert(table)
+
+    return postgresql_insert(table)
+
+
+# The only row of shared_render_version
+SHARED_RENDER_VERSION_ID = 1
+# How many levels of subgroups a subgroup can contain, e.g. backend > api > payments is 2.
+# Expanding a subgroup also stops here, so a cycle can never make it run away.
+MAX_SUBGROUP_NESTING_DEPTH = 5
+
+
+def _subgroup_hierarchy(start: Select, downwards: bool = True, name: str = "subgroup_hierarchy") -> CTE:
+    """
+    Creates a recursive CTE of the subgroups nested in the starting subgroups, or containing them.
+    :param start: selects the subgroup ids to start from
+    :param downwards: True for the subgroups they contain, False for the subgroups containing them
+    :param name: must be unique within a query
+    :return: a CTE with subgroup_id and depth columns, the starting subgroups are at depth 0.
+    A subgroup reachable through more than one path is there once per depth it's reachable at.
+    """
+    join_table = subgroups_subgroups_join_table
+    from_column, to_column = (
+        (join_table.c.parent_subgroup_id, join_table.c.child_subgroup_id)
+        if downwards else
+        (join_table.c.child_subgroup_id, join_table.c.parent_subgroup_id)
+    )
+
+    # The depth is written inline, postgreSQL can't tell the type of a bound parameter in a recursive CTE
+    hierarchy = (
+        start.add_columns(literal_column("0").label("depth"))
+        .cte(name, recursive=True)
+    )
+    parents = hierarchy.alias()
+    # UNION drops repeated rows, so wide hierarchies that share subgroups stay small
+    return hierarchy.union(
+        select(to_column, parents.c.depth + 1)
+        .join(parents, from_column == parents.c.subgroup_id)
+        .where(parents.c.depth < MAX_SUBGROUP_NESTING_DEPTH)
+    )
+
+
+def _subgroup_member_ids(group_chat_id: str, subgroup_name: str, name: str = "subgroup_hierarchy") -> Select:
+    """
+    Selects the ids of the members of a subgroup, and of every subgroup nested in it
+    :param group_chat_id:
+    :param subgroup_name:
+    :param name: of the CTE expanding the subgroup, must be unique within a query
+    :return:
+    """
+    subgroups = _subgroup_hierarchy(
+        select(SubgroupModel.subgroup_id)
+        .where(SubgroupModel.name == subgroup_name, SubgroupModel.group_chat_id == group_chat_id),
+        name=name
+    )
+    return (
+        select(users_subgroups_join_table.c.user_id)
+        .join(subgroups, users_subgroups_join_table.c.subgroup_id == subgroups.c.subgroup_id)
+    )
+
+
+def _users_with_ids(user_ids: Select) -> Select:
+    return (
+        select(UserModel)
+        .where(UserModel.user_id.in_(user_ids))
+        # Rows come back in index order otherwise, so keep mentions in a stable order
+        .order_by(UserModel.telegram_user_id)
+    )
+
+
+@track_queries
+async def find_all_users_in_subgroup(db: AsyncSession, group_chat_id: int, subgroup_name: str) -> list[Type[UserModel]]:
+    """
+    Finds the members of a subgroup, and of every subgroup nested in it, in a single query.
+    A user in more than one of them is only found once.
+    :param db:
+    :param group_chat_id:
+    :param subgroup_name:
+    :return: the users
+    """
+    stmt = _users_with_ids(_subgroup_member_ids(group_chat_id, subgroup_name))
+    users = (await db.execute(stmt)).scalars().all()
+
+    return users
+
+
+# How each operator of a subgroup expression combines the members
+_SET_OPERATIONS = {"+": union, "&": intersect, "-": except_}
+
+
+@track_queries
+async def find_all_users_in_subgroup_expression(
+        db: AsyncSession,
+        group_chat_id: str,
+        expression: SubgroupExpression
+) -> list[Type[UserModel]]:
+    """
+    Finds the members of a subgroup expression, e.g. devs+ops, in a single query.
+    Every operation is a UNION, INTERSECT or EXCEPT, so a user is only found once.
+    A subgroup named like the whole expression, e.g. front-end, wins over the expression.
+    :param db:
+    :param group_chat_id:
+    :param expression:
+    :return: the users
+    """
+    if not expression.operations:
+        return await find_all_users_in_subgroup(db, group_chat_id, expression.first_subgroup_name)
+
+    user_ids = _subgroup_member_ids(group_chat_id, expression.first_subgroup_name, "subgroup_hierarchy_0")
+    for index, (operator, subgroup_name) in enumerate(expression.operations, start=1):
+        members = _subgroup_member_ids(group_chat_id, subgroup_name, f"subgroup_hierarchy_{index}")
+        # Selecting from the result so far applies the operations left to right.
+        # postgreSQL would otherwise apply INTERSECT before UNION and EXCEPT.
+        result_so_far = user_ids.subquery()
+        user_ids = select(
+            _SET_OPERATIONS[operator](select(result_so_far.c.user_id), members).subquery().c.user_id
+        )
+
+    is_subgroup_name = (
+        select(SubgroupModel.subgroup_id)
+        .where(SubgroupModel.name == expression.text, SubgroupModel.group_chat_id == group_chat_id)
+        .exists()
+    )
+    user_ids = union(
+        _subgroup_member_ids(group_chat_id, expression.text),
+        user_ids.where(~is_subgroup_name)
     )
 
+    users = (await db.execute(_users_with_ids(user_ids))).scalars().all()
     return users
 
 
-async def find_all_users_in_group_chat(db: Session, telegram_group_chat_id: int) -> list[Type[UserModel]]:
-    users = (
-        db.query(UserModel)
+@track_queries
+async def find_existing_subgroup_names(db: AsyncSession, group_chat_id: int, subgroup_names: Iterable[str]) -> set[str]:
+    """
+    Finds which of the subgroup names exist in a group chat, in a single query.
+    :param db:
+    :param group_chat_id:
+    :param subgroup_names:
+    :return: the names of the subgroups that exist
+    """
+    stmt = (
+        select(SubgroupModel.name)
+        .where(SubgroupModel.group_chat_id == group_chat_id, SubgroupModel.name.in_(set(subgroup_names)))
+    )
+    return set((await db.execute(stmt)).scalars().all())
+
+
+@track_queries
+async def find_all_users_in_group_chat(db: AsyncSession, telegram_group_chat_id: int) -> list[Type[UserModel]]:
+    stmt = (
+        select(UserModel)
         .join(users_group_chats_join_table)
         .join(GroupChatModel)
-        .filter(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
-        .all()
+        .where(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
+        # Rows come back in index order otherwise, so keep mentions in a stable order
+        .order_by(UserModel.telegram_user_id)
     )
+    users = (await db.execute(stmt)).scalars().all()
 
     return users
 
 
-async def find_all_subgroups_in_group_chat(db: Session, telegram_group_chat_id: int) -> list[Type[SubgroupModel]]:
+@track_queries
+async def find_all_subgroups_in_group_chat(db: AsyncSession, telegram_group_chat_id: int) -> list[Type[SubgroupModel]]:
     """
     Finds all subgroups for a group chat
     :param db: SQLAlchemy session
     :param telegram_group_chat_id:
     :return: the list of subgroups
     """
-    result = (
-        db.query(SubgroupModel)
+    stmt = (
+        select(SubgroupModel)
         .join(GroupChatModel)
-        .filter(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
-        .all()
+        .where(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
     )
+    result = (await db.execute(stmt)).scalars().all()
 
     return result
 
 
-async def find_subgroup_by_telegram_group_chat_id_and_subgroup_name(db: Session,
+@track_queries
+async def find_subgroup_by_telegram_group_chat_id_and_subgroup_name(db: AsyncSession,
                                                                     telegram_group_chat_id: int,
                                                                     subgroup_name: str) -> SubgroupModel | None:
-    result = (
-        db.query(SubgroupModel)
+    stmt = (
+        select(SubgroupModel)
         .join(GroupChatModel)
-        .filter(
+        .where(
             GroupChatModel.telegram_group_chat_id == telegram_group_chat_id,
             SubgroupModel.name == subgroup_name
-        ).first()
+        )
     )
+    result = (await db.execute(stmt)).scalars().first()
 
     return result
 
 
-async def find_users_by_usernames(db: Session, usernames: set[str]) -> Sequence[UserModel]:
+@track_queries
+async def find_users_by_usernames(db: AsyncSession, usernames: set[str]) -> Sequence[UserModel]:
     stmt = (
         select(UserModel)
-        .where(UserModel.username.in_(usernames))
+        .where(UserModel.username.in_({normalize_username(username) for username in usernames}))
     )
-    result = db.execute(stmt).scalars().all()
+    result = (await db.execute(stmt)).scalars().all()
     return result
 
 
-async def find_users_by_user_ids(db: Session, user_ids: set[int]) -> Sequence[UserModel]:
+@track_queries
+async def find_users_in_group_chat_by_usernames(db: AsyncSession,
+                                                 telegram_group_chat_id: int,
+                                                 usernames: set[str]) -> Sequence[UserModel]:
+    """
+    Finds the users with the usernames, but only if they're in the group chat.
+    The usernames are found with the username index, then checked against the chat's members.
+    :param db:
+    :param telegram_group_chat_id:
+    :param usernames: in any case
+    :return: the users that were found
+    """
+    stmt = (
+        select(UserModel)
+        .join(users_group_chats_join_table)
+        .join(GroupChatModel)
+        .where(
+            GroupChatModel.telegram_group_chat_id == telegram_group_chat_id,
+            UserModel.username.in_({normalize_username(username) for username in usernames})
+        )
+    )
+    result = (await db.execute(stmt)).scalars().all()
+    return result
+
+
+@track_queries
+async def find_users_in_group_chat_by_telegram_user_ids(db: AsyncSession,
+                                                        telegram_group_chat_id: int,
+                                                        telegram_user_ids: set[int]) -> Sequence[UserModel]:
+    """
+    Finds the users with the telegram user ids, but only if they're in the group chat
+    :param db:
+    :param telegram_group_chat_id:
+    :param telegram_user_ids:
+    :return: the users that were found
+    """
+    stmt = (
+        select(UserModel)
+        .join(users_group_chats_join_table)
+        .join(GroupChatModel)
+        .where(
+            GroupChatModel.telegram_group_chat_id == telegram_group_chat_id,
+            UserModel.telegram_user_id.in_(telegram_user_ids)
+        )
+    )
+    result = (await db.execute(stmt)).scalars().all()
+    return result
+
+
+@track_queries
+async def find_users_by_user_ids(db: AsyncSession, user_ids: set[int]) -> Sequence[UserModel]:
     stmt = (
         select(UserModel)
         .where(UserModel.user_id.in_(user_ids))
     )
-    result = db.execute(stmt).scalars().all()
+    result = (await db.execute(stmt)).scalars().all()
     return result
 
 
-async def find_user_by_user_id(db: Session, user_id: str) -> UserModel | None:
+@track_queries
+async def find_user_by_user_id(db: AsyncSession, user_id: str) -> UserModel | None:
     stmt = (
         select(UserModel)
         .where(UserModel.user_id == user_id)
     )
-    result = db.execute(stmt).scalars().first()
+    result = (await db.execute(stmt)).scalars().first()
     return result
 
 
-async def find_user_by_username(db: Session, username: str) -> UserModel | None:
+@track_queries
+async def find_user_by_username(db: AsyncSession, username: str) -> UserModel | None:
     stmt = (
         select(UserModel)
-        .where(UserModel.username == username)
+        .where(UserModel.username == normalize_username(username))
     )
-    result = db.execute(stmt).scalars().first()
+    result = (await db.execute(stmt)).scalars().first()
     return result
 
 
-async def find_user_by_telegram_user_id(db: Session, telegram_user_id: int) -> UserModel | None:
+@track_queries
+async def find_user_by_telegram_user_id(db: AsyncSession, telegram_user_id: int) -> UserModel | None:
     stmt = (
         select(UserModel)
         .where(UserModel.telegram_user_id == telegram_user_id)
     )
-    result = db.execute(stmt).scalars().first()
+    result = (await db.execute(stmt)).scalars().first()
     return result
 
 
-async def find_group_chat_by_telegram_group_chat_id(db: Session, telegram_group_chat_id: int) -> GroupChatModel | None:
+@track_queries
+async def find_group_chat_by_telegram_group_chat_id(db: AsyncSession, telegram_group_chat_id: int) -> GroupChatModel | None:
     stmt = (
         select(GroupChatModel)
         .where(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
     )
 
-    result = db.execute(stmt).scalars().first()
+    result = (await db.execute(stmt)).scalars().first()
     return result
 
 
+@track_queries
 async def insert_user(
-        db: Session,
+        db: AsyncSession,
         telegram_user_id: int,
         username: str,
         first_name: str,
@@ -137,13 +356,193 @@ async def insert_user(
         last_name=last_name
     )
     db.add(new_user)
-    db.flush()
-    db.refresh(new_user)
+    await db.flush()
+    await db.refresh(new_user)
     return new_user
 
 
+@track_queries
+async def upsert_user(
+        db: AsyncSession,
+        telegram_user_id: int,
+        username: str,
+        first_name: str,
+        last_name: str
+) -> tuple[UserModel, bool]:
+    """
+    Inserts a user, or updates their profile if we already know the telegram user.
+    A known user is only written if their profile changed, in a single INSERT ... ON CONFLICT ... RETURNING statement.
+    :param db:
+    :param telegram_user_id:
+    :param username:
+    :param first_name:
+    :param last_name:
+    :return: the inserted or updated user, and whether the profile of a known user changed
+    """
+    stmt = _upsertable_insert(db, UserModel).values(
+        telegram_user_id=telegram_user_id,
+        username=normalize_username(username),
+        first_name=first_name,
+        last_name=last_name
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserModel.telegram_user_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "updated_at": func.now(),
+        },
+        where=or_(
+            UserModel.username.is_distinct_from(stmt.excluded.username),
+            UserModel.first_name.is_distinct_from(stmt.excluded.first_name),
+            UserModel.last_name.is_distinct_from(stmt.excluded.last_name),
+        )
+    ).returning(UserModel)
+
+    # populate_existing makes sure an already loaded user gets the new profile
+    result = await db.scalars(stmt, execution_options={"populate_existing": True})
+    user = result.one_or_none()
+    if user is not None:
+        # Only updates set updated_at, new users don't have one yet
+        return user, user.updated_at is not None
+
+    # An unchanged user wasn't written, so it isn't returned either
+    user = await db.scalar(select(UserModel).where(UserModel.telegram_user_id == telegram_user_id))
+    return user, False
+
+
+@track_queries
+async def insert_user_into_group_chat(db: AsyncSession, group_chat_id: str, user_id: str) -> bool:
+    """
+    Adds a user to a group chat, if they're not already in it.
+    :param db:
+    :param group_chat_id:
+    :param user_id:
+    :return: True if the user was added, False if they were already in the group chat
+    """
+    stmt = (
+        _upsertable_insert(db, users_group_chats_join_table)
+        .values(group_chat_id=group_chat_id, user_id=user_id)
+        .on_conflict_do_nothing()
+    )
+    result = await db.execute(stmt)
+    return result.rowcount > 0
+
+
+@track_queries
+async def upsert_group_chats(db: AsyncSession, group_chats: Sequence[GroupChatModel]) -> dict[int, str]:
+    """
+    Inserts many group chats in a single statement.
+    Group chats we already know have their name updated.
+    :param db:
+    :param group_chats: group chats that haven't been saved, unique by telegram group chat id
+    :return: a mapping of telegram group chat id to our group chat id
+    """
+    if not group_chats:
+        return {}
+
+    stmt = _upsertable_insert(db, GroupChatModel).values([
+        {
+            "telegram_group_chat_id": group_chat.telegram_group_chat_id,
+            "name": group_chat.name,
+            "description": group_chat.description,
+        }
+        for group_chat in group_chats
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[GroupChatModel.telegram_group_chat_id],
+        set_={"name": stmt.excluded.name}
+    ).returning(GroupChatModel.telegram_group_chat_id, GroupChatModel.group_chat_id)
+
+    result = await db.execute(stmt)
+    return {telegram_group_chat_id: group_chat_id for telegram_group_chat_id, group_chat_id in result}
+
+
+@track_queries
+async def upsert_users(db: AsyncSession, users: Sequence[UserModel]) -> tuple[dict[int, str], set[int]]:
+    """
+    Inserts many users in a single statement.
+    Users we already know have their profile updated, but only if it changed,
+    so an unchanged profile doesn't cost a row write.
+    :param db:
+    :param users: users that haven't been saved, unique by telegram user id
+    :return: a mapping of telegram user id to our user id,
+    and the telegram user ids of the known users whose profile changed
+    """
+    if not users:
+        return {}, set()
+
+    stmt = _upsertable_insert(db, UserModel).values([
+        {
+            "telegram_user_id": user.telegram_user_id,
+            "username": normalize_username(user.username),
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+        }
+        for user in users
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserModel.telegram_user_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "updated_at": func.now(),
+        },
+        where=or_(
+            UserModel.username.is_distinct_from(stmt.excluded.username),
+            UserModel.first_name.is_distinct_from(stmt.excluded.first_name),
+            UserModel.last_name.is_distinct_from(stmt.excluded.last_name),
+        )
+    ).returning(UserModel.telegram_user_id, UserModel.user_id, UserModel.updated_at)
+
+    user_ids = {}
+    changed_telegram_user_ids = set()
+    for telegram_user_id, user_id, updated_at in await db.execute(stmt):
+        user_ids[telegram_user_id] = user_id
+        # Only updates set updated_at, new users don't have one yet
+        if updated_at is not None:
+            changed_telegram_user_ids.add(telegram_user_id)
+
+    # Unchanged users weren't written, so they aren't returned either
+    unchanged_telegram_user_ids = {user.telegram_user_id for user in users} - user_ids.keys()
+    if unchanged_telegram_user_ids:
+        result = await db.execute(
+            select(UserModel.telegram_user_id, UserModel.user_id)
+            .where(UserModel.telegram_user_id.in_(unchanged_telegram_user_ids))
+        )
+        user_ids.update({telegram_user_id: user_id for telegram_user_id, user_id in result})
+
+    return user_ids, changed_telegram_user_ids
+
+
+@track_queries
+async def insert_users_into_group_chats(db: AsyncSession, group_chat_id_user_id_pairs: set[tuple[str, str]]) -> int:
+    """
+    Adds many users to group chats, skipping the ones that are already members.
+    :param db:
+    :param group_chat_id_user_id_pairs: (group_chat_id, user_id) pairs
+    :return: the number of users that were added
+    """
+    if not group_chat_id_user_id_pairs:
+        return 0
+
+    stmt = (
+        _upsertable_insert(db, users_group_chats_join_table)
+        .values([
+            {"group_chat_id": group_chat_id, "user_id": user_id}
+            for group_chat_id, user_id in group_chat_id_user_id_pairs
+        ])
+        .on_conflict_do_nothing()
+    )
+    result = await db.execute(stmt)
+    return result.rowcount
+
+
+@track_queries
 async def insert_subgroup(
-        db: Session,
+        db: AsyncSession,
         subgroup_name: str,
         group_chat_id: str,
         users: Sequence[UserModel]
@@ -154,13 +553,14 @@ async def insert_subgroup(
         users=users
     )
     db.add(new_subgroup)
-    db.flush()
-    db.refresh(new_subgroup)
+    await db.flush()
+    await db.refresh(new_subgroup)
     return new_subgroup
 
 
+@track_queries
 async def delete_subgroup(
-        db: Session,
+        db: AsyncSession,
         telegram_group_chat_id: int,
         subgroup_name: str,
 ) -> bool:
@@ -186,17 +586,27 @@ async def delete_subgroup(
 
     # This is a cascading delete.
     # We'll remove the users in the subgroup prior to deletion
-    subgroup.users.clear()
-    db.flush()
+    users = await subgroup.awaitable_attrs.users
+    users.clear()
+    await db.flush()
+
+    # And take it out of the subgroups it's nested in, along with the ones nested in it
+    await db.execute(
+        delete(subgroups_subgroups_join_table).where(or_(
+            subgroups_subgroups_join_table.c.parent_subgroup_id == subgroup.subgroup_id,
+            subgroups_subgroups_join_table.c.child_subgroup_id == subgroup.subgroup_id
+        ))
+    )
 
     # Delete the subgroup
-    db.delete(subgroup)
-    db.flush()
+    await db.delete(subgroup)
+    await db.flush()
 
     return True
 
 
-async def insert_group_chat(db: Session,
+@track_queries
+async def insert_group_chat(db: AsyncSession,
                             telegram_chat_id: int,
                             telegram_chat_title: str,
                             telegram_chat_description: str
@@ -208,104 +618,370 @@ async def insert_group_chat(db: Session,
     )
 
     db.add(new_group_chat)
-    db.flush()
-    db.refresh(new_group_chat)  # Refresh to get the ID and other generated values
+    await db.flush()
+    await db.refresh(new_group_chat)  # Refresh to get the ID and other generated values
     return new_group_chat
 
 
-async def remove_users_from_subgroup(db: Session, subgroup: SubgroupModel, user_ids: set[int]) -> SubgroupModel:
+async def _find_subgroup_members_and_set_users(
+        db: AsyncSession,
+        subgroup: SubgroupModel,
+        changed_members: CTE | None = None,
+        were_added: bool = True
+) -> SubgroupModel:
     """
-    Removes all users from a subgroup
+    Loads the members of a subgroup straight from the join table,
+    and sets them as the subgroup's users without marking anything as changed.
     :param db:
     :param subgroup:
-    :param user_ids:
-    :return: the subgroup after the users are removed
+    :param changed_members: an INSERT or DELETE ... RETURNING user_id on the join table, that runs in the same
+    statement. It doesn't see the join table as changed by it, so its users are added to, or left out of, the members.
+    :param were_added: whether changed_members added or removed its users
+    :return: the subgroup with its users loaded
     """
+    member_ids = (
+        select(users_subgroups_join_table.c.user_id)
+        .where(users_subgroups_join_table.c.subgroup_id == subgroup.subgroup_id)
+    )
+    is_member = UserModel.user_id.in_(member_ids)
+    if changed_members is not None:
+        is_changed = UserModel.user_id.in_(select(changed_members.c.user_id))
+        is_member = or_(is_member, is_changed) if were_added else and_(is_member, ~is_changed)
 
-    # If we can't find all the users, then it means we have not saved them yet.
-    users_to_be_removed = await find_users_by_user_ids(db, user_ids)
-    # Find all the users who aren't in the group, then add them
+    stmt = (
+        select(UserModel)
+        .where(is_member)
+        .order_by(UserModel.telegram_user_id)
+    )
+    members = (await db.execute(stmt)).scalars().all()
+    set_committed_value(subgroup, "users", members)
 
-    for user in users_to_be_removed:
-        # How Equivalency is Checked:
-        # __eq__ Method:
-        # SQLAlchemy model instances, like those created with the `UserModel`, have an `__eq__` method
-        # that checks equivalency based on the primary key by default.
-        # This means that two instances of `UserModel` are considered equal
-        # if their primary key (`user_id`) values are the same.
-        if user in subgroup.users:
-            subgroup.users.remove(user)
+    return subgroup
 
-    # Commit the transaction
-    db.flush()
-    db.refresh(subgroup)
 
-    return subgroup
+def _supports_data_modifying_ctes(db: AsyncSession) -> bool:
+    """
+    Whether an INSERT or DELETE can run in a WITH clause, so the rows it changed can be selected in the same statement.
+    PostgreSQL can, SQLite (used in tests) can't.
+    :param db:
+    :return:
+    """
+    return db.get_bind().dialect.name == "postgresql"
 
 
-async def add_users_to_subgroup(db: Session, subgroup: SubgroupModel, user_ids: set[int]) -> SubgroupModel:
+@track_queries
+async def remove_users_from_subgroup(db: AsyncSession, subgroup: SubgroupModel, user_ids: set[str]) -> SubgroupModel:
     """
-    Adds all users from a subgroup
+    Removes users from a subgroup with a single DELETE ... RETURNING on the join table,
+    that the remaining members are selected with, in one statement.
+    Users that aren't in the subgroup are ignored.
     :param db:
     :param subgroup:
     :param user_ids:
     :return: the subgroup after the users are removed
     """
+    stmt = (
+        delete(users_subgroups_join_table)
+        .where(
+            users_subgroups_join_table.c.subgroup_id == subgroup.subgroup_id,
+            users_subgroups_join_table.c.user_id.in_(user_ids)
+        )
+        .returning(users_subgroups_join_table.c.user_id)
+    )
+    if _supports_data_modifying_ctes(db):
+        return await _find_subgroup_members_and_set_users(db, subgroup, stmt.cte("removed_members"), were_added=False)
+
+    await db.execute(stmt)
+    return await _find_subgroup_members_and_set_users(db, subgroup)
+
 
-    # If we can't find all the users, then it means we have not saved them yet.
-    users_to_be_added = await find_users_by_user_ids(db, user_ids)
+@track_queries
+async def add_users_to_subgroup(db: AsyncSession, subgroup: SubgroupModel, user_ids: set[str]) -> SubgroupModel:
+    """
+    Adds users to a subgroup with a single INSERT ... SELECT ... RETURNING on the join table,
+    that the members are selected with, in one statement.
+    Users that are already in the subgroup, or that we haven't saved, are ignored.
+    :param db:
+    :param subgroup:
+    :param user_ids:
+    :return: the subgroup after the users are added
+    """
+    users_to_be_added = (
+        select(literal(subgroup.subgroup_id, UuidKey), UserModel.user_id)
+        .where(UserModel.user_id.in_(user_ids))
+    )
+    stmt = (
+        _upsertable_insert(db, users_subgroups_join_table)
+        .from_select(["subgroup_id", "user_id"], users_to_be_added)
+        .on_conflict_do_nothing()
+        .returning(users_subgroups_join_table.c.user_id)
+    )
+    if _supports_data_modifying_ctes(db):
+        return await _find_subgroup_members_and_set_users(db, subgroup, stmt.cte("added_members"), were_added=True)
 
-    # Find all the users who aren't in the group, then add them
-    for user in users_to_be_added:
-        # How Equivalency is Checked:
-        # __eq__ Method:
-        # SQLAlchemy model instances, like those created with the `UserModel`, have an `__eq__` method
-        # that checks equivalency based on the primary key by default.
-        # This means that two instances of `UserModel` are considered equal
-        # if their primary key (`user_id`) values are the same.
-        if user not in subgroup.users:
-            subgroup.users.append(user)
+    await db.execute(stmt)
+    return await _find_subgroup_members_and_set_users(db, subgroup)
 
-    # Commit the transaction
-    db.flush()
-    db.refresh(subgroup)
 
-    return subgroup
+@track_queries
+async def find_subgroups_by_names(
+        db: AsyncSession,
+        telegram_group_chat_id: int,
+        subgroup_names: set[str]
+) -> Sequence[SubgroupModel]:
+    stmt = (
+        select(SubgroupModel)
+        .join(GroupChatModel)
+        .where(
+            GroupChatModel.telegram_group_chat_id == telegram_group_chat_id,
+            SubgroupModel.name.in_(subgroup_names)
+        )
+    )
+    result = (await db.execute(stmt)).scalars().all()
+    return result
 
 
-async def add_user_to_group_chat(db: Session, group_chat: GroupChatModel, current_user: UserModel):
+@track_queries
+async def find_subgroup_nesting_depths(db: AsyncSession, subgroup_id: str, downwards: bool = True) -> dict[str, int]:
+    """
+    Finds the subgroups nested in a subgroup, or the ones containing it, with how deep they are
+    :param db:
+    :param subgroup_id:
+    :param downwards: True for the subgroups it contains, False for the subgroups containing it
+    :return: a mapping of subgroup id to the longest path from the subgroup, which is in it at depth 0
+    """
+    hierarchy = _subgroup_hierarchy(
+        select(SubgroupModel.subgroup_id).where(SubgroupModel.subgroup_id == subgroup_id),
+        downwards
+    )
+    stmt = select(hierarchy.c.subgroup_id, func.max(hierarchy.c.depth)).group_by(hierarchy.c.subgroup_id)
+    result = await db.execute(stmt)
+    return {nested_subgroup_id: depth for nested_subgroup_id, depth in result}
+
+
+@track_queries
+async def nest_subgroups(db: AsyncSession, parent_subgroup_id: str, child_subgroup_ids: set[str]) -> int:
+    """
+    Nests subgroups in a subgroup, skipping the ones that are already nested in it.
+    It's the callers responsibility to check this doesn't create a cycle.
+    :param db:
+    :param parent_subgroup_id:
+    :param child_subgroup_ids:
+    :return: the number of subgroups that were nested
+    """
+    if not child_subgroup_ids:
+        return 0
+
+    stmt = (
+        _upsertable_insert(db, subgroups_subgroups_join_table)
+        .values([
+            {"parent_subgroup_id": parent_subgroup_id, "child_subgroup_id": child_subgroup_id}
+            for child_subgroup_id in child_subgroup_ids
+        ])
+        .on_conflict_do_nothing()
+    )
+    result = await db.execute(stmt)
+    return result.rowcount
+
+
+@track_queries
+async def unnest_subgroups(db: AsyncSession, parent_subgroup_id: str, child_subgroup_ids: set[str]) -> int:
+    """
+    :param db:
+    :param parent_subgroup_id:
+    :param child_subgroup_ids:
+    :return: the number of subgroups that were nested in the parent, and aren't anymore
+    """
+    stmt = delete(subgroups_subgroups_join_table).where(
+        subgroups_subgroups_join_table.c.parent_subgroup_id == parent_subgroup_id,
+        subgroups_subgroups_join_table.c.child_subgroup_id.in_(child_subgroup_ids)
+    )
+    result = await db.execute(stmt)
+    return result.rowcount
+
+
+@track_queries
+async def add_user_to_group_chat(db: AsyncSession,
+                                 group_chat: GroupChatModel,
+                                 current_user: UserModel) -> tuple[UserModel | None, bool]:
     """
     Adds a user to an existing group chat.
+    The user is upserted, so someone we already know from another
+    group chat is reused, and their profile is kept up to date.
     It's the callers responsibility to check
     if the group chat exists
     :param db:
     :param group_chat:
     :param current_user:
-    :return:
+    :return: the user if they were added, None if they were already in the group chat,
+    and whether the stored profile of the user changed
     """
-    added_user = await insert_user(
+    user, profile_changed = await upsert_user(
         db,
         current_user.telegram_user_id,
         current_user.username,
         current_user.first_name,
         current_user.last_name
     )
-    group_chat.users.append(added_user)
-    db.flush()
-    db.refresh(added_user)
-    return added_user
+
+    was_added = await insert_user_into_group_chat(db, group_chat.group_chat_id, user.user_id)
+    if not was_added:
+        return None, profile_changed
+
+    # The join table was written to directly, so any loaded members are stale
+    db.expire(group_chat, ["users"])
+    return user, profile_changed
 
 
-async def remove_user_from_all_sub_groups_in_group_chat(db: Session,
+@track_queries
+async def remove_user_from_all_sub_groups_in_group_chat(db: AsyncSession,
                                                         telegram_group_chat_id: int,
                                                         user: UserModel) -> None:
-    subgroups = await find_all_subgroups_in_group_chat(db, telegram_group_chat_id)
-    for subgroup in subgroups:
-        await remove_users_from_subgroup(db, subgroup, {user.user_id})
+    """
+    Removes a user from every subgroup in a group chat with a single DELETE ... RETURNING.
+    :param db:
+    :param telegram_group_chat_id:
+    :param user:
+    :return:
+    """
+    subgroup_ids_in_group_chat = (
+        select(SubgroupModel.subgroup_id)
+        .join(GroupChatModel)
+        .where(GroupChatModel.telegram_group_chat_id == telegram_group_chat_id)
+    )
+    stmt = (
+        delete(users_subgroups_join_table)
+        .where(
+            users_subgroups_join_table.c.user_id == user.user_id,
+            users_subgroups_join_table.c.subgroup_id.in_(subgroup_ids_in_group_chat)
+        )
+        .returning(users_subgroups_join_table.c.subgroup_id)
+    )
+    removed_from_subgroup_ids = (await db.execute(stmt)).scalars().all()
 
+    # The join table was written to directly, so the members of the subgroups
+    # the user was removed from are stale, if they were already loaded in this session.
+    for subgroup_id in removed_from_subgroup_ids:
+        loaded = db.identity_map.get(db.identity_key(SubgroupModel, subgroup_id))
+        if loaded is not None:
+            db.expire(loaded, ["users"])
 
-async def remove_user_from_group_chat(db: Session, group_chat: GroupChatModel, user_to_be_removed: UserModel):
-    group_chat.users.remove(user_to_be_removed)
-    db.flush()
-    db.refresh(group_chat)
+
+@track_queries
+async def remove_user_from_group_chat(db: AsyncSession, group_chat: GroupChatModel, user_to_be_removed: UserModel):
+    """
+    Removes a user from a group chat with a single DELETE.
+    :param db:
+    :param group_chat:
+    :param user_to_be_removed:
+    :return: the removed user
+    """
+    stmt = (
+        delete(users_group_chats_join_table)
+        .where(
+            users_group_chats_join_table.c.group_chat_id == group_chat.group_chat_id,
+            users_group_chats_join_table.c.user_id == user_to_be_removed.user_id
+        )
+    )
+    await db.execute(stmt)
+
+    # The join table was written to directly, so any loaded members are stale
+    db.expire(group_chat, ["users"])
     return user_to_be_removed
+
+
+@track_queries
+async def claim_update(db: AsyncSession, update_id: int, processed_at: datetime) -> bool:
+    """
+    Records that we're processing an update, unless an instance of the bot already is.
+    :param db:
+    :param update_id: the telegram update id
+    :param processed_at:
+    :return: True if we claimed it, False if it was claimed before
+    """
+    stmt = (
+        _upsertable_insert(db, ProcessedUpdateModel)
+        .values(update_id=update_id, processed_at=processed_at)
+        .on_conflict_do_nothing()
+        .returning(ProcessedUpdateModel.update_id)
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none() is not None
+
+
+@track_queries
+async def release_update(db: AsyncSession, update_id: int) -> None:
+    """
+    Forgets a claim, so the update is processed again if it's delivered again
+    :param db:
+    :param update_id: the telegram update id
+    :return:
+    """
+    await db.execute(delete(ProcessedUpdateModel).where(ProcessedUpdateModel.update_id == update_id))
+
+
+@track_queries
+async def delete_processed_updates_before(db: AsyncSession, before: datetime) -> int:
+    """
+    :param db:
+    :param before: updates processed before this are forgotten
+    :return: how many updates were forgotten
+    """
+    result = await db.execute(delete(ProcessedUpdateModel).where(ProcessedUpdateModel.processed_at < before))
+    return result.rowcount
+
+
+@track_queries
+async def take_over_chat(db: AsyncSession, telegram_chat_id: int, instance_id: str, updated_at: datetime) -> bool:
+    """
+    Records that an instance of the bot is processing the chat, in a single upsert.
+    :param db:
+    :param telegram_chat_id:
+    :param instance_id:
+    :param updated_at:
+    :return: True if the chat is new to us, or another instance processed it last
+    """
+    stmt = _upsertable_insert(db, ChatAffinityModel).values(
+        telegram_chat_id=telegram_chat_id,
+        instance_id=instance_id,
+        updated_at=updated_at
+    )
+    # Nothing is written, and nothing returned, when we processed the chat last
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatAffinityModel.telegram_chat_id],
+        set_={"instance_id": stmt.excluded.instance_id, "updated_at": stmt.excluded.updated_at},
+        where=ChatAffinityModel.instance_id != stmt.excluded.instance_id
+    ).returning(ChatAffinityModel.telegram_chat_id)
+
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none() is not None
+
+
+@track_queries
+async def bump_shared_render_version(db: AsyncSession) -> None:
+    """
+    Bumps the version every instance of the bot checks before trusting its rendered output, in a single upsert
+    :param db:
+    :return:
+    """
+    stmt = _upsertable_insert(db, SharedRenderVersionModel).values(
+        shared_render_version_id=SHARED_RENDER_VERSION_ID,
+        version=1
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SharedRenderVersionModel.shared_render_version_id],
+        set_={"version": SharedRenderVersionModel.version + 1}
+    )
+    await db.execute(stmt)
+
+
+@track_queries
+async def find_shared_render_version(db: AsyncSession) -> int:
+    """
+    :param db:
+    :return: the version, 0 if it was never bumped
+    """
+    stmt = select(SharedRenderVersionModel.version).where(
+        SharedRenderVersionModel.shared_render_version_id == SHARED_RENDER_VERSION_ID
+    )
+    return (await db.scalar(stmt)) or 0
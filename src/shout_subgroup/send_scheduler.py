@@ -0,0 +1,444 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from functools import partial
+from typing import Awaitable, Callable, Any, Coroutine, AsyncIterator
+
+from telegram import Update
+from telegram.error import RetryAfter
+
+from shout_subgroup.exceptions import SendSchedulerStoppedError
+from shout_subgroup.metrics import LatencySamples
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows a bot about 20 messages per minute in the same group,
+# and about 30 messages per second overall.
+DEFAULT_CHAT_RATE = 20 / 60
+DEFAULT_CHAT_BURST = 3
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_GLOBAL_BURST = 30
+# How many times we'll wait out a RetryAfter before giving up on a message
+DEFAULT_MAX_RETRIES = 3
+
+
+class Priority(IntEnum):
+    """
+    Lower values are sent first.
+    """
+    # Replies to commands, someone is waiting on them
+    ACKNOWLEDGEMENT = 0
+    # Shouts can be many messages long, so they shouldn't hold up everything else
+    SHOUT = 1
+
+
+class TokenBucket:
+    """
+    Allows `rate` sends per second, with bursts of up to `capacity` sends.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        :param now: the current time.monotonic()
+        :return: how many seconds until a send is allowed, 0 if it's allowed now
+        """
+        self._refill(now)
+        blocked_for = max(0.0, self._blocked_until - now)
+        refill_for = max(0.0, (1 - self._tokens) / self.rate)
+        return max(blocked_for, refill_for)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def block_until(self, until: float) -> None:
+        """
+        Stops all sends until the time, e.g. when Telegram tells us to back off
+        :param until: a time.monotonic() time
+        :return:
+        """
+        self._blocked_until = max(self._blocked_until, until)
+
+    def is_idle(self, now: float) -> bool:
+        return self.wait_time(now) == 0 and self._tokens >= self.capacity
+
+
+@dataclass
+class SendJob:
+    telegram_chat_id: int
+    send: Callable[[], Awaitable]
+    priority: Priority
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class SendSchedulerMetrics:
+    """
+    Counters and recent send latencies of a SendScheduler.
+    Latency is the time between queueing a message and Telegram accepting it.
+    """
+
+    def __init__(self):
+        self.sent_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.latency_sum = 0.0
+        self.latencies = LatencySamples()
+
+    def record_sent(self, latency: float) -> None:
+        self.sent_count += 1
+        self.latency_sum += latency
+        self.latencies.record(latency)
+
+    def latency_percentile(self, percentile: float) -> float | None:
+        """
+        :param percentile: between 0 and 100
+        :return: the latency in seconds, None if nothing has been sent
+        """
+        return self.latencies.percentile(percentile)
+
+
+class SendScheduler:
+    """
+    Central scheduler for every message the bot sends.
+
+    Messages wait in a queue per priority and chat until both their chat's token bucket
+    and the global token bucket allow a send. Messages to the same chat are
+    sent one at a time and in order (within a priority), while different chats
+    are sent concurrently, taking turns. When Telegram answers with RetryAfter,
+    the chat and every other send are paused for as long as it asks, and the message is retried.
+    """
+
+    def __init__(
+            self,
+            chat_rate: float = DEFAULT_CHAT_RATE,
+            chat_burst: float = DEFAULT_CHAT_BURST,
+            global_rate: float = DEFAULT_GLOBAL_RATE,
+            global_burst: float = DEFAULT_GLOBAL_BURST,
+            max_retries: int = DEFAULT_MAX_RETRIES
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.metrics = SendSchedulerMetrics()
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        # Chats are kept in the order they take turns in, a chat goes to the back once one of its messages is sent
+        self._queues: dict[Priority, dict[int, deque[SendJob]]] = {priority: {} for priority in Priority}
+        self._chats_in_flight: set[int] = set()
+        self._sending: set[asyncio.Task] = set()
+        self._background: set[asyncio.Task] = set()
+        self._wake_up: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+
+    async def send(
+            self,
+            telegram_chat_id: int,
+            send: Callable[[], Awaitable],
+            priority: Priority = Priority.ACKNOWLEDGEMENT
+    ) -> Any:
+        """
+        Queues a send, and waits until it's done.
+        :param telegram_chat_id: the chat the message is sent to
+        :param send: sends the message, e.g. lambda: update.message.reply_text("Hi")
+        :param priority:
+        :return: whatever send returns
+        """
+        return await self.enqueue(telegram_chat_id, send, priority)
+
+    def enqueue(
+            self,
+            telegram_chat_id: int,
+            send: Callable[[], Awaitable],
+            priority: Priority = Priority.ACKNOWLEDGEMENT
+    ) -> asyncio.Future:
+        """
+        Queues a send without waiting for it, so sends queued one after the other keep their order.
+        :param telegram_chat_id: the chat the message is sent to
+        :param send: sends the message, e.g. lambda: update.message.reply_text("Hi")
+        :param priority:
+        :return: a future with whatever send returns, cancelling it takes the send off the queue
+        """
+        self._ensure_worker()
+
+        future = asyncio.get_running_loop().create_future()
+        self._chat_queue(priority, telegram_chat_id).append(SendJob(telegram_chat_id, send, priority, future))
+        self._wake_up.set()
+
+        return future
+
+    def run_in_background(self, sends: Coroutine[Any, Any, Any]) -> asyncio.Task:
+        """
+        Runs a series of sends without the caller waiting for them, e.g. a long shout,
+        so a handler can return as soon as its messages are handed over.
+        The scheduler keeps the task until it's done, and cancels it when stopped.
+        :param sends: a coroutine that sends through this scheduler
+        :return: the task running the sends
+        """
+        task = asyncio.create_task(sends)
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    async def drain(self) -> None:
+        """
+        Waits until every series started with run_in_background is done
+        :return:
+        """
+        while self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def set_rate_limits(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float) -> None:
+        """
+        Replaces the rate limits, e.g. to lift them when sending to a stubbed Bot API.
+        Every bucket starts over full.
+        :param chat_rate: sends per second per chat
+        :param chat_burst:
+        :param global_rate: sends per second over all chats
+        :param global_burst:
+        :return:
+        """
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = {}
+
+    def queue_depth(self, priority: Priority | None = None) -> int:
+        """
+        :param priority: only count messages with this priority
+        :return: how many messages are waiting to be sent
+        """
+        priorities = Priority if priority is None else [priority]
+        return sum(len(queue) for priority in priorities for queue in self._queues[priority].values())
+
+    async def stop(self) -> None:
+        background = list(self._background)
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        # Nothing will send them anymore, so don't leave anyone waiting on them
+        for queues in self._queues.values():
+            for queue in queues.values():
+                for job in queue:
+                    if not job.future.done():
+                        job.future.set_exception(SendSchedulerStoppedError("The send scheduler was stopped"))
+            queues.clear()
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to send in the background", exc_info=task.exception())
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._wake_up = asyncio.Event()
+            self._worker = loop.create_task(self._dispatch_forever())
+
+    async def _dispatch_forever(self) -> None:
+        while True:
+            self._wake_up.clear()
+            wait_time = self._dispatch_ready_jobs()
+
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), timeout=wait_time)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready_jobs(self) -> float | None:
+        """
+        Starts sending every job that is allowed to be sent now.
+        Only the next job of each chat is looked at, so a long shout costs the same as a single message.
+        :return: seconds until the next waiting job can be sent, None if nothing is waiting on a bucket
+        """
+        now = time.monotonic()
+        next_wait_time = None
+
+        for priority in Priority:
+            queues = self._queues[priority]
+
+            for telegram_chat_id in list(queues):
+                # Nothing can be sent until the global bucket allows it
+                global_wait_time = self._global_bucket.wait_time(now)
+                if global_wait_time > 0:
+                    self._forget_idle_chats(now)
+                    return global_wait_time if next_wait_time is None else min(next_wait_time, global_wait_time)
+
+                # One message at a time per chat keeps them in order
+                if telegram_chat_id in self._chats_in_flight:
+                    continue
+
+                queue = queues[telegram_chat_id]
+                # Whoever was waiting on it gave up, e.g. the handler was cancelled
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue:
+                    del queues[telegram_chat_id]
+                    continue
+
+                chat_bucket = self._chat_bucket(telegram_chat_id)
+                wait_time = chat_bucket.wait_time(now)
+                if wait_time > 0:
+                    next_wait_time = wait_time if next_wait_time is None else min(next_wait_time, wait_time)
+                    continue
+
+                chat_bucket.take(now)
+                self._global_bucket.take(now)
+                job = queue.popleft()
+                # The chat takes its next turn after every other chat
+                del queues[telegram_chat_id]
+                if queue:
+                    queues[telegram_chat_id] = queue
+
+                self._chats_in_flight.add(telegram_chat_id)
+                # Keep a reference, otherwise the task could be garbage collected mid send
+                task = asyncio.create_task(self._send(job))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+
+        self._forget_idle_chats(now)
+        return next_wait_time
+
+    async def _send(self, job: SendJob) -> None:
+        try:
+            job.attempts += 1
+            result = await job.send()
+
+        except RetryAfter as ex:
+            if job.attempts > self.max_retries or job.future.done():
+                self.metrics.failed_count += 1
+                if not job.future.done():
+                    job.future.set_exception(ex)
+                return
+
+            logger.warning(f"Flood limit hit for telegram chat id {job.telegram_chat_id}, "
+                           f"retrying in {ex.retry_after} seconds")
+            self.metrics.retry_count += 1
+            # The flood limit Telegram hit may be the global one, so everything waits
+            blocked_until = time.monotonic() + ex.retry_after
+            self._chat_bucket(job.telegram_chat_id).block_until(blocked_until)
+            self._global_bucket.block_until(blocked_until)
+            # Back to the front, so it's still the next message for its chat
+            self._chat_queue(job.priority, job.telegram_chat_id).appendleft(job)
+
+        except Exception as ex:
+            self.metrics.failed_count += 1
+            if not job.future.done():
+                job.future.set_exception(ex)
+
+        else:
+            self.metrics.record_sent(time.monotonic() - job.enqueued_at)
+            if not job.future.done():
+                job.future.set_result(result)
+
+        finally:
+            self._chats_in_flight.discard(job.telegram_chat_id)
+            self._wake_up.set()
+
+    def _chat_queue(self, priority: Priority, telegram_chat_id: int) -> deque[SendJob]:
+        queue = self._queues[priority].get(telegram_chat_id)
+        if queue is None:
+            queue = deque()
+            self._queues[priority][telegram_chat_id] = queue
+
+        return queue
+
+    def _chat_bucket(self, telegram_chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(telegram_chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[telegram_chat_id] = bucket
+
+        return bucket
+
+    def _forget_idle_chats(self, now: float) -> None:
+        # A full bucket is the same as a new one, so we don't need to keep it around
+        if len(self._chat_buckets) < 10_000:
+            return
+
+        waiting_chat_ids = {telegram_chat_id for queues in self._queues.values() for telegram_chat_id in queues}
+        self._chat_buckets = {
+            telegram_chat_id: bucket
+            for telegram_chat_id, bucket in self._chat_buckets.items()
+            if telegram_chat_id in waiting_chat_ids
+            or telegram_chat_id in self._chats_in_flight
+            or not bucket.is_idle(now)
+        }
+
+
+send_scheduler = SendScheduler()
+
+
+class DeferredReplies:
+    """
+    Replies rendered while a transaction is open, to be sent once it's closed.
+    Sending waits on the flood limits, and neither the transaction nor the update should be held up for that long.
+    """
+
+    def __init__(self, update: Update):
+        self.update = update
+        self._replies: list[tuple[str, dict]] = []
+
+    def add(self, text: str, **kwargs) -> None:
+        """
+        :param text:
+        :param kwargs: passed to reply_text, e.g. parse_mode
+        :return:
+        """
+        self._replies.append((text, kwargs))
+
+    def send(self) -> asyncio.Task:
+        """
+        Queues the replies in order, and sends them in the background like a shout,
+        so a chat that hit the flood limits doesn't hold up its next updates.
+        :return: the task waiting on the replies
+        """
+        replies, self._replies = self._replies, []
+        sent = [
+            send_scheduler.enqueue(self.update.effective_chat.id, partial(self.update.message.reply_text, text, **kwargs))
+            for text, kwargs in replies
+        ]
+
+        async def wait_for_replies() -> None:
+            await asyncio.gather(*sent)
+
+        return send_scheduler.run_in_background(wait_for_replies())
+
+
+@asynccontextmanager
+async def defer_replies(update: Update) -> AsyncIterator[DeferredReplies]:
+    """
+    Collects replies, and sends them in the background once the block is done.
+    Nothing is sent if the block raises, e.g. when its transaction couldn't be committed.
+    E.g. async with defer_replies(update) as replies, db_session.begin() as session:
+    :param update:
+    :return: where to add the replies
+    """
+    replies = DeferredReplies(update)
+    yield replies
+    replies.send()
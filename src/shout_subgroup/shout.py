@@ -1,22 +1,36 @@
+import asyncio
 import logging
 from typing import Sequence
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.helpers import escape_markdown
 
-from shout_subgroup.database import get_database
+from shout_subgroup.database import read_only_session, REPLICA_LAG_SECONDS
 from shout_subgroup.exceptions import NotGroupChatError, GroupChatDoesNotExistError
 from shout_subgroup.models import UserModel
-from shout_subgroup.repository import find_all_users_in_group_chat, find_all_users_in_subgroup, \
-    find_group_chat_by_telegram_group_chat_id
+from shout_subgroup.paced_sender import shout_sender
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.repository import find_all_users_in_group_chat, find_all_users_in_subgroup_expression, \
+    find_group_chat_by_telegram_group_chat_id, find_existing_subgroup_names
+from shout_subgroup.subgroup_expression import parse_subgroup_expression
 from shout_subgroup.utils import is_group_chat, create_mention_from_user
 
 logger = logging.getLogger(__name__)
 
+# Telegram rejects messages longer than this, counted in UTF-16 code units
+MAX_MESSAGE_LENGTH = 4096
 
-async def shout_subgroup_members(db: Session, telegram_chat_id: int, subgroup_name: str) -> str:
+
+async def shout_subgroup_members(db: AsyncSession, telegram_chat_id: int, subgroup_name: str) -> list[str]:
+    """
+    Creates the messages mentioning a subgroup's members
+    :param db:
+    :param telegram_chat_id:
+    :param subgroup_name: or an expression combining subgroups, e.g. devs+ops, devs&oncall or devs-managers
+    :return: the messages to send
+    """
     if not await is_group_chat(telegram_chat_id):
         msg = f"Can't shout subgroup members because telegram chat id {telegram_chat_id} is not a group chat."
         logger.info(msg)
@@ -28,34 +42,104 @@ async def shout_subgroup_members(db: Session, telegram_chat_id: int, subgroup_na
         logger.info(msg)
         raise GroupChatDoesNotExistError(msg)
 
-    subgroup_members = await find_all_users_in_subgroup(db, group_chat.group_chat_id, subgroup_name)
+    expression = parse_subgroup_expression(subgroup_name)
+    if expression.operations:
+        # A typo would otherwise shout far more people than meant, e.g. all of devs for devs-managrs
+        existing_names = await find_existing_subgroup_names(
+            db,
+            group_chat.group_chat_id,
+            [expression.text, *expression.subgroup_names]
+        )
+        unknown_names = [name for name in expression.subgroup_names if name not in existing_names]
+        if unknown_names and expression.text not in existing_names:
+            logger.info(f"Attempted to shout '{subgroup_name}' in telegram chat id: {telegram_chat_id}, but subgroups {unknown_names} don't exist.")
+            formatted_names = ", ".join(f"'{name}'" for name in unknown_names)
+            return [f"Didn't shout '{subgroup_name}', these subgroups don't exist: {formatted_names}. "
+                    f"Put names with +, & or - in them in quotes, e.g. devs+\"on-call\"."]
+
+    subgroup_members = await find_all_users_in_subgroup_expression(db, group_chat.group_chat_id, expression)
 
     if not subgroup_members:
         logger.info(f"Attempted to shout subgroup '{subgroup_name}' in telegram chat id: {telegram_chat_id} members, but there are no members.")
-        return f"'{subgroup_name}' subgroup has no members, use /group to add members."
+        return [f"'{subgroup_name}' subgroup has no members, use /group to add members."]
 
-    message = create_message_to_mention_members(subgroup_members)
-    return message
+    messages = create_messages_to_mention_members(subgroup_members)
+    return messages
 
 
-async def shout_all_members(db: Session, telegram_group_chat_id: int) -> str:
+async def shout_all_members(db: AsyncSession, telegram_group_chat_id: int) -> list[str]:
     group_chat_members = await find_all_users_in_group_chat(db, telegram_group_chat_id)
 
     if not group_chat_members:
         logger.info(f"Attempted to shout all members in telegram chat id '{telegram_group_chat_id}' but there are no members.")
-        return "I don't know any members in this chat. If you want me to register someone ask them to send a message."
+        return ["I don't know any members in this chat. If you want me to register someone ask them to send a message."]
+
+    messages = create_messages_to_mention_members(group_chat_members)
+    return messages
 
-    message = create_message_to_mention_members(group_chat_members)
-    return message
+
+def utf16_length(text: str) -> int:
+    """
+    Telegram measures message length in UTF-16 code units,
+    e.g. an emoji in someone's first name counts as 2.
+    :param text:
+    :return: the length of the text in UTF-16 code units
+    """
+    return len(text.encode("utf-16-le")) // 2
 
 
-def create_message_to_mention_members(members: Sequence[UserModel]) -> str:
-    message = ""
+def create_messages_to_mention_members(
+        members: Sequence[UserModel],
+        max_message_length: int = MAX_MESSAGE_LENGTH
+) -> list[str]:
+    """
+    Creates the messages that mention every member.
+    Mentions are packed into as few messages as possible without
+    going over Telegram's length limit, and a mention is never split.
+    :param members:
+    :param max_message_length: in UTF-16 code units, after escaping
+    :return: the messages to send
+    """
+    messages: list[str] = []
+    mentions: list[str] = []
+    length = 0
+
     for member in members:
-        message += create_mention_from_user(member) + " "
+        mention = escape_markdown(create_mention_from_user(member) + " ")
+        mention_length = utf16_length(mention)
+
+        if mentions and length + mention_length > max_message_length:
+            messages.append("".join(mentions))
+            mentions = []
+            length = 0
+
+        mentions.append(mention)
+        length += mention_length
+
+    if mentions:
+        messages.append("".join(mentions))
 
-    message = escape_markdown(message)
-    return message
+    return messages
+
+
+def send_shout(update: Update, messages: Sequence[str]) -> asyncio.Task:
+    """
+    Hands the shout messages to the send scheduler,
+    which paces them in the background to stay under Telegram's flood limits.
+    :param update:
+    :param messages:
+    :return: the task sending the messages
+    """
+    telegram_chat_id = update.effective_chat.id
+
+    async def send_message(message: str):
+        await update.message.reply_text(message, parse_mode='markdown')
+
+    async def log_progress(sent_count: int, total_count: int):
+        if total_count > 1:
+            logger.info(f"Sent shout message {sent_count}/{total_count} to telegram chat id {telegram_chat_id}")
+
+    return shout_sender.start(telegram_chat_id, messages, send_message, on_progress=log_progress)
 
 
 async def shout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -69,19 +153,20 @@ async def shout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     :return:
     """
     args = context.args
-    db_session = get_database()
-
-    with db_session.begin() as session:
-        telegram_chat_id = update.effective_chat.id
-
-        if len(args) == 1:
-            subgroup_name = args[0]
-            message = await shout_subgroup_members(session, telegram_chat_id, subgroup_name)
-
-            await update.message.reply_text(message, parse_mode='markdown')
-            return
-
-        else:
-            message = await shout_all_members(session, telegram_chat_id)
-            await update.message.reply_text(message, parse_mode='markdown')
-            return
+    telegram_chat_id = update.effective_chat.id
+    subgroup_name = args[0] if len(args) == 1 else None
+
+    async def render_shout() -> list[str]:
+        # The replica may not have a change that was just made
+        prefer_primary = rendered_output_cache.changed_within(telegram_chat_id, REPLICA_LAG_SECONDS)
+        async with read_only_session(prefer_primary) as session:
+            if subgroup_name:
+                return await shout_subgroup_members(session, telegram_chat_id, subgroup_name)
+            return await shout_all_members(session, telegram_chat_id)
+
+    # Members rarely change between shouts, so repeated shouts are served without touching the database
+    messages = await rendered_output_cache.get_or_render(telegram_chat_id, ("shout", subgroup_name), render_shout)
+
+    # Big shouts take a while to send. Waiting for them would hold up every other update in the chat,
+    # so the scheduler sends them in the background.
+    send_shout(update, messages)
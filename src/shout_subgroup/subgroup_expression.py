@@ -0,0 +1,61 @@
+import re
+from dataclasses import dataclass
+
+# + is everyone in either subgroup, & is everyone in both, - is everyone in the first but not the second.
+# A subgroup name with one of them in it, e.g. on-call, is quoted: devs+"on-call"
+_TOKEN_PATTERN = re.compile(r'"([^"]*)"|([+&-])|([^"+&-]+)')
+
+
+@dataclass(frozen=True, eq=True)
+class SubgroupExpression:
+    """
+    Subgroups combined left to right, e.g. devs+ops-managers is everyone in devs or ops, except the managers.
+    A plain subgroup name is an expression without operations.
+    """
+    text: str
+    first_subgroup_name: str
+    # (operator, subgroup name) pairs, applied in order
+    operations: tuple[tuple[str, str], ...] = ()
+
+    @property
+    def subgroup_names(self) -> list[str]:
+        """
+        :return: the name of every subgroup in the expression, once, in the order they appear
+        """
+        return list(dict.fromkeys([self.first_subgroup_name, *(name for _, name in self.operations)]))
+
+
+def parse_subgroup_expression(text: str) -> SubgroupExpression:
+    """
+    Parses the argument of /shout, e.g. devs, devs+ops, devs&oncall, devs-managers or devs+"on-call"
+    :param text:
+    :return: the expression, without operations if the text isn't a valid expression, e.g. -devs or devs+
+    """
+    not_an_expression = SubgroupExpression(text, text)
+    subgroup_names: list[str] = []
+    operators: list[str] = []
+    position = 0
+
+    for match in _TOKEN_PATTERN.finditer(text):
+        # Anything the pattern skipped, e.g. a quote that's never closed
+        if match.start() != position:
+            return not_an_expression
+        position = match.end()
+
+        quoted_name, operator, name = match.groups()
+        expects_subgroup_name = len(subgroup_names) == len(operators)
+        if operator is not None:
+            if expects_subgroup_name:
+                return not_an_expression
+            operators.append(operator)
+            continue
+
+        subgroup_name = quoted_name if quoted_name is not None else name
+        if not expects_subgroup_name or not subgroup_name:
+            return not_an_expression
+        subgroup_names.append(subgroup_name)
+
+    if position != len(text) or len(subgroup_names) != len(operators) + 1:
+        return not_an_expression
+
+    return SubgroupExpression(text, subgroup_names[0], tuple(zip(operators, subgroup_names[1:])))
@@ -0,0 +1,130 @@
+import asyncio
+import inspect
+import logging
+import os
+import sys
+from typing import Any, Awaitable
+
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from shout_subgroup.instance_coordination import InstanceCoordinator, load_instance_coordinator
+
+logger = logging.getLogger(__name__)
+
+# Only the oldest update of each chat counts towards the limit,
+# so it's about how many chats can be busy at the same time.
+DEFAULT_MAX_CONCURRENT_UPDATES = 256
+
+# The application already runs every update in its own task. The base class's semaphore
+# would keep a slot for every update waiting on its chat, so it's sized to never make an update wait.
+_UNLIMITED_UPDATES = sys.maxsize
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently,
+    and updates from the same chat one at a time, in the order they arrived.
+
+    Registering members relies on seeing a chat's messages, joins and leaves in order,
+    while a slow shout in one chat shouldn't hold up every other chat.
+    Updates without a chat, e.g. inline queries, are processed right away.
+
+    With a coordinator, several instances of the bot can share the work,
+    see InstanceCoordinator.
+    """
+
+    def __init__(
+            self,
+            max_concurrent_updates: int = DEFAULT_MAX_CONCURRENT_UPDATES,
+            coordinator: InstanceCoordinator | None = None
+    ):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+
+        # The base class sizes its semaphore from max_concurrent_updates,
+        # so it only sees the unlimited size while it's created
+        self._update_limit = _UNLIMITED_UPDATES
+        super().__init__(_UNLIMITED_UPDATES)
+        self._update_limit = max_concurrent_updates
+        # Taken once an update is the oldest of its chat, so waiting on a busy chat doesn't use up a slot
+        self._update_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.coordinator = coordinator
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        # Updates holding or waiting on each chat's lock, the lock is dropped once it's 0
+        self._chat_update_counts: dict[int, int] = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._update_limit
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        telegram_chat_id = _telegram_chat_id(update)
+        if telegram_chat_id is None:
+            async with self._update_slots:
+                await self._process(update, None, coroutine)
+            return
+
+        # asyncio.Lock wakes its waiters first in, first out, and the application
+        # starts processing updates in the order they arrive, so they keep that order.
+        lock = self._chat_locks.setdefault(telegram_chat_id, asyncio.Lock())
+        self._chat_update_counts[telegram_chat_id] = self._chat_update_counts.get(telegram_chat_id, 0) + 1
+        try:
+            async with lock, self._update_slots:
+                await self._process(update, telegram_chat_id, coroutine)
+        finally:
+            self._chat_update_counts[telegram_chat_id] -= 1
+            if self._chat_update_counts[telegram_chat_id] == 0:
+                del self._chat_update_counts[telegram_chat_id]
+                del self._chat_locks[telegram_chat_id]
+
+    async def _process(self, update: object, telegram_chat_id: int | None, coroutine: Awaitable[Any]) -> None:
+        if self.coordinator is None or not isinstance(update, Update):
+            await coroutine
+            return
+
+        is_claimed = False
+        try:
+            async with self.coordinator.chat_lock(telegram_chat_id) as db:
+                is_claimed = await self.coordinator.claim(db, update.update_id, telegram_chat_id)
+                if is_claimed:
+                    try:
+                        await coroutine
+                    except BaseException:
+                        await self.coordinator.release(db, update.update_id)
+                        raise
+        finally:
+            # Another instance processed it, or we couldn't claim it.
+            # Never awaiting the coroutine would log a warning.
+            if not is_claimed and inspect.iscoroutine(coroutine):
+                coroutine.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self.coordinator is not None:
+            await self.coordinator.close()
+
+
+def _telegram_chat_id(update: object) -> int | None:
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+
+    return None
+
+
+def load_update_processor() -> ChatOrderedUpdateProcessor:
+    """
+    Reads how many updates can be processed at the same time from CONCURRENT_UPDATES.
+    Setting it to 1 processes every update one at a time, like the bot used to.
+    With MULTI_INSTANCE, updates are coordinated with the other instances of the bot.
+    The database must be configured first.
+    :return:
+    """
+    load_dotenv()
+
+    max_concurrent_updates = int(os.getenv('CONCURRENT_UPDATES') or DEFAULT_MAX_CONCURRENT_UPDATES)
+    logger.info(f"Processing up to {max_concurrent_updates} updates at the same time")
+    return ChatOrderedUpdateProcessor(max_concurrent_updates, load_instance_coordinator())
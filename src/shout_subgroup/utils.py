@@ -2,12 +2,16 @@ import logging
 import re
 from dataclasses import dataclass
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import User
 
 from shout_subgroup.exceptions import UserDoesNotExistsError
-from shout_subgroup.models import UserModel
-from shout_subgroup.repository import find_user_by_username, find_user_by_telegram_user_id, find_user_by_user_id
+from shout_subgroup.models import UserModel, normalize_username
+from shout_subgroup.repository import (
+    find_user_by_user_id,
+    find_users_in_group_chat_by_usernames,
+    find_users_in_group_chat_by_telegram_user_ids
+)
 
 
 async def are_mentions_valid(usernames: set[str]) -> bool:
@@ -65,37 +69,85 @@ class UserIdMentionMapping:
     user_id: str | None
 
 
-async def get_user_id_from_mention(db: Session, username_or_markdown: str) -> UserIdMentionMapping:
-    user_id = (
-        await _convert_username_to_user_id(db, username_or_markdown[1:].lower())
-        if username_or_markdown[0] == "@"
-        else await _convert_markdown_to_user_id(db, username_or_markdown)
-    )
-
-    return UserIdMentionMapping(user_id=user_id, mention=username_or_markdown)
+async def get_user_id_from_mention(
+        db: AsyncSession,
+        telegram_group_chat_id: int,
+        username_or_markdown: str
+) -> UserIdMentionMapping:
+    """
+    Converts a mention into our user id. Only users in the group chat are found.
+    :param db:
+    :param telegram_group_chat_id:
+    :param username_or_markdown: e.g. @johndoe or [John](tg://user?id=12345678)
+    :return: the mapping, the user id is None if the user wasn't found
+    """
+    mappings = await get_user_ids_from_mentions(db, telegram_group_chat_id, {username_or_markdown})
+    return mappings.pop()
 
 
-async def _convert_username_to_user_id(db: Session, telegram_username: str) -> int | None:
+async def get_user_ids_from_mentions(
+        db: AsyncSession,
+        telegram_group_chat_id: int,
+        usernames_or_markdowns: set[str]
+) -> set[UserIdMentionMapping]:
     """
-    Converts from a telegram username to our user id
+    Converts many mentions into our user ids.
+    Instead of a query per mention, all the usernames are looked up in one query,
+    and all the markdown mentions are looked up in another.
+    Only users in the group chat are found.
     :param db:
-    :param telegram_username:
-    :return: the user id used within our system. None if user doesn't exist
-    """
-    user = await find_user_by_username(db, telegram_username)
-    if not user:
-        return None
+    :param telegram_group_chat_id:
+    :param usernames_or_markdowns: e.g. @johndoe or [John](tg://user?id=12345678)
+    :return: a mapping for every mention, the user id is None if the user wasn't found
+    """
+    usernames_by_mention = {
+        mention: normalize_username(mention[1:])
+        for mention in usernames_or_markdowns
+        if mention[0] == "@"
+    }
+    telegram_user_ids_by_mention = {
+        mention: _parse_telegram_user_id_from_markdown(mention)
+        for mention in usernames_or_markdowns
+        if mention[0] != "@"
+    }
 
-    return user.user_id
+    user_ids_by_username: dict[str, str] = {}
+    if usernames_by_mention:
+        users = await find_users_in_group_chat_by_usernames(
+            db,
+            telegram_group_chat_id,
+            set(usernames_by_mention.values())
+        )
+        user_ids_by_username = {user.username: user.user_id for user in users}
+
+    user_ids_by_telegram_user_id: dict[int, str] = {}
+    telegram_user_ids = {
+        telegram_user_id
+        for telegram_user_id in telegram_user_ids_by_mention.values()
+        if telegram_user_id is not None
+    }
+    if telegram_user_ids:
+        users = await find_users_in_group_chat_by_telegram_user_ids(db, telegram_group_chat_id, telegram_user_ids)
+        user_ids_by_telegram_user_id = {user.telegram_user_id: user.user_id for user in users}
 
+    username_mappings = {
+        UserIdMentionMapping(mention=mention, user_id=user_ids_by_username.get(username))
+        for mention, username in usernames_by_mention.items()
+    }
+    markdown_mappings = {
+        UserIdMentionMapping(mention=mention, user_id=user_ids_by_telegram_user_id.get(telegram_user_id))
+        for mention, telegram_user_id in telegram_user_ids_by_mention.items()
+    }
+
+    return username_mappings | markdown_mappings
 
-async def _convert_markdown_to_user_id(db: Session, telegram_markdown_v2: str) -> int | None:
+
+def _parse_telegram_user_id_from_markdown(telegram_markdown_v2: str) -> int | None:
     """
-    Convert from telegram markdown into our user id.
-    E.g. [John](tg://user?id=12345678)
-    :param db:
+    Pulls the telegram user id out of telegram markdown.
+    E.g. [John](tg://user?id=12345678) -> 12345678
     :param telegram_markdown_v2:
-    :return: the user id used within our system
+    :return: the telegram user id, None if it's not a user mention
     """
 
     # Regular expression to match the first name and user ID
@@ -105,13 +157,7 @@ async def _convert_markdown_to_user_id(db: Session, telegram_markdown_v2: str) -
     if not match:
         return None
 
-    telegram_user_id = match.group('telegram_user_id')
-    user = await find_user_by_telegram_user_id(db, telegram_user_id)
-
-    if not user:
-        return None
-
-    return user.user_id
+    return int(match.group('telegram_user_id'))
 
 
 async def get_mention_from_user_id_mention_mappings(
@@ -131,7 +177,7 @@ async def get_mention_from_user_id_mention_mappings(
     return None
 
 
-async def create_mention_from_user_id(db: Session, user_id: str) -> str:
+async def create_mention_from_user_id(db: AsyncSession, user_id: str) -> str:
     """
     Creates the mention reply text for a user id
     :param db:
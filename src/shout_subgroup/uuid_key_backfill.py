@@ -0,0 +1,144 @@
+"""
+Moves the primary and foreign keys from UUID strings to native postgreSQL UUID columns.
+
+The migration runs in two revisions, so big tables can be backfilled without
+holding a lock on them:
+1. a1c93e5f0b27 adds a nullable `<column>_uuid` shadow column next to every key column,
+   and triggers that fill them for every new or updated row.
+2. This script fills the shadow columns of existing rows in small batches,
+   committing after each one. It can be stopped and rerun at any time.
+3. 6d0f2b8c4e19 backfills whatever is left, then swaps the shadow columns in.
+
+Small databases can skip the script, `alembic upgrade head` backfills everything in one go.
+
+Usage:
+    python -m shout_subgroup.uuid_key_backfill --batch-size 5000
+"""
+import argparse
+import logging
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import Connection, create_engine, text
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 5_000
+
+# (table, key columns) of every table, with the referenced tables first
+KEY_COLUMNS = [
+    ('group_chats', ('group_chat_id',)),
+    ('users', ('user_id',)),
+    ('subgroups', ('subgroup_id', 'group_chat_id')),
+    ('users_group_chats_join_table', ('group_chat_id', 'user_id')),
+    ('users_subgroups_join_table', ('subgroup_id', 'user_id')),
+]
+
+
+def shadow_column(column: str) -> str:
+    return f'{column}_uuid'
+
+
+def _fill_trigger_name(table: str) -> str:
+    return f'{table}_fill_uuid_keys'
+
+
+def create_fill_triggers(connection: Connection) -> None:
+    """
+    Fills the shadow columns of every row that is inserted or updated from now on,
+    so the backfill never has to come back for them
+    :param connection:
+    :return:
+    """
+    for table, columns in KEY_COLUMNS:
+        name = _fill_trigger_name(table)
+        assignments = " ".join(f"NEW.{shadow_column(column)} := NEW.{column}::uuid;" for column in columns)
+        connection.execute(text(
+            f"CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$ "
+            f"BEGIN {assignments} RETURN NEW; END "
+            f"$$ LANGUAGE plpgsql"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER {name} BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION {name}()"
+        ))
+
+
+def drop_fill_triggers(connection: Connection) -> None:
+    for table, _ in KEY_COLUMNS:
+        name = _fill_trigger_name(table)
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {name} ON {table}"))
+        connection.execute(text(f"DROP FUNCTION IF EXISTS {name}()"))
+
+
+def backfill_batch(connection: Connection, table: str, columns: tuple[str, ...], batch_size: int) -> int:
+    """
+    Fills the shadow columns of up to batch_size rows that don't have them yet
+    :param connection:
+    :param table:
+    :param columns: the key columns of the table
+    :param batch_size:
+    :return: how many rows were filled, 0 once the table is done
+    """
+    not_filled = " OR ".join(f"{shadow_column(column)} IS NULL" for column in columns)
+    assignments = ", ".join(f"{shadow_column(column)} = {column}::uuid" for column in columns)
+    result = connection.execute(
+        text(
+            f"UPDATE {table} SET {assignments} "
+            f"WHERE ctid = ANY(ARRAY(SELECT ctid FROM {table} WHERE {not_filled} LIMIT :batch_size))"
+        ),
+        {"batch_size": batch_size}
+    )
+    return result.rowcount
+
+
+def backfill_uuid_keys(connection: Connection, batch_size: int = DEFAULT_BATCH_SIZE, commit: bool = True) -> dict[str, int]:
+    """
+    Fills the shadow columns of every table
+    :param connection:
+    :param batch_size: rows updated per statement
+    :param commit: commit after every batch, so no lock is held for long.
+    Migrations pass False, they run in a single transaction.
+    :return: rows filled per table
+    """
+    filled = {}
+    for table, columns in KEY_COLUMNS:
+        filled[table] = 0
+        while True:
+            row_count = backfill_batch(connection, table, columns, batch_size)
+            if commit:
+                connection.commit()
+            if row_count == 0:
+                break
+
+            filled[table] += row_count
+            logger.info(f"Backfilled {filled[table]} rows of {table}")
+
+    return filled
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="rows updated per transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+
+    POSTGRES_USER = os.getenv('POSTGRES_USER')
+    POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+    POSTGRES_HOST = os.getenv('POSTGRES_CONTAINER')
+    POSTGRES_DB = os.getenv('POSTGRES_DB')
+
+    engine = create_engine(f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:5432/{POSTGRES_DB}")
+    try:
+        with engine.connect() as connection:
+            filled = backfill_uuid_keys(connection, args.batch_size)
+    finally:
+        engine.dispose()
+
+    logger.info(f"Backfill done, rows filled per table: {filled}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+from telegram.ext import Application
+
+from shout_subgroup.exceptions import InvalidWebhookConfigError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WEBHOOK_LISTEN = "0.0.0.0"
+# The Dockerfile exposes port 80
+DEFAULT_WEBHOOK_PORT = 80
+DEFAULT_WEBHOOK_PATH = "telegram"
+# Telegram only accepts 1-256 characters of A-Z, a-z, 0-9, _ and -
+SECRET_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+
+@dataclass(frozen=True)
+class WebhookConfig:
+    # The public https url Telegram sends updates to, without the path
+    url: str
+    # Telegram sends this in the X-Telegram-Bot-Api-Secret-Token header,
+    # any request without it is rejected
+    secret_token: str
+    listen: str = DEFAULT_WEBHOOK_LISTEN
+    port: int = DEFAULT_WEBHOOK_PORT
+    url_path: str = DEFAULT_WEBHOOK_PATH
+
+    @property
+    def webhook_url(self) -> str:
+        return f"{self.url.rstrip('/')}/{self.url_path}"
+
+
+def load_webhook_config() -> WebhookConfig | None:
+    """
+    Reads the webhook settings from the environment.
+    Webhook mode is turned on by setting WEBHOOK_URL, otherwise the bot polls.
+    :return: the webhook config, None if the bot should poll instead
+    """
+    load_dotenv()
+
+    url = os.getenv('WEBHOOK_URL')
+    if not url:
+        return None
+
+    if not url.startswith("https://"):
+        raise InvalidWebhookConfigError("WEBHOOK_URL must be an https url, Telegram won't send updates to anything else.")
+
+    secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+    if not secret_token or not SECRET_TOKEN_PATTERN.match(secret_token):
+        raise InvalidWebhookConfigError(
+            "WEBHOOK_SECRET_TOKEN must be set to 1-256 characters of letters, numbers, '_' or '-'."
+        )
+
+    port = os.getenv('WEBHOOK_PORT') or str(DEFAULT_WEBHOOK_PORT)
+    if not port.isdigit():
+        raise InvalidWebhookConfigError(f"WEBHOOK_PORT must be a number, got '{port}'.")
+
+    return WebhookConfig(
+        url=url,
+        secret_token=secret_token,
+        listen=os.getenv('WEBHOOK_LISTEN') or DEFAULT_WEBHOOK_LISTEN,
+        port=int(port),
+        url_path=(os.getenv('WEBHOOK_PATH') or DEFAULT_WEBHOOK_PATH).strip('/')
+    )
+
+
+def run_application(app: Application, webhook_config: WebhookConfig | None) -> None:
+    """
+    Runs the application until it's stopped, either with a webhook or by polling.
+    Both feed updates into the same handlers.
+    :param app:
+    :param webhook_config: None to poll
+    :return:
+    """
+    if webhook_config is None:
+        logger.info("Starting application with long polling")
+        app.run_polling()
+        return
+
+    logger.info(f"Starting application with a webhook at {webhook_config.webhook_url}, "
+                f"listening on {webhook_config.listen}:{webhook_config.port}")
+
+    # Every replica registers the same url on startup, so it doesn't
+    # matter which one a load balancer sends an update to.
+    app.run_webhook(
+        listen=webhook_config.listen,
+        port=webhook_config.port,
+        url_path=webhook_config.url_path,
+        webhook_url=webhook_config.webhook_url,
+        secret_token=webhook_config.secret_token
+    )
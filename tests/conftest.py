@@ -1,25 +1,38 @@
-import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
 
+from shout_subgroup.membership_cache import chat_membership_cache
 from shout_subgroup.models import Base
+from shout_subgroup.profile_fingerprints import profile_fingerprint_cache
+from shout_subgroup.render_cache import rendered_output_cache
 
-# Create an SQLite in-memory database and a session factory
-engine = create_engine('sqlite:///:memory:', echo=True)
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
+@pytest_asyncio.fixture
+async def db():
+    # Create an SQLite in-memory database and a session factory.
+    # The StaticPool makes every connection share the same in-memory database.
+    engine = create_async_engine('sqlite+aiosqlite:///:memory:', echo=True, poolclass=StaticPool)
+    SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
-@pytest.fixture
-def db():
     # Create tables
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    # Each test gets a fresh database, so the cache has to start fresh too
+    chat_membership_cache.clear()
+    profile_fingerprint_cache.clear()
+    rendered_output_cache.clear()
 
     session = SessionLocal()
-    
+
     try:
         yield session
     finally:
         # Close the session and drop all tables
-        session.close()
-    
-    Base.metadata.drop_all(bind=engine)
+        await session.close()
+
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+
+    await engine.dispose()
@@ -0,0 +1,57 @@
+import json
+import time
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Shout Bot", "username": "shout_subgroup_bot"}
+
+
+class FakeBotApiRequest(BaseRequest):
+    """
+    Stands in for the network layer of a telegram Bot, so tests can send
+    messages without reaching the Bot API.
+    Every sendMessage is recorded, and the first `flood_count` of them
+    are answered with a 429 like Telegram's flood control does.
+    """
+
+    def __init__(self, flood_count: int = 0, retry_after: int = 1):
+        self.flood_count = flood_count
+        self.retry_after = retry_after
+        self.sent_messages: list[dict] = []
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None, **kwargs):
+        if url.endswith("/getMe"):
+            return 200, self._ok(BOT_USER)
+
+        if url.endswith("/sendMessage"):
+            if self.flood_count > 0:
+                self.flood_count -= 1
+                return 429, json.dumps({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }).encode()
+
+            parameters = request_data.parameters
+            self.sent_messages.append(parameters)
+            self._message_id += 1
+            return 200, self._ok({
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": parameters["chat_id"], "type": "group"},
+                "text": parameters["text"]
+            })
+
+        return 404, json.dumps({"ok": False, "error_code": 404, "description": "Not Found"}).encode()
+
+    @staticmethod
+    def _ok(result: dict) -> bytes:
+        return json.dumps({"ok": True, "result": result}).encode()
@@ -1,7 +1,7 @@
 from unittest.mock import Mock
 
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import InvalidSubGroupNameError
 from shout_subgroup.modify_subgroup import create_subgroup
@@ -16,13 +16,13 @@ class MockTelegramChat:
 
 
 @pytest.mark.asyncio
-async def test_create_subgroup(db: Session):
+async def test_create_subgroup(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # And: We have the subgroup information
     telegram_chat = Mock()
@@ -41,18 +41,18 @@ async def test_create_subgroup(db: Session):
     assert subgroup.name == subgroup_name
     assert subgroup.group_chat_id is not None
 
-    assert len(subgroup.users) == 2
-    assert set([user.user_id for user in subgroup.users]) == user_ids
+    assert len(await subgroup.awaitable_attrs.users) == 2
+    assert set([user.user_id for user in await subgroup.awaitable_attrs.users]) == user_ids
 
 
 @pytest.mark.asyncio
-async def test_can_not_create_subgroup_with_mentions_in_the_name(db: Session):
+async def test_can_not_create_subgroup_with_mentions_in_the_name(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # And: We have the subgroup information
     telegram_chat = Mock()
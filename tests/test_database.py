@@ -0,0 +1,161 @@
+import pytest
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+
+from shout_subgroup import database
+from shout_subgroup.database import load_pool_config, PoolConfig, create_engine, get_pool_status, read_only_session, \
+    use_engines
+
+DATABASE_ENVIRONMENT_VARIABLES = [
+    'DATABASE_POOL_SIZE', 'DATABASE_MAX_OVERFLOW', 'DATABASE_POOL_TIMEOUT',
+    'DATABASE_POOL_RECYCLE', 'DATABASE_POOL_PRE_PING', 'DATABASE_ECHO'
+]
+
+
+@pytest.fixture(autouse=True)
+def clear_database_environment(monkeypatch):
+    for name in DATABASE_ENVIRONMENT_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_load_pool_config_defaults():
+    # When: Nothing is configured
+    pool_config = load_pool_config()
+
+    # Then: Statements aren't logged, and connections are checked before they're used
+    assert pool_config == PoolConfig()
+    assert pool_config.echo is False
+    assert pool_config.pool_pre_ping is True
+
+
+def test_load_pool_config(monkeypatch):
+    # Given: The pool is configured
+    monkeypatch.setenv('DATABASE_POOL_SIZE', '20')
+    monkeypatch.setenv('DATABASE_MAX_OVERFLOW', '5')
+    monkeypatch.setenv('DATABASE_POOL_TIMEOUT', '2.5')
+    monkeypatch.setenv('DATABASE_POOL_RECYCLE', '600')
+    monkeypatch.setenv('DATABASE_POOL_PRE_PING', 'false')
+    monkeypatch.setenv('DATABASE_ECHO', 'true')
+
+    # When: We load the config
+    pool_config = load_pool_config()
+
+    # Then: It's used
+    assert pool_config == PoolConfig(
+        pool_size=20,
+        max_overflow=5,
+        pool_timeout=2.5,
+        pool_recycle=600,
+        pool_pre_ping=False,
+        echo=True
+    )
+
+
+@pytest.mark.asyncio
+async def test_pool_status_shows_starvation(tmp_path):
+    # Given: A pool with a single connection
+    engine = create_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+        PoolConfig(pool_size=1, max_overflow=0, pool_timeout=0.1)
+    )
+
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+            # When: It's in use
+            status = get_pool_status(engine)
+
+            # Then: We can see it
+            assert status["size"] == 1
+            assert status["in_use"] == 1
+            assert status["checkout_count"] == 1
+            assert status["checkout_wait_p50"] is not None
+            assert status["checkout_wait_sum"] >= 0
+
+            # And: Anyone else waiting for a connection times out, and is counted
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+
+        status = get_pool_status(engine)
+        assert status["in_use"] == 0
+        assert status["idle"] == 1
+        assert status["checkout_timeout_count"] == 1
+    finally:
+        await engine.dispose()
+
+
+async def create_test_engine(path, name: str) -> AsyncEngine:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as connection:
+        await connection.execute(text("CREATE TABLE IF NOT EXISTS whoami (name TEXT)"))
+        await connection.execute(text("INSERT INTO whoami VALUES (:name)"), {"name": name})
+    return engine
+
+
+async def whoami(prefer_primary: bool = False) -> str:
+    async with read_only_session(prefer_primary) as session:
+        return (await session.execute(text("SELECT name FROM whoami"))).scalar_one()
+
+
+@pytest.fixture
+def restore_sessions(monkeypatch):
+    for name in ("Session", "ReadOnlySession", "_replica_failed_at"):
+        monkeypatch.setattr(database, name, getattr(database, name))
+
+
+@pytest.mark.asyncio
+async def test_read_only_session_reads_from_replica(tmp_path, restore_sessions):
+    # Given: A primary and a replica
+    primary = await create_test_engine(tmp_path / "primary.db", "primary")
+    replica = await create_test_engine(tmp_path / "replica.db", "replica")
+    use_engines(primary, replica)
+
+    try:
+        # When: We read
+        # Then: It's from the replica, unless we need to read from the primary
+        assert await whoami() == "replica"
+        assert await whoami(prefer_primary=True) == "primary"
+
+        # And: Writes still go to the primary
+        async with database.get_database().begin() as session:
+            assert (await session.execute(text("SELECT name FROM whoami"))).scalar_one() == "primary"
+    finally:
+        await primary.dispose()
+        await replica.dispose()
+
+
+@pytest.mark.asyncio
+async def test_read_only_session_without_replica_reads_from_primary(tmp_path, restore_sessions):
+    # Given: Only a primary
+    primary = await create_test_engine(tmp_path / "primary.db", "primary")
+    use_engines(primary)
+
+    try:
+        # When: We read
+        # Then: It's from the primary
+        assert await whoami() == "primary"
+    finally:
+        await primary.dispose()
+
+
+@pytest.mark.asyncio
+async def test_read_only_session_falls_back_to_primary(tmp_path, restore_sessions):
+    # Given: A replica that can't be reached
+    primary = await create_test_engine(tmp_path / "primary.db", "primary")
+    replica = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    use_engines(primary, replica)
+
+    try:
+        # When: We read
+        # Then: It's from the primary
+        assert await whoami() == "primary"
+
+        # And: The replica isn't tried again for a while
+        assert database._replica_failed_at is not None
+        assert not database._is_replica_available()
+        assert await whoami() == "primary"
+    finally:
+        await primary.dispose()
+        await replica.dispose()
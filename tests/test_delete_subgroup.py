@@ -1,5 +1,5 @@
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.delete_subgroup import remove_subgroup
 from shout_subgroup.exceptions import SubGroupDoesNotExistsError, NotGroupChatError
@@ -8,15 +8,15 @@ from test_helpers import create_test_user, create_test_group_chat, create_test_s
 
 
 @pytest.mark.asyncio
-async def test_remove_subgroup(db: Session):
+async def test_remove_subgroup(db: AsyncSession):
     # Given: A group chat and subgroup exist
     telegram_chat_id = -123456789
     subgroup_name = "Archery"
 
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    group_chat = create_test_group_chat(db, telegram_chat_id, "Group Chat", [john, jane])
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [john, jane])
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    group_chat = await create_test_group_chat(db, telegram_chat_id, "Group Chat", [john, jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [john, jane])
 
     # When: The subgroup is removed
     result = await remove_subgroup(db, telegram_chat_id, subgroup_name)
@@ -30,14 +30,14 @@ async def test_remove_subgroup(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_remove_subgroup_that_does_not_exist(db: Session):
+async def test_remove_subgroup_that_does_not_exist(db: AsyncSession):
     # Given: A group chat exists but the subgroup does not
     telegram_chat_id = -123456789
     subgroup_name = "Archery"
 
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    create_test_group_chat(db, telegram_chat_id, "Group Chat", [john, jane])
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    await create_test_group_chat(db, telegram_chat_id, "Group Chat", [john, jane])
 
     # When: Attempting to remove a non-existent subgroup
     with pytest.raises(SubGroupDoesNotExistsError):
@@ -45,12 +45,12 @@ async def test_remove_subgroup_that_does_not_exist(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_remove_subgroup_that_not_in_a_group_chat(db: Session):
+async def test_remove_subgroup_that_not_in_a_group_chat(db: AsyncSession):
     # Given: The chat ID is not a group chat
     telegram_chat_id = 123  # Assume positive IDs are not group chats
     subgroup_name = "Archery"
 
-    create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
 
     # When: Attempting to remove a subgroup from a non-group chat
     with pytest.raises(NotGroupChatError):
@@ -1,27 +1,32 @@
 from unittest.mock import Mock
 
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import NotGroupChatError
-from shout_subgroup.group_chat_listener import add_user_to_group_chat, remove_user_from_group_chat
+from shout_subgroup.group_chat_listener import add_user_to_group_chat, remove_user_from_group_chat, listen_for_messages_handler
+from shout_subgroup.membership_cache import chat_membership_cache
 from shout_subgroup.models import UserModel
-from shout_subgroup.repository import find_group_chat_by_telegram_group_chat_id
+from shout_subgroup.profile_fingerprints import profile_fingerprint_cache
+from shout_subgroup.registration_queue import registration_queue
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.repository import find_group_chat_by_telegram_group_chat_id, find_shared_render_version
 from test_helpers import create_test_user, create_test_group_chat, create_test_subgroup
 
 
 @pytest.mark.asyncio
-async def test_add_user_if_not_in_group_chat(db: Session):
+async def test_add_user_if_not_in_group_chat(db: AsyncSession):
     # Given: A group chat exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
     telegram_group_chat_description = "Test Chatting"
 
     initial_group_chat_users = [john, jane]
-    group_chat = create_test_group_chat(
+    group_chat = await create_test_group_chat(
         db,
         telegram_group_chat_id,
         telegram_group_chat_name,
@@ -46,11 +51,11 @@ async def test_add_user_if_not_in_group_chat(db: Session):
     added_user = await add_user_to_group_chat(db, telegram_chat, current_user)
 
     # Then: The user should be added to the group chat
-    assert len(group_chat.users) == 3
+    assert len(await group_chat.awaitable_attrs.users) == 3
 
     assert added_user.user_id is not None
 
-    actual_user = next((user for user in group_chat.users if user.telegram_user_id == current_user.telegram_user_id),
+    actual_user = next((user for user in await group_chat.awaitable_attrs.users if user.telegram_user_id == current_user.telegram_user_id),
                        None)
     assert actual_user.telegram_user_id == added_user.telegram_user_id
     assert actual_user.username == added_user.username
@@ -59,17 +64,17 @@ async def test_add_user_if_not_in_group_chat(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_ignore_user_if_already_in_group_chat(db: Session):
+async def test_ignore_user_if_already_in_group_chat(db: AsyncSession):
     # Given: A group chat exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
     telegram_group_chat_description = "Test Chatting"
 
     initial_group_chat_users = [john, jane]
-    create_test_group_chat(
+    await create_test_group_chat(
         db,
         telegram_group_chat_id,
         telegram_group_chat_name,
@@ -93,7 +98,7 @@ async def test_ignore_user_if_already_in_group_chat(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_create_group_chat_and_add_user_if_both_non_existent(db: Session):
+async def test_create_group_chat_and_add_user_if_both_non_existent(db: AsyncSession):
     # Given: A group chat doesn't exists
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
@@ -126,7 +131,7 @@ async def test_create_group_chat_and_add_user_if_both_non_existent(db: Session):
     actual_user = next(
         (
             user
-            for user in created_group_chat.users
+            for user in await created_group_chat.awaitable_attrs.users
             if user.telegram_user_id == current_user.telegram_user_id
         ), None
     )
@@ -137,16 +142,16 @@ async def test_create_group_chat_and_add_user_if_both_non_existent(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_add_user_to_group_throws_exception_for_non_group_chat(db: Session):
+async def test_add_user_to_group_throws_exception_for_non_group_chat(db: AsyncSession):
     # Given: A group chat exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
 
     initial_group_chat_users = [john, jane]
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
 
     # But: The user is not in the group chat
     current_user = UserModel(
@@ -171,28 +176,28 @@ async def test_add_user_to_group_throws_exception_for_non_group_chat(db: Session
     assert str(not_telegram_group_chat_id) in ex.value.message
 
     # And: Other group chats are not impacted
-    actual_user = next((user for user in group_chat.users if user.username == current_user.username), None)
+    actual_user = next((user for user in await group_chat.awaitable_attrs.users if user.username == current_user.username), None)
     assert actual_user is None
 
 
 @pytest.mark.asyncio
-async def test_remove_user_from_group_chat(db: Session):
+async def test_remove_user_from_group_chat(db: AsyncSession):
     # Given: A group chat exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
     telegram_group_chat_description = "Test Chatting"
 
     initial_group_chat_users = [john, jane]
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
 
     # And: There are subgroups with the user in it
     subgroup_names = ["Archery", "Bowling", "Cricket"]
     user_to_remove = john
     created_subgroups = [
-        create_test_subgroup(db, group_chat.group_chat_id, name, [user_to_remove, jane])
+        await create_test_subgroup(db, group_chat.group_chat_id, name, [user_to_remove, jane])
         for name in subgroup_names
     ]
 
@@ -206,18 +211,18 @@ async def test_remove_user_from_group_chat(db: Session):
 
     # Then: The user is removed from all subgroups
     for subgroup in created_subgroups:
-        assert removed_user not in subgroup.users
+        assert removed_user not in await subgroup.awaitable_attrs.users
 
     # And: The user is removed from the group chat
     assert removed_user.user_id == user_to_remove.user_id
-    assert removed_user not in group_chat.users
+    assert removed_user not in await group_chat.awaitable_attrs.users
 
 
 @pytest.mark.asyncio
-async def test_remove_user_from_group_chat_if_not_in_group_chat(db: Session):
+async def test_remove_user_from_group_chat_if_not_in_group_chat(db: AsyncSession):
     # Given: A group chat exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     telegram_group_chat_name = "Group Chat"
@@ -227,7 +232,7 @@ async def test_remove_user_from_group_chat_if_not_in_group_chat(db: Session):
     telegram_chat.description = "Testing Chat"
 
     initial_group_chat_users = [john, jane]
-    create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
+    await create_test_group_chat(db, telegram_group_chat_id, telegram_group_chat_name, initial_group_chat_users)
 
     # And: A user leaves the group chat before they were registered by the bot and added to the group chat
     user_who_was_not_registered = UserModel(
@@ -245,7 +250,7 @@ async def test_remove_user_from_group_chat_if_not_in_group_chat(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_remove_user_from_group_chat_throws_exception_for_non_group_chat(db: Session):
+async def test_remove_user_from_group_chat_throws_exception_for_non_group_chat(db: AsyncSession):
     # Given: A individual chat exists
     individual_chat_id = 12345
     telegram_chat = Mock()
@@ -267,3 +272,250 @@ async def test_remove_user_from_group_chat_throws_exception_for_non_group_chat(d
 
     # Then: An exception is thrown
     assert ex.value.message == f"Can't remove user from chat because telegram chat id {telegram_chat.id} is not a group chat."
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_chat_skips_database_for_cached_user(db: AsyncSession):
+    # Given: A group chat exists with a registered user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # And: The listener has already seen them
+    await add_user_to_group_chat(db, telegram_chat, john)
+    await db.commit()
+    assert chat_membership_cache.contains(telegram_group_chat_id, john.telegram_user_id)
+
+    # When: They send another message
+    db_without_access = Mock()
+    added_user = await add_user_to_group_chat(db_without_access, telegram_chat, john)
+
+    # Then: The database isn't touched
+    assert added_user is None
+    assert not db_without_access.method_calls
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_chat_only_caches_committed_members(db: AsyncSession):
+    # Given: A group chat exists
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # When: A user is added, but the transaction is rolled back
+    betty = UserModel(telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    await add_user_to_group_chat(db, telegram_chat, betty)
+    assert not chat_membership_cache.contains(telegram_group_chat_id, betty.telegram_user_id)
+    await db.rollback()
+
+    # Then: The cache doesn't vouch for them
+    assert not chat_membership_cache.contains(telegram_group_chat_id, betty.telegram_user_id)
+
+    # When: They're added again, and it's committed
+    await add_user_to_group_chat(db, telegram_chat, betty)
+    await db.commit()
+
+    # Then: The cache knows about them
+    assert chat_membership_cache.contains(telegram_group_chat_id, betty.telegram_user_id)
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_chat_only_records_committed_profiles(db: AsyncSession):
+    # Given: A group chat exists with a registered user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # When: Their new profile is written, but the transaction is rolled back
+    johnny = UserModel(telegram_user_id=12345, username="johnny", first_name="John", last_name="Doe")
+    await add_user_to_group_chat(db, telegram_chat, johnny)
+    await db.rollback()
+
+    # Then: The new profile still has to be written
+    assert profile_fingerprint_cache.has_changed(johnny)
+
+    # When: It's written again, and committed
+    await add_user_to_group_chat(db, telegram_chat, johnny)
+    await db.commit()
+
+    # Then: It's known to be stored
+    assert not profile_fingerprint_cache.has_changed(johnny)
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_chat_only_invalidates_every_chat_for_new_profiles(db: AsyncSession):
+    # Given: A user is in a group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat A", [john])
+    await create_test_group_chat(db, -987654321, "Group Chat B", [])
+
+    telegram_chat = Mock()
+    telegram_chat.id = -987654321
+    global_version, _ = rendered_output_cache.version(telegram_group_chat_id)
+    _, chat_version = rendered_output_cache.version(-987654321)
+
+    # When: They join another group chat with the same profile
+    await add_user_to_group_chat(db, telegram_chat, UserModel(telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe"))
+    await db.commit()
+
+    # Then: Only the chat they joined is invalidated
+    assert rendered_output_cache.version(telegram_group_chat_id) == (global_version, 0)
+    assert rendered_output_cache.version(-987654321) == (global_version, chat_version + 1)
+
+    # When: They're seen with a new username
+    await add_user_to_group_chat(db, telegram_chat, UserModel(telegram_user_id=12345, username="johnny", first_name="John", last_name="Doe"))
+    await db.commit()
+
+    # Then: Every chat is invalidated
+    assert rendered_output_cache.version(telegram_group_chat_id) == (global_version + 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_joining_with_an_unchanged_profile_does_not_bump_the_global_or_shared_version(db: AsyncSession, monkeypatch):
+    # Given: Other instances of the bot run, and a user is in a group chat
+    monkeypatch.setattr(rendered_output_cache, "is_shared", True)
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    await create_test_group_chat(db, -987654321, "Group Chat B", [])
+
+    telegram_chat = Mock()
+    telegram_chat.id = -987654321
+    global_version, _ = rendered_output_cache.version(-987654321)
+    shared_version = await find_shared_render_version(db)
+
+    # When: They join another group chat with the same profile
+    await add_user_to_group_chat(db, telegram_chat, UserModel(telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe"))
+    await db.commit()
+
+    # Then: Neither the global nor the shared version is bumped
+    assert rendered_output_cache.version(-987654321)[0] == global_version
+    assert await find_shared_render_version(db) == shared_version
+
+
+@pytest.mark.asyncio
+async def test_listen_for_messages_queues_cached_user_with_new_profile(db: AsyncSession):
+    # Given: The listener has already seen a user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+    await add_user_to_group_chat(db, telegram_chat, john)
+    await db.commit()
+
+    update = Mock()
+    update.effective_chat = telegram_chat
+    update.message.from_user.id = 12345
+    update.message.from_user.first_name = "John"
+    update.message.from_user.last_name = "Doe"
+
+    # When: They send another message with the same profile
+    update.message.from_user.username = "johndoe"
+    await listen_for_messages_handler(update, Mock())
+
+    # Then: They aren't queued
+    assert not registration_queue.is_pending(telegram_group_chat_id, 12345)
+
+    # When: They send a message after changing their username
+    update.message.from_user.username = "johnny"
+    await listen_for_messages_handler(update, Mock())
+
+    # Then: They're queued, so their profile is updated
+    assert registration_queue.is_pending(telegram_group_chat_id, 12345)
+    await registration_queue.discard(telegram_group_chat_id, 12345)
+
+
+@pytest.mark.asyncio
+async def test_remove_user_from_group_chat_invalidates_cache(db: AsyncSession):
+    # Given: A group chat exists with a registered user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # And: The listener has already seen them
+    await add_user_to_group_chat(db, telegram_chat, john)
+    await db.commit()
+
+    # When: They leave the group chat
+    await remove_user_from_group_chat(db, telegram_chat, john)
+
+    # Then: The cache no longer knows about them
+    assert not chat_membership_cache.contains(telegram_group_chat_id, john.telegram_user_id)
+
+
+@pytest.mark.asyncio
+async def test_add_user_already_registered_in_another_group_chat(db: AsyncSession):
+    # Given: A user is registered in one group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -111111111, "Group Chat A", [john])
+
+    # And: Another group chat exists without them
+    telegram_group_chat_id = -222222222
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat B", [])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # When: They send a message in the other group chat, with a new username
+    current_user = UserModel(
+        telegram_user_id=12345,
+        username="johnny",
+        first_name="John",
+        last_name="Doe"
+    )
+    added_user = await add_user_to_group_chat(db, telegram_chat, current_user)
+
+    # Then: The existing user is added to the group chat
+    assert added_user.user_id == john.user_id
+    assert [user.user_id for user in await group_chat.awaitable_attrs.users] == [john.user_id]
+
+    # And: Their profile is updated
+    assert added_user.username == "johnny"
+
+
+@pytest.mark.asyncio
+async def test_remove_user_from_group_chat_keeps_subgroups_in_other_group_chats(db: AsyncSession):
+    # Given: A user is in subgroups in two group chats
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    group_chat_a = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat A", [john])
+    group_chat_b = await create_test_group_chat(db, -987654321, "Group Chat B", [john])
+
+    subgroup_a = await create_test_subgroup(db, group_chat_a.group_chat_id, "Archery", [john])
+    subgroup_b = await create_test_subgroup(db, group_chat_b.group_chat_id, "Archery", [john])
+
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+
+    # When: They leave the first group chat
+    await remove_user_from_group_chat(db, telegram_chat, john)
+
+    # Then: Only the members of the subgroups they were removed from have to be loaded again
+    assert "users" in inspect(subgroup_a).unloaded
+    assert "users" not in inspect(subgroup_b).unloaded
+
+    # And: They're only removed from the subgroups in that group chat
+    assert john not in await subgroup_a.awaitable_attrs.users
+    assert john in await subgroup_b.awaitable_attrs.users
+    assert john in await group_chat_b.awaitable_attrs.users
@@ -1,9 +1,9 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.models import GroupChatModel, SubgroupModel, UserModel
 
 
-def create_test_user(session: Session, telegram_user_id, username, first_name, last_name) -> UserModel:
+async def create_test_user(session: AsyncSession, telegram_user_id, username, first_name, last_name) -> UserModel:
     user = UserModel(
         telegram_user_id=telegram_user_id,
         username=username,
@@ -12,14 +12,14 @@ def create_test_user(session: Session, telegram_user_id, username, first_name, l
     )
 
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    await session.refresh(user)
 
     return user
 
 
-def create_test_subgroup(
-        session: Session,
+async def create_test_subgroup(
+        session: AsyncSession,
         group_chat_id: str,
         name: str,
         users: list[UserModel],
@@ -33,13 +33,13 @@ def create_test_subgroup(
         subgroup.users.append(user)
 
     session.add(subgroup)
-    session.commit()
-    session.refresh(subgroup)
+    await session.commit()
+    await session.refresh(subgroup, ["users"])
     return subgroup
 
 
-def create_test_group_chat(
-        session: Session,
+async def create_test_group_chat(
+        session: AsyncSession,
         telegram_group_chat_id: int,
         name: str,
         users: list[UserModel],
@@ -55,7 +55,7 @@ def create_test_group_chat(
         group_chat.users.append(user)
 
     session.add(group_chat)
-    session.commit()
-    session.refresh(group_chat)
+    await session.commit()
+    await session.refresh(group_chat, ["users"])
 
     return group_chat
@@ -0,0 +1,168 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from conftest import db
+from shout_subgroup import database, instance_coordination
+from shout_subgroup.instance_coordination import InstanceCoordinator
+from shout_subgroup.membership_cache import chat_membership_cache
+from shout_subgroup.models import Base, ProcessedUpdateModel
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.repository import claim_update, bump_shared_render_version
+from shout_subgroup.update_processor import ChatOrderedUpdateProcessor
+from test_update_processor import create_update
+
+
+@pytest.fixture
+def shared_database(db: AsyncSession, monkeypatch) -> AsyncSession:
+    # Every instance connects to the test database
+    monkeypatch.setattr(database, "Session", None)
+    monkeypatch.setattr(database, "ReadOnlySession", None)
+    database.use_engines(db.bind)
+    return db
+
+
+async def claim(coordinator: InstanceCoordinator, update_id: int, telegram_chat_id: int | None) -> bool:
+    async with coordinator.chat_lock(telegram_chat_id) as session:
+        return await coordinator.claim(session, update_id, telegram_chat_id)
+
+
+@pytest.mark.asyncio
+async def test_an_update_is_only_claimed_once(shared_database: AsyncSession):
+    # Given: Two instances
+    first = InstanceCoordinator(instance_id="first")
+    second = InstanceCoordinator(instance_id="second")
+
+    # When: Both are delivered the same update
+    # Then: Only the first claims it
+    assert await claim(first, 1, -1)
+    assert not await claim(second, 1, -1)
+    assert (first.duplicate_count, second.duplicate_count) == (0, 1)
+
+    # And: Updates without a chat are claimed too
+    assert await claim(second, 2, None)
+    assert not await claim(first, 2, None)
+
+
+@pytest.mark.asyncio
+async def test_taking_a_chat_over_forgets_its_caches(shared_database: AsyncSession):
+    # Given: The second instance cached something about a chat
+    first = InstanceCoordinator(instance_id="first")
+    second = InstanceCoordinator(instance_id="second")
+    assert await claim(second, 1, -1)
+    chat_membership_cache.add(-1, 12345)
+    version = rendered_output_cache.version(-1)
+
+    # When: The first instance processes the chat, then the second one again
+    assert await claim(first, 2, -1)
+    assert await claim(second, 3, -1)
+
+    # Then: The second instance doesn't trust what it cached
+    assert second.take_over_count == 2
+    assert not chat_membership_cache.contains(-1, 12345)
+    assert rendered_output_cache.version(-1) != version
+
+    # And: It doesn't forget again while it keeps the chat
+    chat_membership_cache.add(-1, 12345)
+    assert await claim(second, 4, -1)
+    assert second.take_over_count == 2
+    assert chat_membership_cache.contains(-1, 12345)
+
+
+@pytest.mark.asyncio
+async def test_profile_changes_made_by_another_instance_are_noticed(shared_database: AsyncSession):
+    # Given: An instance keeps processing a chat
+    second = InstanceCoordinator(instance_id="second")
+    assert await claim(second, 1, -1)
+    version = rendered_output_cache.version(-1)
+
+    # When: Another instance changes a profile, which only bumps the shared version for us
+    async with database.get_database().begin() as session:
+        await bump_shared_render_version(session)
+    assert rendered_output_cache.version(-1) == version
+
+    # Then: The chat's next update forgets what was rendered
+    assert await claim(second, 2, -1)
+    assert second.take_over_count == 1
+    assert rendered_output_cache.version(-1) != version
+
+    # And: It doesn't forget again until the next change
+    version = rendered_output_cache.version(-1)
+    assert await claim(second, 3, -1)
+    assert rendered_output_cache.version(-1) == version
+
+
+@pytest.mark.asyncio
+async def test_expired_updates_are_forgotten(shared_database: AsyncSession, monkeypatch):
+    # Given: An update claimed long ago
+    await claim_update(shared_database, 1, datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=2))
+    await shared_database.commit()
+    monkeypatch.setattr(instance_coordination, "PRUNE_EVERY_CLAIMS", 1)
+
+    # When: Another update is claimed
+    assert await claim(InstanceCoordinator(instance_id="first"), 2, -1)
+
+    # Then: Only the new one is kept
+    update_ids = (await shared_database.execute(select(ProcessedUpdateModel.update_id))).scalars().all()
+    assert update_ids == [2]
+
+
+@pytest.mark.asyncio
+async def test_instances_process_each_update_once(tmp_path, monkeypatch):
+    # Given: Two instances that are both delivered the same updates.
+    # They process chats concurrently, so they need a database that allows more than one connection.
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'instances.db'}")
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(database, "Session", None)
+    monkeypatch.setattr(database, "ReadOnlySession", None)
+    database.use_engines(engine)
+
+    processors = [
+        ChatOrderedUpdateProcessor(10, InstanceCoordinator(instance_id="first")),
+        ChatOrderedUpdateProcessor(10, InstanceCoordinator(instance_id="second")),
+    ]
+    processed = []
+
+    async def process(update_id: int) -> None:
+        processed.append(update_id)
+
+    # When: They process them
+    await asyncio.gather(*(
+        processor.process_update(create_update(update_id, -(update_id % 3)), process(update_id))
+        for update_id in range(1, 21)
+        for processor in processors
+    ))
+
+    # Then: Every update was processed once
+    assert sorted(processed) == list(range(1, 21))
+    async with database.get_database()() as session:
+        assert await session.scalar(select(func.count()).select_from(ProcessedUpdateModel)) == 20
+
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_a_failed_update_is_released(shared_database: AsyncSession):
+    # Given: An instance that fails to process an update
+    processor = ChatOrderedUpdateProcessor(10, InstanceCoordinator(instance_id="first"))
+
+    async def fail() -> None:
+        raise RuntimeError("Processing failed")
+
+    with pytest.raises(RuntimeError):
+        await processor.process_update(create_update(1, -1), fail())
+
+    # When: The update is delivered again
+    processed = []
+
+    async def process() -> None:
+        processed.append(1)
+
+    await processor.process_update(create_update(1, -1), process())
+
+    # Then: It's processed
+    assert processed == [1]
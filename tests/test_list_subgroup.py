@@ -1,5 +1,5 @@
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import NotGroupChatError, SubGroupDoesNotExistsError
 from shout_subgroup.list_subgroup import list_subgroups, list_subgroup_members
@@ -8,18 +8,18 @@ from test_helpers import (create_test_user, create_test_group_chat,
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup(db: Session):
+async def test_list_subgroup(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # And: the group chat has a subgroup with members
     subgroup_names = ["Archery", "Bowling", "Cricket"]
     for name in subgroup_names:
-        create_test_subgroup(db, group_chat.group_chat_id, name, [john])
+        await create_test_subgroup(db, group_chat.group_chat_id, name, [john])
 
     # When: We list the subgroups
     result = await list_subgroups(db, group_chat.telegram_group_chat_id)
@@ -31,13 +31,13 @@ async def test_list_subgroup(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_for_no_subgroups(db: Session):
+async def test_list_subgroup_for_no_subgroups(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # But: No subgroups exists in the group chat
 
@@ -49,7 +49,7 @@ async def test_list_subgroup_for_no_subgroups(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_throws_not_group_chat_exception(db: Session):
+async def test_list_subgroup_throws_not_group_chat_exception(db: AsyncSession):
     # Given: The telegram chat is not a group chat
     user_chat_id = 123
 
@@ -62,19 +62,19 @@ async def test_list_subgroup_throws_not_group_chat_exception(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_members(db: Session):
+async def test_list_subgroup_members(db: AsyncSession):
     # Given: A subgroup exist with members
 
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, subgroup_users)
 
     # When: We list the members
     result = await list_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
@@ -88,15 +88,15 @@ async def test_list_subgroup_members(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_that_has_no_members(db: Session):
+async def test_list_subgroup_that_has_no_members(db: AsyncSession):
     # Given: A subgroup exist with no members
     telegram_group_chat_id = -123456789
     subgroup_users = []
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, subgroup_users)
 
     # When: We list the members
     result = await list_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
@@ -106,7 +106,7 @@ async def test_list_subgroup_that_has_no_members(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_members_throws_not_group_chat_exception(db: Session):
+async def test_list_subgroup_members_throws_not_group_chat_exception(db: AsyncSession):
     # Given: The telegram chat is not a group chat
     user_chat_id = 123
 
@@ -119,15 +119,15 @@ async def test_list_subgroup_members_throws_not_group_chat_exception(db: Session
 
 
 @pytest.mark.asyncio
-async def test_list_subgroup_members_throws_not_subgroup_does_not_exist_exception(db: Session):
+async def test_list_subgroup_members_throws_not_subgroup_does_not_exist_exception(db: AsyncSession):
     # Given: Subgroup doesn't exist
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", subgroup_users)
 
     non_existent_subgroup_name = "nonexistent-subgroup"
     # When: We try to list the subgroups
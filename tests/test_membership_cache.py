@@ -0,0 +1,58 @@
+from shout_subgroup.membership_cache import ChatMembershipCache
+
+
+def test_contains_added_user():
+    # Given: A user is cached for a group chat
+    cache = ChatMembershipCache()
+    cache.add(-123, 12345)
+
+    # Then: Only that user is known in that group chat
+    assert cache.contains(-123, 12345)
+    assert not cache.contains(-123, 67890)
+    assert not cache.contains(-456, 12345)
+
+
+def test_discard_forgets_user():
+    # Given: Users are cached for a group chat
+    cache = ChatMembershipCache()
+    cache.add(-123, 12345, 67890)
+
+    # When: One of them is discarded
+    cache.discard(-123, 12345)
+
+    # Then: Only the other user is still known
+    assert not cache.contains(-123, 12345)
+    assert cache.contains(-123, 67890)
+
+
+def test_invalidate_forgets_group_chat():
+    # Given: Users are cached for a group chat
+    cache = ChatMembershipCache()
+    cache.add(-123, 12345, 67890)
+
+    # When: The group chat is invalidated
+    cache.invalidate(-123)
+
+    # Then: None of the users are known
+    assert not cache.contains(-123, 12345)
+    assert not cache.contains(-123, 67890)
+    assert len(cache) == 0
+
+
+def test_evicts_least_recently_used_group_chat():
+    # Given: A cache that can only hold two group chats
+    cache = ChatMembershipCache(max_chats=2)
+    cache.add(-1, 1)
+    cache.add(-2, 2)
+
+    # And: The first group chat was used recently
+    assert cache.contains(-1, 1)
+
+    # When: A third group chat is cached
+    cache.add(-3, 3)
+
+    # Then: The least recently used group chat is evicted
+    assert len(cache) == 2
+    assert cache.contains(-1, 1)
+    assert not cache.contains(-2, 2)
+    assert cache.contains(-3, 3)
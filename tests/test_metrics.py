@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+from shout_subgroup.metrics import MetricsRegistry, TimedUpdateQueue, LatencySamples
+
+
+def test_latency_samples_percentiles():
+    # Given: 100 latencies
+    samples = LatencySamples()
+    for latency in range(1, 101):
+        samples.record(latency / 1000)
+
+    # Then: The percentiles come from the recorded latencies
+    assert samples.percentile(50) == 0.051
+    assert samples.percentile(99) == 0.1
+    assert LatencySamples().percentile(50) is None
+
+
+@pytest.mark.asyncio
+async def test_instrument_records_count_duration_and_queue_lag():
+    # Given: An instrumented handler, and an update that waited in the queue
+    registry = MetricsRegistry()
+    update_queue = TimedUpdateQueue(registry)
+
+    async def shout_handler(update, context):
+        await asyncio.sleep(0.01)
+
+    instrumented_handler = registry.instrument(shout_handler)
+    update = Update(update_id=1)
+    await update_queue.put(update)
+    await asyncio.sleep(0.02)
+
+    # When: The handler runs
+    await instrumented_handler(await update_queue.get(), None)
+
+    # Then: Everything is recorded under the handler's name
+    metrics = registry.handlers["shout_handler"]
+    assert metrics.count == 1
+    assert metrics.error_count == 0
+    assert metrics.durations.percentile(50) >= 0.01
+    assert metrics.queue_lag_count == 1
+    assert metrics.queue_lags.percentile(50) >= 0.02
+
+
+@pytest.mark.asyncio
+async def test_instrument_records_errors():
+    # Given: A handler that fails
+    registry = MetricsRegistry()
+
+    async def broken_handler(update, context):
+        raise ValueError("Oops")
+
+    instrumented_handler = registry.instrument(broken_handler)
+
+    # When: It runs
+    # Then: The error still reaches the application
+    with pytest.raises(ValueError):
+        await instrumented_handler(Update(update_id=1), None)
+
+    # And: It's counted
+    metrics = registry.handlers["broken_handler"]
+    assert metrics.count == 1
+    assert metrics.error_count == 1
+    # The update never went through the queue
+    assert metrics.queue_lag_count == 0
+
+
+def test_registry_forgets_unhandled_updates():
+    # Given: A registry that remembers 2 updates
+    registry = MetricsRegistry(max_pending_updates=2)
+
+    # When: 3 updates arrive, and no handler picks them up
+    for update_id in range(3):
+        registry.update_received(Update(update_id=update_id))
+
+    # Then: Only the latest are remembered
+    assert list(registry._received_at) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_timed_update_queue_records_arrival_once():
+    # Given: A timed update queue
+    registry = MetricsRegistry()
+    update_queue = TimedUpdateQueue(registry)
+
+    # When: Updates are put, waiting or not
+    await update_queue.put(Update(update_id=1))
+    received_at = registry._received_at[1]
+    update_queue.put_nowait(Update(update_id=2))
+
+    # Then: Each arrival is recorded, and put() doesn't record it again
+    assert list(registry._received_at) == [1, 2]
+    assert registry._received_at[1] == received_at
+    assert update_queue.qsize() == 2
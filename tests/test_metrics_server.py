@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+from shout_subgroup.metrics import MetricsRegistry
+from shout_subgroup.metrics_server import render_metrics, MetricsServer
+from shout_subgroup.query_metrics import QueryMetrics
+from shout_subgroup.send_scheduler import SendScheduler
+
+
+async def create_test_registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+
+    async def shout_handler(update, context):
+        pass
+
+    await registry.instrument(shout_handler)(Update(update_id=1), None)
+    return registry
+
+
+@pytest.mark.asyncio
+async def test_render_metrics():
+    # Given: A handler ran, a message was sent and a query was made
+    registry = await create_test_registry()
+    scheduler = SendScheduler()
+    scheduler.metrics.record_sent(0.25)
+    queries = QueryMetrics()
+    queries.record("find_all_users_in_group_chat", 0.002)
+
+    # When: We render the metrics
+    text = render_metrics(registry, scheduler, queries)
+
+    # Then: They're in the Prometheus text format
+    assert "# TYPE shout_subgroup_handler_duration_seconds summary" in text
+    assert 'shout_subgroup_handler_updates_total{handler="shout_handler"} 1.0' in text
+    assert 'shout_subgroup_handler_errors_total{handler="shout_handler"} 0.0' in text
+    assert 'shout_subgroup_handler_duration_seconds_count{handler="shout_handler"} 1.0' in text
+    assert 'shout_subgroup_handler_queue_lag_seconds{handler="shout_handler",quantile="0.99"} NaN' in text
+    assert "shout_subgroup_messages_sent_total 1.0" in text
+    assert "# TYPE shout_subgroup_send_latency_seconds summary" in text
+    assert 'shout_subgroup_send_latency_seconds{quantile="0.5"} 0.25' in text
+    assert "shout_subgroup_send_latency_seconds_sum 0.25" in text
+    assert "shout_subgroup_send_latency_seconds_count 1.0" in text
+    assert 'shout_subgroup_send_queue_depth{priority="shout"} 0.0' in text
+    assert 'shout_subgroup_queries_total{function="find_all_users_in_group_chat"} 1.0' in text
+    assert "# TYPE shout_subgroup_query_duration_seconds summary" in text
+    assert 'shout_subgroup_query_duration_seconds_sum{function="find_all_users_in_group_chat"} 0.002' in text
+    assert "shout_subgroup_registrations_pending 0.0" in text
+    assert 'shout_subgroup_render_cache_requests_total{result="hit"}' in text
+
+
+@pytest.mark.asyncio
+async def test_metrics_server_serves_metrics():
+    # Given: The metrics server is running on any free port
+    server = MetricsServer(port=0)
+    await server.start()
+
+    try:
+        # When: Prometheus scrapes it
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.bound_port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+
+        # Then: The metrics are returned
+        headers, body = response.split(b"\r\n\r\n", 1)
+        assert headers.startswith(b"HTTP/1.1 200 OK")
+        assert b"# TYPE shout_subgroup_messages_sent_total counter" in body
+
+        # And: Anything else isn't found
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.bound_port)
+        writer.write(b"GET / HTTP/1.1\r\n\r\n")
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b"HTTP/1.1 404 Not Found")
+    finally:
+        await server.stop()
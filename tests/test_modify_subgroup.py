@@ -1,8 +1,14 @@
+from unittest.mock import Mock
+
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import SubGroupDoesNotExistsError, UserDoesNotExistsError, NotGroupChatError
-from shout_subgroup.modify_subgroup import add_users_to_existing_subgroup, does_subgroup_exist
+from shout_subgroup.modify_subgroup import add_users_to_existing_subgroup, does_subgroup_exist, \
+    _handle_add_users_to_existing_subgroup
+from shout_subgroup.query_metrics import QueryMetrics, instrument_query_timing
+from shout_subgroup.send_scheduler import DeferredReplies
+from shout_subgroup.utils import UserIdMentionMapping
 from test_helpers import create_test_user, create_test_group_chat, create_test_subgroup
 
 
@@ -14,73 +20,101 @@ class MockTelegramChat:
 
 
 @pytest.mark.asyncio
-async def test_add_users_to_existing_subgroup(db: Session):
+async def test_add_users_to_existing_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We add a new member to the group
     subgroup = await add_users_to_existing_subgroup(db, telegram_group_chat_id, subgroup_name, {betty.user_id})
 
     # Then: It's added correctly
-    assert len(subgroup.users) == 3
+    assert len(await subgroup.awaitable_attrs.users) == 3
 
-    actual_usernames = [user.username for user in subgroup.users]
+    actual_usernames = [user.username for user in await subgroup.awaitable_attrs.users]
     expected_subgroup_users = [john, jane, betty]
     expected_usernames = [user.username for user in expected_subgroup_users]
     assert set(actual_usernames) == set(expected_usernames)
 
 
 @pytest.mark.asyncio
-async def test_add_users_to_existing_subgroup_when_provided_user_already_in_group(db: Session):
+async def test_adding_users_replies_without_querying_each_member(db: AsyncSession):
+    # Given: A subgroup with members, and timed queries
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username=None, first_name="Betty", last_name="White")
+    group_chat = await create_test_group_chat(db, -123456789, "Group Chat", [john, jane, betty])
+    await create_test_subgroup(db, group_chat.group_chat_id, "Archery", [john, jane])
+    metrics = QueryMetrics()
+    instrument_query_timing(db.bind, metrics, slow_query_seconds=60)
+
+    update = Mock()
+    update.effective_chat.id = -123456789
+    replies = DeferredReplies(update)
+
+    # When: We add a member
+    await _handle_add_users_to_existing_subgroup(
+        db, update, replies, "Archery", {UserIdMentionMapping(mention="Betty", user_id=betty.user_id)}
+    )
+
+    # Then: Every member is mentioned
+    [(text, kwargs)] = replies._replies
+    assert "@johndoe" in text and "@janedoe" in text and "[Betty](tg://user?id=87654)" in text
+
+    # And: The members weren't looked up one by one
+    assert "find_user_by_user_id" not in metrics.query_counts
+
+
+@pytest.mark.asyncio
+async def test_add_users_to_existing_subgroup_when_provided_user_already_in_group(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We add a new member and an existing member to the group
     members_to_add = {jane.user_id, betty.user_id}
     subgroup = await add_users_to_existing_subgroup(db, telegram_group_chat_id, subgroup_name, members_to_add)
 
     # Then: It's added correctly
-    assert len(subgroup.users) == 3
+    assert len(await subgroup.awaitable_attrs.users) == 3
 
-    actual_usernames = [user.username for user in subgroup.users]
+    actual_usernames = [user.username for user in await subgroup.awaitable_attrs.users]
     expected_subgroup_users = [john, jane, betty]
     expected_usernames = [user.username for user in expected_subgroup_users]
     assert set(actual_usernames) == set(expected_usernames)
 
 
 @pytest.mark.asyncio
-async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_subgroup(db: Session):
+async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We try to modify a non-existent subgroup
     non_existent_subgroup_name = "Party"
@@ -93,18 +127,18 @@ async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_
 
 
 @pytest.mark.asyncio
-async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_user(db: Session):
+async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_user(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We try to add a non-existent user
     non_existent_user_id = {None}
@@ -116,18 +150,18 @@ async def test_add_users_to_existing_subgroup_throws_exception_for_non_existent_
 
 
 @pytest.mark.asyncio
-async def test_does_subgroup_exist(db: Session):
+async def test_does_subgroup_exist(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We look for the subgroup
     exists = await does_subgroup_exist(db, telegram_group_chat_id, subgroup_name)
@@ -137,18 +171,18 @@ async def test_does_subgroup_exist(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_does_subgroup_does_not_exist(db: Session):
+async def test_does_subgroup_does_not_exist(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We look for the non-existent subgroup
     non_existent_subgroup_name = "Party"
@@ -159,18 +193,18 @@ async def test_does_subgroup_does_not_exist(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_does_subgroup_exist_throws_exception_when_group_chat_does_not_exist(db: Session):
+async def test_does_subgroup_exist_throws_exception_when_group_chat_does_not_exist(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We look for the subgroup
     user_chat_id = 123  # Users have positive integers for ids
@@ -0,0 +1,118 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from shout_subgroup.exceptions import (
+    SubGroupDoesNotExistsError,
+    SubGroupNestingCycleError,
+    SubGroupNestingTooDeepError
+)
+from shout_subgroup.models import subgroups_subgroups_join_table
+from shout_subgroup.nest_subgroup import nest_subgroups_in_subgroup, unnest_subgroups_from_subgroup
+from shout_subgroup.repository import find_all_users_in_subgroup, delete_subgroup, MAX_SUBGROUP_NESTING_DEPTH
+from shout_subgroup.shout import shout_subgroup_members
+from test_helpers import create_test_user, create_test_group_chat, create_test_subgroup
+
+
+@pytest.mark.asyncio
+async def test_shout_nested_subgroup_mentions_every_member_once(db: AsyncSession):
+    # Given: A group chat with subgroups that share a member
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    sue = await create_test_user(db, telegram_user_id=13579, username="sue", first_name="Sue", last_name="Smith")
+    bob = await create_test_user(db, telegram_user_id=24680, username="bob", first_name="Bob", last_name="Brown")
+
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane, sue, bob])
+    await create_test_subgroup(db, group_chat.group_chat_id, "backend", [bob])
+    await create_test_subgroup(db, group_chat.group_chat_id, "api", [john, jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, "db", [jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, "payments", [sue])
+
+    # When: backend contains api and db, and api contains payments
+    await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "backend", {"api", "db"})
+    await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "api", {"payments"})
+
+    # Then: Shouting backend mentions everyone at every level, once
+    messages = await shout_subgroup_members(db, telegram_group_chat_id, "backend")
+    assert messages == ["@johndoe @sue @bob @janedoe "]
+
+    # And: Nested subgroups still only shout their own members
+    api_members = await find_all_users_in_subgroup(db, group_chat.group_chat_id, "api")
+    assert {user.username for user in api_members} == {"johndoe", "janedoe", "sue"}
+
+
+@pytest.mark.asyncio
+async def test_nest_subgroup_rejects_cycles(db: AsyncSession):
+    # Given: backend contains api
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [])
+    await create_test_subgroup(db, group_chat.group_chat_id, "backend", [])
+    await create_test_subgroup(db, group_chat.group_chat_id, "api", [])
+    await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "backend", {"api"})
+
+    # Then: api can't contain backend, or itself
+    with pytest.raises(SubGroupNestingCycleError):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "api", {"backend"})
+
+    with pytest.raises(SubGroupNestingCycleError):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "api", {"api"})
+
+
+@pytest.mark.asyncio
+async def test_nest_subgroup_rejects_too_many_levels(db: AsyncSession):
+    # Given: A chain of subgroups as deep as they can go
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [])
+    names = [f"level-{level}" for level in range(MAX_SUBGROUP_NESTING_DEPTH + 2)]
+    for name in names:
+        await create_test_subgroup(db, group_chat.group_chat_id, name, [])
+
+    for parent_name, child_name in zip(names[:-2], names[1:-1]):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, parent_name, {child_name})
+
+    # Then: Another level can't be added at the bottom, or at the top
+    with pytest.raises(SubGroupNestingTooDeepError):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, names[-2], {names[-1]})
+
+    with pytest.raises(SubGroupNestingTooDeepError):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, names[-1], {names[0]})
+
+
+@pytest.mark.asyncio
+async def test_nest_subgroup_requires_existing_subgroups(db: AsyncSession):
+    # Given: A group chat with one subgroup
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [])
+    await create_test_subgroup(db, group_chat.group_chat_id, "backend", [])
+
+    # Then: A subgroup that doesn't exist can't be nested
+    with pytest.raises(SubGroupDoesNotExistsError):
+        await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "backend", {"api"})
+
+
+@pytest.mark.asyncio
+async def test_unnest_and_delete_subgroup_remove_nesting(db: AsyncSession):
+    # Given: backend contains api and db
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, "backend", [])
+    await create_test_subgroup(db, group_chat.group_chat_id, "api", [john])
+    await create_test_subgroup(db, group_chat.group_chat_id, "db", [jane])
+    await nest_subgroups_in_subgroup(db, telegram_group_chat_id, "backend", {"api", "db"})
+
+    # When: api is taken out
+    await unnest_subgroups_from_subgroup(db, telegram_group_chat_id, "backend", {"api"})
+
+    # Then: Only db's members are shouted
+    members = await find_all_users_in_subgroup(db, group_chat.group_chat_id, "backend")
+    assert [user.username for user in members] == ["janedoe"]
+
+    # When: db is deleted
+    await delete_subgroup(db, telegram_group_chat_id, "db")
+
+    # Then: Nothing is nested anymore
+    assert (await db.execute(select(subgroups_subgroups_join_table))).all() == []
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+
+from shout_subgroup.paced_sender import PacedSender
+from shout_subgroup.send_scheduler import SendScheduler
+
+
+class FakeChat:
+    def __init__(self):
+        self.sent: list[tuple[str, float]] = []
+
+    async def send_message(self, message: str):
+        self.sent.append((message, time.monotonic()))
+
+
+@pytest.mark.asyncio
+async def test_send_paces_messages():
+    # Given: A scheduler that allows 20 messages a second per chat, without bursts
+    sender = PacedSender(SendScheduler(chat_rate=20, chat_burst=1))
+    chat = FakeChat()
+    progress = []
+
+    async def on_progress(sent_count, total_count):
+        progress.append((sent_count, total_count))
+
+    # When: We send a few messages
+    sent_count = await sender.send(-123, ["one", "two", "three"], chat.send_message, on_progress)
+
+    # Then: They're all sent in order
+    assert sent_count == 3
+    assert [message for message, _ in chat.sent] == ["one", "two", "three"]
+
+    # And: They're paced
+    send_times = [sent_at for _, sent_at in chat.sent]
+    assert all(later - earlier >= 0.04 for earlier, later in zip(send_times, send_times[1:]))
+
+    # And: Progress was reported after each message
+    assert progress == [(1, 3), (2, 3), (3, 3)]
+
+
+@pytest.mark.asyncio
+async def test_send_does_not_interleave_series_in_the_same_chat():
+    # Given: Two shouts in the same chat
+    sender = PacedSender(SendScheduler(chat_rate=1000, chat_burst=1000))
+    chat = FakeChat()
+
+    # When: They're sent at the same time
+    await asyncio.gather(
+        sender.send(-123, ["a1", "a2", "a3"], chat.send_message),
+        sender.send(-123, ["b1", "b2", "b3"], chat.send_message)
+    )
+
+    # Then: One shout is sent completely before the other
+    assert [message for message, _ in chat.sent] == ["a1", "a2", "a3", "b1", "b2", "b3"]
+
+
+@pytest.mark.asyncio
+async def test_chat_locks_are_dropped_once_idle():
+    # Given: Shouts in a few chats
+    sender = PacedSender(SendScheduler(chat_rate=1000, chat_burst=1000))
+    chat = FakeChat()
+
+    # When: They're all sent
+    await asyncio.gather(*(
+        sender.send(-(index % 2), [f"message {index}"], chat.send_message) for index in range(5)
+    ))
+
+    # Then: No lock is kept around
+    assert len(chat.sent) == 5
+    assert sender._chat_locks == {}
+    assert sender._chat_series_counts == {}
+
+
+@pytest.mark.asyncio
+async def test_start_returns_before_the_messages_are_sent():
+    # Given: A scheduler that allows a message every 50ms per chat
+    scheduler = SendScheduler(chat_rate=20, chat_burst=1)
+    sender = PacedSender(scheduler)
+    chat = FakeChat()
+
+    # When: Two shouts are handed over, one after the other
+    sender.start(-123, ["a1", "a2", "a3"], chat.send_message)
+    sender.start(-123, ["b1", "b2"], chat.send_message)
+
+    # Then: Nothing was waited on
+    assert chat.sent == []
+
+    # And: The scheduler sends them in the background, in the order they were handed over
+    await scheduler.drain()
+    assert [message for message, _ in chat.sent] == ["a1", "a2", "a3", "b1", "b2"]
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_series_sent_in_the_background():
+    # Given: A long shout sent in the background
+    scheduler = SendScheduler(chat_rate=1, chat_burst=1)
+    sender = PacedSender(scheduler)
+    chat = FakeChat()
+    task = sender.start(-123, ["one", "two", "three"], chat.send_message)
+    await asyncio.sleep(0.01)
+
+    # When: The scheduler stops
+    await scheduler.stop()
+
+    # Then: The rest of the shout isn't sent
+    assert task.cancelled()
+    assert [message for message, _ in chat.sent] == ["one"]
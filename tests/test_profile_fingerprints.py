@@ -0,0 +1,43 @@
+from shout_subgroup.models import UserModel
+from shout_subgroup.profile_fingerprints import ProfileFingerprintCache
+
+
+def test_unknown_user_has_changed():
+    # Given: An empty cache
+    cache = ProfileFingerprintCache()
+
+    # Then: Any user counts as changed
+    assert cache.has_changed(UserModel(telegram_user_id=12345, username="johndoe", first_name="John"))
+
+
+def test_recorded_profile_has_not_changed():
+    # Given: A user's profile was recorded
+    cache = ProfileFingerprintCache()
+    cache.record(UserModel(telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe"))
+
+    # Then: The same profile, in any case, hasn't changed
+    assert not cache.has_changed(UserModel(telegram_user_id=12345, username="JohnDoe", first_name="John", last_name="Doe"))
+
+    # And: A new username or name has
+    assert cache.has_changed(UserModel(telegram_user_id=12345, username="johnny", first_name="John", last_name="Doe"))
+    assert cache.has_changed(UserModel(telegram_user_id=12345, username="johndoe", first_name="Johnny", last_name="Doe"))
+    assert cache.has_changed(UserModel(telegram_user_id=12345, username=None, first_name="John", last_name="Doe"))
+
+
+def test_evicts_least_recently_seen_user():
+    # Given: A cache that only fits two users
+    cache = ProfileFingerprintCache(max_users=2)
+    john = UserModel(telegram_user_id=12345, username="johndoe", first_name="John")
+    jane = UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane")
+    sue = UserModel(telegram_user_id=13579, username="sue", first_name="Sue")
+    cache.record(john, jane)
+
+    # When: John is seen again, and a third user is recorded
+    cache.has_changed(john)
+    cache.record(sue)
+
+    # Then: Jane, the least recently seen, is evicted
+    assert len(cache) == 2
+    assert cache.has_changed(jane)
+    assert not cache.has_changed(john)
+    assert not cache.has_changed(sue)
@@ -0,0 +1,128 @@
+import logging
+
+import pytest
+from sqlalchemy import text, exc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from conftest import db
+from shout_subgroup.database import create_engine, PoolConfig
+from shout_subgroup.query_metrics import QueryMetrics, instrument_query_timing, UNTRACKED_CALLER
+from shout_subgroup.repository import find_all_users_in_group_chat, find_user_by_telegram_user_id
+from test_helpers import create_test_user, create_test_group_chat
+
+
+@pytest.mark.asyncio
+async def test_queries_are_timed_per_repository_function(db: AsyncSession):
+    # Given: A group chat with a user, and timed queries
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    metrics = QueryMetrics()
+    instrument_query_timing(db.bind, metrics, slow_query_seconds=60)
+
+    # When: We query through the repository, and outside of it
+    await find_all_users_in_group_chat(db, -123456789)
+    await find_all_users_in_group_chat(db, -123456789)
+    await find_user_by_telegram_user_id(db, 12345)
+    await db.execute(text("SELECT 1"))
+
+    # Then: Each statement is recorded under the function that ran it
+    assert metrics.query_counts == {
+        "find_all_users_in_group_chat": 2,
+        "find_user_by_telegram_user_id": 1,
+        UNTRACKED_CALLER: 1,
+    }
+    assert metrics.latency_percentile("find_all_users_in_group_chat", 99) is not None
+    assert metrics.slow_query_counts == {}
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_are_logged_with_their_plan(db: AsyncSession, caplog):
+    # Given: Every query counts as slow
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    metrics = QueryMetrics()
+    explainer = instrument_query_timing(db.bind, metrics, slow_query_seconds=0)
+
+    # When: We query through the repository
+    with caplog.at_level(logging.WARNING, logger="shout_subgroup.query_metrics"):
+        users = await find_all_users_in_group_chat(db, -123456789)
+        await explainer.drain()
+
+    # Then: The results are untouched
+    assert [user.telegram_user_id for user in users] == [12345]
+
+    # And: The statement was logged, followed by its plan
+    assert metrics.slow_query_counts == {"find_all_users_in_group_chat": 1}
+    slow_query_logs = [record.getMessage() for record in caplog.records if record.name == "shout_subgroup.query_metrics"]
+    assert len(slow_query_logs) == 2
+    assert "Slow query in find_all_users_in_group_chat" in slow_query_logs[0]
+    assert "Plan of slow query in find_all_users_in_group_chat" in slow_query_logs[1]
+    assert "SEARCH" in slow_query_logs[1] or "SCAN" in slow_query_logs[1]
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_are_explained_once_per_interval(db: AsyncSession, caplog):
+    # Given: Every query counts as slow
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    metrics = QueryMetrics()
+    explainer = instrument_query_timing(db.bind, metrics, slow_query_seconds=0, explain_interval=60)
+
+    # When: The same statement is slow a few times
+    with caplog.at_level(logging.WARNING, logger="shout_subgroup.query_metrics"):
+        for _ in range(3):
+            await find_all_users_in_group_chat(db, -123456789)
+        await explainer.drain()
+
+    # Then: Each time is logged, but it's explained only once, and the EXPLAIN isn't timed
+    assert metrics.query_counts == {"find_all_users_in_group_chat": 3}
+    slow_query_logs = [record.getMessage() for record in caplog.records if record.name == "shout_subgroup.query_metrics"]
+    assert len([log for log in slow_query_logs if log.startswith("Slow query in")]) == 3
+    assert len([log for log in slow_query_logs if log.startswith("Plan of slow query in")]) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_queries_are_not_timed(db: AsyncSession):
+    # Given: Timed queries
+    metrics = QueryMetrics()
+    instrument_query_timing(db.bind, metrics, slow_query_seconds=60)
+
+    # When: A statement fails
+    with pytest.raises(exc.OperationalError):
+        await db.execute(text("SELECT * FROM no_such_table"))
+
+    # Then: The database error is raised as it is, and the next statement is timed
+    await db.execute(text("SELECT 1"))
+    assert metrics.query_counts == {UNTRACKED_CALLER: 1}
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_are_not_explained_while_the_pool_is_busy(tmp_path, caplog):
+    # Given: A pool with two connections, and every query counts as slow
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", PoolConfig(pool_size=2, max_overflow=0))
+    metrics = QueryMetrics()
+    explainer = instrument_query_timing(engine, metrics, slow_query_seconds=0)
+
+    try:
+        with caplog.at_level(logging.INFO, logger="shout_subgroup.query_metrics"):
+            # When: A statement is slow while both connections are in use
+            async with engine.connect() as connection, engine.connect():
+                await connection.execute(text("SELECT 1"))
+                await explainer.drain()
+
+            # Then: It's logged, but not explained
+            logs = [record.getMessage() for record in caplog.records if record.name == "shout_subgroup.query_metrics"]
+            assert len([log for log in logs if log.startswith("Slow query in")]) == 1
+            assert len([log for log in logs if log.startswith("Skipped explaining slow query in")]) == 1
+            assert not [log for log in logs if log.startswith("Plan of slow query in")]
+
+            # When: It's slow again while the other connection is free
+            async with engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+                await explainer.drain()
+
+        # Then: It's explained
+        logs = [record.getMessage() for record in caplog.records if record.name == "shout_subgroup.query_metrics"]
+        assert len([log for log in logs if log.startswith("Plan of slow query in")]) == 1
+    finally:
+        await engine.dispose()
@@ -0,0 +1,225 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from shout_subgroup import registration_queue as registration_queue_module, group_chat_listener
+from shout_subgroup.membership_cache import chat_membership_cache
+from shout_subgroup.models import UserModel, GroupChatModel
+from shout_subgroup.profile_fingerprints import profile_fingerprint_cache
+from shout_subgroup.registration_queue import RegistrationQueue, register_users_in_group_chats
+from shout_subgroup.render_cache import rendered_output_cache
+from shout_subgroup.repository import find_all_users_in_group_chat, find_group_chat_by_telegram_group_chat_id, upsert_users
+from test_helpers import create_test_user, create_test_group_chat
+
+
+def create_telegram_chat(telegram_group_chat_id: int, title: str = "Group Chat") -> Mock:
+    telegram_chat = Mock()
+    telegram_chat.id = telegram_group_chat_id
+    telegram_chat.title = title
+    telegram_chat.description = "Test Chatting"
+    return telegram_chat
+
+
+@pytest.fixture
+def use_test_database(db: AsyncSession, monkeypatch):
+    # The queue opens its own transactions, so point it at the test database
+    session_factory = async_sessionmaker(bind=db.bind, expire_on_commit=False)
+    monkeypatch.setattr(registration_queue_module, "get_database", lambda: session_factory)
+
+
+@pytest.mark.asyncio
+async def test_register_users_in_group_chats(db: AsyncSession):
+    # Given: A group chat exists with a user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+
+    # When: We register the existing user, a new user, and a user in a new group chat
+    group_chat_a = GroupChatModel(telegram_group_chat_id=-123456789, name="Group Chat A")
+    group_chat_b = GroupChatModel(telegram_group_chat_id=-987654321, name="Group Chat B")
+    jane = UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    johnny = UserModel(telegram_user_id=12345, username="johnny", first_name="John", last_name="Doe")
+
+    added_count = await register_users_in_group_chats(db, [
+        (group_chat_a, johnny),
+        (group_chat_a, jane),
+        (group_chat_b, jane),
+    ])
+
+    # Then: Only the missing memberships are added
+    assert added_count == 2
+
+    # And: Profiles are updated (the upserts bypass the session, so forget what it loaded)
+    db.expire_all()
+
+    group_chat_a_users = await find_all_users_in_group_chat(db, -123456789)
+    assert {user.username for user in group_chat_a_users} == {"johnny", "janedoe"}
+
+    # And: The new group chat is created
+    created_group_chat = await find_group_chat_by_telegram_group_chat_id(db, -987654321)
+    assert created_group_chat.name == "Group Chat B"
+
+    group_chat_b_users = await find_all_users_in_group_chat(db, -987654321)
+    assert [user.username for user in group_chat_b_users] == ["janedoe"]
+
+
+@pytest.mark.asyncio
+async def test_upsert_users_only_writes_changed_profiles(db: AsyncSession):
+    # Given: Users we already know
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+
+    # When: They're upserted, one with a new username, along with a new user
+    user_ids, changed_telegram_user_ids = await upsert_users(db, [
+        UserModel(telegram_user_id=12345, username="JohnDoe", first_name="John", last_name="Doe"),
+        UserModel(telegram_user_id=67890, username="jane", first_name="Jane", last_name="Doe"),
+        UserModel(telegram_user_id=13579, username="sue", first_name="Sue"),
+    ])
+
+    # Then: Every user has an id
+    assert user_ids[12345] == john.user_id
+    assert user_ids[67890] == jane.user_id
+    assert user_ids[13579] is not None
+
+    # And: Only the known user with a new profile changed
+    assert changed_telegram_user_ids == {67890}
+
+
+@pytest.mark.asyncio
+async def test_registering_known_members_keeps_other_chats_rendered_output(db: AsyncSession):
+    # Given: A group chat exists with a user
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    await db.commit()
+    version = rendered_output_cache.version(-987654321)
+
+    # When: They're registered again with the same profile
+    group_chat_a = GroupChatModel(telegram_group_chat_id=-123456789, name="Group Chat A")
+    same_john = UserModel(telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await register_users_in_group_chats(db, [(group_chat_a, same_john)])
+    await db.commit()
+
+    # Then: Other chats' rendered output is still current
+    assert rendered_output_cache.version(-987654321) == version
+
+    # When: They're registered with a new username
+    new_john = UserModel(telegram_user_id=12345, username="johnny", first_name="John", last_name="Doe")
+    await register_users_in_group_chats(db, [(group_chat_a, new_john)])
+    await db.commit()
+
+    # Then: It's stale everywhere, the user could be in any chat
+    assert rendered_output_cache.version(-987654321) != version
+
+
+@pytest.mark.asyncio
+async def test_enqueue_deduplicates_registrations():
+    # Given: A queue
+    queue = RegistrationQueue()
+    telegram_chat = create_telegram_chat(-123456789)
+
+    # When: The same user is queued many times
+    for username in ["johndoe", "johndoe", "johnny"]:
+        queue.enqueue(telegram_chat, UserModel(telegram_user_id=12345, username=username, first_name="John"))
+
+    # Then: Only one registration is waiting
+    assert len(queue) == 1
+    assert queue.is_pending(-123456789, 12345)
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_pending_registrations(db: AsyncSession, use_test_database):
+    # Given: A running queue that won't flush on its own
+    queue = RegistrationQueue(flush_interval=60)
+    queue.start()
+
+    # And: Users are queued
+    telegram_chat = create_telegram_chat(-123456789)
+    queue.enqueue(telegram_chat, UserModel(telegram_user_id=12345, username="johndoe", first_name="John"))
+    queue.enqueue(telegram_chat, UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane"))
+
+    # When: The queue is stopped
+    await queue.stop()
+
+    # Then: Every user was written
+    assert len(queue) == 0
+    users = await find_all_users_in_group_chat(db, -123456789)
+    assert {user.username for user in users} == {"johndoe", "janedoe"}
+
+    # And: They are cached as members, with the profiles that were written
+    assert chat_membership_cache.contains(-123456789, 12345)
+    assert chat_membership_cache.contains(-123456789, 67890)
+    assert not profile_fingerprint_cache.has_changed(UserModel(telegram_user_id=12345, username="johndoe", first_name="John"))
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed_early(db: AsyncSession, use_test_database):
+    # Given: A running queue with a small batch size that won't flush on its own
+    queue = RegistrationQueue(flush_interval=60, max_batch_size=2)
+    queue.start()
+
+    # When: The batch fills up
+    telegram_chat = create_telegram_chat(-123456789)
+    queue.enqueue(telegram_chat, UserModel(telegram_user_id=12345, username="johndoe", first_name="John"))
+    queue.enqueue(telegram_chat, UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane"))
+
+    # Then: It's written without waiting for the flush interval
+    for _ in range(100):
+        if chat_membership_cache.contains(-123456789, 67890):
+            break
+        await asyncio.sleep(0.01)
+
+    users = await find_all_users_in_group_chat(db, -123456789)
+    assert {user.username for user in users} == {"johndoe", "janedoe"}
+
+    await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_flush_waits_for_the_batch_being_written(db: AsyncSession, use_test_database):
+    # Given: A registration that's being written
+    queue = RegistrationQueue()
+    jane = UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    queue.enqueue(create_telegram_chat(-123456789), jane)
+    writing = asyncio.create_task(queue.flush())
+    await asyncio.sleep(0)
+
+    # Then: It's still pending in its chat, and only there
+    assert queue.has_pending(-123456789)
+    assert not queue.has_pending(-987654321)
+
+    # When: We flush again
+    await queue.flush()
+
+    # Then: The registration was written by the time it returns
+    assert not queue.has_pending(-123456789)
+    assert chat_membership_cache.contains(-123456789, 67890)
+    await writing
+
+
+@pytest.mark.asyncio
+async def test_leaving_while_the_registration_is_written(db: AsyncSession, use_test_database, monkeypatch):
+    # Given: A group chat, and a registration for a new member that's being written
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -123456789, "Group Chat A", [john])
+    await db.commit()
+
+    queue = RegistrationQueue()
+    monkeypatch.setattr(group_chat_listener, "registration_queue", queue)
+    telegram_chat = create_telegram_chat(-123456789, "Group Chat A")
+    jane = UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    queue.enqueue(telegram_chat, jane)
+    writing = asyncio.create_task(queue.flush())
+    await asyncio.sleep(0)
+
+    # When: The member leaves before the write is done
+    leaving = UserModel(telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    await group_chat_listener.remove_user_from_group_chat(db, telegram_chat, leaving)
+    await db.commit()
+    await writing
+
+    # Then: They're not in the group chat, nor in the cache
+    group_chat_users = await find_all_users_in_group_chat(db, -123456789)
+    assert [user.username for user in group_chat_users] == ["johndoe"]
+    assert not chat_membership_cache.contains(-123456789, 67890)
+    assert not queue.is_pending(-123456789, 67890)
@@ -1,5 +1,5 @@
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import SubGroupDoesNotExistsError, UserDoesNotExistsError, NotGroupChatError
 from shout_subgroup.remove_subgroup_members import remove_users_from_existing_subgroup
@@ -7,118 +7,118 @@ from test_helpers import create_test_user, create_test_group_chat, create_test_s
 
 
 @pytest.mark.asyncio
-async def test_remove_users_from_existing_subgroup(db: Session):
+async def test_remove_users_from_existing_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane, betty]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We remove a member from the subgroup
     users_to_remove = {john.user_id}
     subgroup = await remove_users_from_existing_subgroup(db, telegram_group_chat_id, subgroup_name, users_to_remove)
 
     # Then: The subgroup doesn't have the member anymore
-    assert len(subgroup.users) == 2
+    assert len(await subgroup.awaitable_attrs.users) == 2
 
-    actual_usernames = [user.username for user in subgroup.users]
+    actual_usernames = [user.username for user in await subgroup.awaitable_attrs.users]
     expected_subgroup_users = [jane, betty]
     expected_usernames = [user.username for user in expected_subgroup_users]
     assert set(actual_usernames) == set(expected_usernames)
 
 
 @pytest.mark.asyncio
-async def test_remove_a_user_who_is_not_in_the_subgroup(db: Session):
+async def test_remove_a_user_who_is_not_in_the_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [jane, betty]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We remove a member who isn't in the group
     users_to_remove = {john.user_id}
     subgroup = await remove_users_from_existing_subgroup(db, telegram_group_chat_id, subgroup_name, users_to_remove)
 
     # Then: The subgroup is unchanged
-    assert len(subgroup.users) == len(initial_subgroup_users)
+    assert len(await subgroup.awaitable_attrs.users) == len(initial_subgroup_users)
 
-    actual_usernames = [user.username for user in subgroup.users]
+    actual_usernames = [user.username for user in await subgroup.awaitable_attrs.users]
     expected_subgroup_users = [jane, betty]
     expected_usernames = [user.username for user in expected_subgroup_users]
     assert set(actual_usernames) == set(expected_usernames)
 
 
 @pytest.mark.asyncio
-async def test_remove_all_users_from_existing_subgroup(db: Session):
+async def test_remove_all_users_from_existing_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [jane, betty]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We remove all the members
     users_to_remove = {jane.user_id, betty.user_id}
     subgroup = await remove_users_from_existing_subgroup(db, telegram_group_chat_id, subgroup_name, users_to_remove)
 
     # Then: The subgroup is empty
-    assert len(subgroup.users) == 0
+    assert len(await subgroup.awaitable_attrs.users) == 0
 
 
 @pytest.mark.asyncio
-async def test_remove_users_from_existing_subgroup_when_group_is_empty(db: Session):
+async def test_remove_users_from_existing_subgroup_when_group_is_empty(db: AsyncSession):
     # Given: A subgroup exist with members
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    betty = create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    betty = await create_test_user(db, telegram_user_id=87654, username="betty", first_name="Betty", last_name="White")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = []
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We remove a user
     members_to_remove = {jane.user_id, betty.user_id}
     subgroup = await remove_users_from_existing_subgroup(db, telegram_group_chat_id, subgroup_name, members_to_remove)
 
     # Then: The group remains empty
-    assert len(subgroup.users) == 0
+    assert len(await subgroup.awaitable_attrs.users) == 0
 
 
 @pytest.mark.asyncio
-async def test_remove_users_from_existing_subgroup_throws_exception_for_non_group_chat_id(db: Session):
+async def test_remove_users_from_existing_subgroup_throws_exception_for_non_group_chat_id(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We try to remove a user
     user_chat_id = 1234
@@ -130,18 +130,18 @@ async def test_remove_users_from_existing_subgroup_throws_exception_for_non_grou
 
 
 @pytest.mark.asyncio
-async def test_remove_users_from_existing_subgroup_throws_exception_for_non_existent_subgroup(db: Session):
+async def test_remove_users_from_existing_subgroup_throws_exception_for_non_existent_subgroup(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We try to remove a user from a non-existent subgroup
     non_existent_subgroup_name = "Party"
@@ -159,18 +159,18 @@ async def test_remove_users_from_existing_subgroup_throws_exception_for_non_exis
 
 
 @pytest.mark.asyncio
-async def test_remove_users_from_existing_subgroup_throws_exception_for_non_existent_user(db: Session):
+async def test_remove_users_from_existing_subgroup_throws_exception_for_non_existent_user(db: AsyncSession):
     # Given: A subgroup exist with members
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
     initial_subgroup_users = [john, jane]
 
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", initial_subgroup_users)
 
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, initial_subgroup_users)
 
     # When: We try to remove a non-existent user
     non_existent_user_id = {None}
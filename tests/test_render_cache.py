@@ -0,0 +1,206 @@
+from unittest.mock import Mock, AsyncMock
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from conftest import db
+from shout_subgroup import database
+from shout_subgroup.query_metrics import QueryMetrics, instrument_query_timing
+from shout_subgroup.render_cache import RenderedOutputCache, rendered_output_cache, invalidate_chat_on_commit, \
+    invalidate_all_on_commit
+from shout_subgroup.repository import find_shared_render_version
+from shout_subgroup.send_scheduler import send_scheduler
+from shout_subgroup.shout import shout_handler
+from test_helpers import create_test_user, create_test_group_chat, create_test_subgroup
+
+
+class FakeRenderer:
+    def __init__(self):
+        self.render_count = 0
+
+    async def render(self) -> str:
+        self.render_count += 1
+        return f"render {self.render_count}"
+
+
+@pytest.mark.asyncio
+async def test_get_or_render_serves_current_output():
+    # Given: An output was rendered for a chat
+    cache = RenderedOutputCache()
+    renderer = FakeRenderer()
+    assert await cache.get_or_render(-1, ("shout", "devs"), renderer.render) == "render 1"
+
+    # When: It's asked for again
+    output = await cache.get_or_render(-1, ("shout", "devs"), renderer.render)
+
+    # Then: It isn't rendered again
+    assert output == "render 1"
+    assert renderer.render_count == 1
+    assert (cache.hit_count, cache.miss_count) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_bump_makes_outputs_stale():
+    # Given: Outputs rendered for two chats
+    cache = RenderedOutputCache()
+    renderer = FakeRenderer()
+    await cache.get_or_render(-1, ("shout", None), renderer.render)
+    await cache.get_or_render(-2, ("shout", None), renderer.render)
+
+    # When: The first chat changes
+    cache.bump(-1)
+
+    # Then: Only its output is rendered again
+    assert await cache.get_or_render(-1, ("shout", None), renderer.render) == "render 3"
+    assert await cache.get_or_render(-2, ("shout", None), renderer.render) == "render 2"
+
+    # And: A profile change makes everything stale
+    cache.bump_all()
+    assert await cache.get_or_render(-2, ("shout", None), renderer.render) == "render 4"
+
+
+def test_changed_within():
+    # Given: A chat that never changed
+    cache = RenderedOutputCache()
+    assert not cache.changed_within(-1, 5)
+
+    # When: It changes
+    cache.bump(-1)
+
+    # Then: It changed recently, but other chats didn't
+    assert cache.changed_within(-1, 5)
+    assert not cache.changed_within(-2, 5)
+    assert not cache.changed_within(-1, 0)
+
+    # And: A profile change counts for every chat
+    cache.bump_all()
+    assert cache.changed_within(-2, 5)
+
+
+@pytest.mark.asyncio
+async def test_get_or_render_evicts_least_recently_used():
+    # Given: A cache with room for two outputs
+    cache = RenderedOutputCache(max_entries=2)
+    renderer = FakeRenderer()
+    await cache.get_or_render(-1, "a", renderer.render)
+    await cache.get_or_render(-1, "b", renderer.render)
+    await cache.get_or_render(-1, "a", renderer.render)
+
+    # When: A third is rendered
+    await cache.get_or_render(-1, "c", renderer.render)
+
+    # Then: The least recently used one was evicted
+    assert len(cache) == 2
+    assert await cache.get_or_render(-1, "a", renderer.render) == "render 1"
+    assert await cache.get_or_render(-1, "b", renderer.render) == "render 4"
+
+
+@pytest.mark.asyncio
+async def test_get_or_render_does_not_cache_errors():
+    # Given: Rendering fails
+    cache = RenderedOutputCache()
+
+    async def broken_render():
+        raise ValueError("Oops")
+
+    # When: We render
+    with pytest.raises(ValueError):
+        await cache.get_or_render(-1, "a", broken_render)
+
+    # Then: Nothing was cached
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_invalidate_chat_on_commit(db: AsyncSession):
+    # Given: A chat's version
+    version = rendered_output_cache.version(-1)
+
+    # When: A change is rolled back
+    invalidate_chat_on_commit(db, -1)
+    await db.rollback()
+
+    # Then: The version is the same
+    assert rendered_output_cache.version(-1) == version
+
+    # When: A change is committed
+    invalidate_chat_on_commit(db, -1)
+    assert rendered_output_cache.version(-1) == version
+    await db.commit()
+
+    # Then: The version was bumped
+    assert rendered_output_cache.version(-1) != version
+
+
+@pytest.mark.asyncio
+async def test_invalidate_all_on_commit_bumps_the_shared_version(db: AsyncSession, monkeypatch):
+    # Given: Other instances of the bot run
+    monkeypatch.setattr(rendered_output_cache, "is_shared", True)
+
+    # And: Every chat's version
+    version = rendered_output_cache.version(-1)
+    shared_version = await find_shared_render_version(db)
+
+    # When: A profile change is committed
+    await invalidate_all_on_commit(db)
+    await db.commit()
+
+    # Then: Every chat's version changed, here and for the other instances
+    assert rendered_output_cache.version(-1) != version
+    assert await find_shared_render_version(db) == shared_version + 1
+
+
+@pytest.mark.asyncio
+async def test_invalidate_all_on_commit_skips_the_shared_version_for_a_single_instance(db: AsyncSession):
+    # Given: Only this instance of the bot runs, and every chat's version
+    version = rendered_output_cache.version(-1)
+
+    # When: A profile change is committed
+    await invalidate_all_on_commit(db)
+    await db.commit()
+
+    # Then: Every chat's version changed, without writing the shared version nobody reads
+    assert rendered_output_cache.version(-1) != version
+    assert await find_shared_render_version(db) == 0
+
+
+@pytest.mark.asyncio
+async def test_repeated_shouts_do_not_query(db: AsyncSession, monkeypatch):
+    # Given: A subgroup in a group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    group_chat = await create_test_group_chat(db, -123456789, "Group Chat A", [john, jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, "devs", [john])
+
+    monkeypatch.setattr(database, "Session", None)
+    monkeypatch.setattr(database, "ReadOnlySession", None)
+    database.use_engines(db.bind)
+    session_factory = database.get_database()
+    query_metrics = QueryMetrics()
+    instrument_query_timing(db.bind, query_metrics, slow_query_seconds=60)
+
+    update = Mock()
+    update.effective_chat.id = -123456789
+    update.message.reply_text = AsyncMock()
+    context = Mock()
+    context.args = ["devs"]
+
+    # When: The subgroup is shouted twice
+    await shout_handler(update, context)
+    queries_for_first_shout = sum(query_metrics.query_counts.values())
+    await shout_handler(update, context)
+    await send_scheduler.drain()
+
+    # Then: The second shout didn't query anything
+    assert queries_for_first_shout > 0
+    assert sum(query_metrics.query_counts.values()) == queries_for_first_shout
+    assert update.message.reply_text.call_count == 2
+    assert update.message.reply_text.call_args_list[0] == update.message.reply_text.call_args_list[1]
+
+    # When: The chat changes
+    async with session_factory.begin() as session:
+        invalidate_chat_on_commit(session, -123456789)
+    await shout_handler(update, context)
+
+    # Then: The shout is rendered again
+    assert sum(query_metrics.query_counts.values()) == 2 * queries_for_first_shout
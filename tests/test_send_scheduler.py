@@ -0,0 +1,231 @@
+import asyncio
+import time
+from unittest.mock import Mock, AsyncMock, call
+
+import pytest
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from fake_bot_api import FakeBotApiRequest
+from shout_subgroup.exceptions import SendSchedulerStoppedError
+from shout_subgroup.send_scheduler import SendScheduler, Priority, TokenBucket, defer_replies, send_scheduler
+
+
+async def create_test_bot(request: FakeBotApiRequest) -> Bot:
+    bot = Bot("123:test", request=request, get_updates_request=FakeBotApiRequest())
+    await bot.initialize()
+    return bot
+
+
+def test_token_bucket_allows_bursts_then_refills():
+    # Given: A bucket that allows 2 sends a second, in bursts of 2
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = 100.0
+    bucket._updated_at = now
+
+    # When: We use up the burst
+    bucket.take(now)
+    bucket.take(now)
+
+    # Then: We wait for a token to refill
+    assert bucket.wait_time(now) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 0.5) == 0
+
+    # And: Being blocked wins over a full bucket
+    bucket.block_until(now + 10)
+    assert bucket.wait_time(now + 5) == pytest.approx(5)
+
+
+@pytest.mark.asyncio
+async def test_send_sends_acknowledgements_before_shouts():
+    # Given: A scheduler that allows one message at a time
+    scheduler = SendScheduler(chat_rate=50, chat_burst=1, global_rate=50, global_burst=1)
+    sent = []
+
+    async def send(text):
+        sent.append(text)
+
+    # When: A long shout is queued before a reply to a command
+    shouts = [
+        asyncio.create_task(scheduler.send(-1, lambda text=text: send(text), Priority.SHOUT))
+        for text in ["shout 1", "shout 2", "shout 3"]
+    ]
+    acknowledgement = asyncio.create_task(scheduler.send(-2, lambda: send("ack"), Priority.ACKNOWLEDGEMENT))
+
+    await asyncio.gather(*shouts, acknowledgement)
+    await scheduler.stop()
+
+    # Then: The reply jumped ahead of the shout
+    assert sent == ["ack", "shout 1", "shout 2", "shout 3"]
+    assert scheduler.queue_depth() == 0
+    assert scheduler.metrics.sent_count == 4
+    assert scheduler.metrics.latency_percentile(50) is not None
+
+
+@pytest.mark.asyncio
+async def test_send_retries_after_flood_limit():
+    # Given: Telegram asks us to back off once
+    request = FakeBotApiRequest(flood_count=1)
+    bot = await create_test_bot(request)
+    scheduler = SendScheduler()
+
+    # When: We send a couple of messages
+    for text in ["one", "two"]:
+        await scheduler.send(-123, lambda text=text: bot.send_message(-123, text))
+    await scheduler.stop()
+
+    # Then: Nothing was lost, and the retries were counted
+    assert [message["text"] for message in request.sent_messages] == ["one", "two"]
+    assert scheduler.metrics.retry_count == 1
+    assert scheduler.metrics.sent_count == 2
+
+
+@pytest.mark.asyncio
+async def test_send_gives_up_after_max_retries():
+    # Given: Telegram keeps asking us to back off
+    request = FakeBotApiRequest(flood_count=10)
+    bot = await create_test_bot(request)
+    scheduler = SendScheduler(max_retries=0)
+
+    # When: We send a message
+    # Then: The error is raised
+    with pytest.raises(RetryAfter):
+        await scheduler.send(-123, lambda: bot.send_message(-123, "one"))
+    await scheduler.stop()
+
+    assert request.sent_messages == []
+    assert scheduler.metrics.failed_count == 1
+
+
+@pytest.mark.asyncio
+async def test_flood_limit_pauses_every_chat():
+    # Given: Telegram asks us to back off when we send to one chat
+    scheduler = SendScheduler(chat_rate=1000, chat_burst=1000, global_rate=1000, global_burst=1000)
+    sent = []
+    flood_count = 1
+
+    async def send(text):
+        nonlocal flood_count
+        if flood_count > 0:
+            flood_count -= 1
+            raise RetryAfter(0.2)
+        sent.append((text, time.monotonic()))
+
+    started_at = time.monotonic()
+    flooded = asyncio.create_task(scheduler.send(-1, lambda: send("flooded")))
+    await asyncio.sleep(0.01)
+
+    # When: Another chat sends a message while we back off
+    await asyncio.gather(flooded, scheduler.send(-2, lambda: send("other chat")))
+    await scheduler.stop()
+
+    # Then: It waited too
+    assert {text for text, _ in sent} == {"flooded", "other chat"}
+    assert all(sent_at - started_at >= 0.2 for _, sent_at in sent)
+
+
+@pytest.mark.asyncio
+async def test_chats_take_turns():
+    # Given: A scheduler that sends one message at a time
+    scheduler = SendScheduler(chat_rate=1000, chat_burst=1000, global_rate=100, global_burst=1)
+    sent = []
+
+    async def send(text):
+        sent.append(text)
+
+    # When: A long shout is queued in one chat, then a short one in another
+    shouts = [
+        asyncio.create_task(scheduler.send(telegram_chat_id, lambda text=text: send(text), Priority.SHOUT))
+        for telegram_chat_id, texts in [(-1, ["a1", "a2", "a3", "a4"]), (-2, ["b1", "b2"])]
+        for text in texts
+    ]
+    await asyncio.gather(*shouts)
+    await scheduler.stop()
+
+    # Then: The chats took turns, each in order
+    assert sent == ["a1", "b1", "a2", "b2", "a3", "a4"]
+
+
+@pytest.mark.asyncio
+async def test_stop_fails_queued_sends():
+    # Given: Messages waiting for their chat's bucket
+    scheduler = SendScheduler(chat_rate=0.1, chat_burst=1)
+    sent = []
+
+    async def send(text):
+        sent.append(text)
+
+    first = asyncio.create_task(scheduler.send(-1, lambda: send("first")))
+    waiting = asyncio.create_task(scheduler.send(-1, lambda: send("waiting")))
+    await first
+
+    # When: The scheduler stops
+    await scheduler.stop()
+
+    # Then: Whoever waits on the queued message doesn't wait forever
+    with pytest.raises(SendSchedulerStoppedError):
+        await asyncio.wait_for(waiting, timeout=1)
+    assert sent == ["first"]
+    assert scheduler.queue_depth() == 0
+
+
+@pytest.mark.asyncio
+async def test_defer_replies_sends_once_the_block_is_done():
+    # Given: A command's update
+    update = Mock()
+    update.effective_chat.id = -123
+    update.message.reply_text = AsyncMock()
+
+    # When: Replies are added in a block
+    async with defer_replies(update) as replies:
+        replies.add("Subgroup was created", parse_mode="markdown")
+        replies.add("Another reply")
+
+        # Then: Nothing is sent until it's done
+        update.message.reply_text.assert_not_called()
+
+    # And: Then they're sent in order, in the background
+    await send_scheduler.drain()
+    assert update.message.reply_text.call_args_list == [
+        call("Subgroup was created", parse_mode="markdown"),
+        call("Another reply"),
+    ]
+
+    # When: A block raises, e.g. its transaction couldn't be committed
+    with pytest.raises(RuntimeError):
+        async with defer_replies(update) as replies:
+            replies.add("Subgroup was deleted")
+            raise RuntimeError("Commit failed")
+
+    # Then: Its replies aren't sent
+    await send_scheduler.drain()
+    assert update.message.reply_text.call_count == 2
+    await send_scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_defer_replies_does_not_wait_for_the_send():
+    # Given: A chat whose replies are stuck, e.g. waiting out a flood limit
+    update = Mock()
+    update.effective_chat.id = -456
+    unblocked = asyncio.Event()
+
+    async def stuck_reply_text(text, **kwargs):
+        await unblocked.wait()
+
+    update.message.reply_text = AsyncMock(side_effect=stuck_reply_text)
+
+    # When: A handler replies
+    async def handler():
+        async with defer_replies(update) as replies:
+            replies.add("Subgroup was created")
+
+    # Then: It's done without waiting for the reply to be sent,
+    # so the chat's next update isn't held up
+    await asyncio.wait_for(handler(), timeout=1)
+
+    # And: The reply is still sent
+    unblocked.set()
+    await send_scheduler.drain()
+    update.message.reply_text.assert_called_once_with("Subgroup was created")
+    await send_scheduler.stop()
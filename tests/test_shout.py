@@ -1,123 +1,128 @@
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from conftest import db
 from shout_subgroup.exceptions import NotGroupChatError, GroupChatDoesNotExistError
-from shout_subgroup.shout import shout_all_members, shout_subgroup_members
+from shout_subgroup.models import UserModel
+from shout_subgroup.repository import find_group_chat_by_telegram_group_chat_id, find_all_users_in_subgroup_expression
+from shout_subgroup.shout import shout_all_members, shout_subgroup_members, create_messages_to_mention_members, \
+    utf16_length
+from shout_subgroup.subgroup_expression import parse_subgroup_expression
 from test_helpers import create_test_user, create_test_subgroup, create_test_group_chat
 
 
 @pytest.mark.asyncio
-async def test_shout_all_members(db: Session):
+async def test_shout_all_members(db: AsyncSession):
     # Given: A group chat already exists with users
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # When: We shout all group members
-    message = await shout_all_members(db, group_chat.telegram_group_chat_id)
+    messages = await shout_all_members(db, group_chat.telegram_group_chat_id)
 
     # Then: It mentions them
-    assert message == "@johndoe @janedoe "
+    assert messages == ["@johndoe @janedoe "]
 
 
 @pytest.mark.asyncio
-async def test_shout_all_members_if_members_have_special_chars_in_username(db: Session):
+async def test_shout_all_members_if_members_have_special_chars_in_username(db: AsyncSession):
     # Given: A group chat already exists with users that have special characters in their usernames
-    john = create_test_user(db, telegram_user_id=12345, username="john*doe", first_name="John", last_name="Doe")
-    dawn = create_test_user(db, telegram_user_id=67890, username="dawn_sun", first_name="Dawn", last_name="Sun")
+    john = await create_test_user(db, telegram_user_id=12345, username="john*doe", first_name="John", last_name="Doe")
+    dawn = await create_test_user(db, telegram_user_id=67890, username="dawn_sun", first_name="Dawn", last_name="Sun")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, dawn])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, dawn])
 
     # When: We shout all group members
-    message = await shout_all_members(db, group_chat.telegram_group_chat_id)
+    messages = await shout_all_members(db, group_chat.telegram_group_chat_id)
 
     # Then: It mentions them
-    assert message == "@john\\*doe @dawn\\_sun "
+    assert messages == ["@john\\*doe @dawn\\_sun "]
 
 
 @pytest.mark.asyncio
-async def test_shout_all_members_handles_no_registered_members(db: Session):
+async def test_shout_all_members_handles_no_registered_members(db: AsyncSession):
     # Given: A group chat exists, but there are no members in it
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [])
 
     # When: We shout all group members
-    message = await shout_all_members(db, group_chat.telegram_group_chat_id)
+    messages = await shout_all_members(db, group_chat.telegram_group_chat_id)
 
     # Then: It mentions them
-    assert message == "I don't know any members in this chat. If you want me to register someone ask them to send a message."
+    assert messages == ["I don't know any members in this chat. If you want me to register someone ask them to send a message."]
 
 
 @pytest.mark.asyncio
-async def test_shout_subgroup_members(db: Session):
+async def test_shout_subgroup_members(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # And: the group chat has a subgroup with members
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [john])
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [john])
 
     # When: We shout all subgroup members
-    message = await shout_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
+    messages = await shout_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
 
     # Then: It mentions them
-    assert message == "@johndoe "
+    assert messages == ["@johndoe "]
 
 
 @pytest.mark.asyncio
-async def test_shout_subgroup_members_only_mentions_members_for_group_chat(db: Session):
+async def test_shout_subgroup_members_only_mentions_members_for_group_chat(db: AsyncSession):
     # Given: A multiple group chats already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
-    sue = create_test_user(db, telegram_user_id=54321, username="suedoe", first_name="Sue", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    sue = await create_test_user(db, telegram_user_id=54321, username="suedoe", first_name="Sue", last_name="Doe")
 
     telegram_group_chat_a_id = -123456789
-    group_chat_a = create_test_group_chat(db, telegram_group_chat_a_id, "Group Chat A", [john, jane])
+    group_chat_a = await create_test_group_chat(db, telegram_group_chat_a_id, "Group Chat A", [john, jane])
     telegram_group_chat_b_id = -987654321
-    group_chat_b = create_test_group_chat(db, telegram_group_chat_b_id, "Group Chat B", [jane, sue])
+    group_chat_b = await create_test_group_chat(db, telegram_group_chat_b_id, "Group Chat B", [jane, sue])
 
     # And: The group chats have a subgroup each with the same name
     subgroup_name = "Party"
-    create_test_subgroup(db, group_chat_a.group_chat_id, subgroup_name, [john])
-    create_test_subgroup(db, group_chat_b.group_chat_id, subgroup_name, [sue])
+    await create_test_subgroup(db, group_chat_a.group_chat_id, subgroup_name, [john])
+    await create_test_subgroup(db, group_chat_b.group_chat_id, subgroup_name, [sue])
 
     # When: We shout all subgroup members for a group chat
-    message = await shout_subgroup_members(db, group_chat_a.telegram_group_chat_id, subgroup_name)
+    messages = await shout_subgroup_members(db, group_chat_a.telegram_group_chat_id, subgroup_name)
 
     # Then: It mentions them
-    assert message == "@johndoe "
+    assert messages == ["@johndoe "]
 
 
 @pytest.mark.asyncio
-async def test_shout_subgroup_members_handles_no_subgroup_members(db: Session):
+async def test_shout_subgroup_members_handles_no_subgroup_members(db: AsyncSession):
     # Given: A group chat already exists
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
-    jane = create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
 
     telegram_group_chat_id = -123456789
-    group_chat = create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
 
     # And: the group chat has a subgroup without any members
     subgroup_name = "Archery"
-    create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [])
+    await create_test_subgroup(db, group_chat.group_chat_id, subgroup_name, [])
 
     # When: We shout all subgroup members
-    message = await shout_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
+    messages = await shout_subgroup_members(db, group_chat.telegram_group_chat_id, subgroup_name)
 
     # Then: It mentions them
-    assert message == "'Archery' subgroup has no members, use /group to add members."
+    assert messages == ["'Archery' subgroup has no members, use /group to add members."]
 
 
 @pytest.mark.asyncio
-async def test_shout_subgroup_members_throws_not_group_chat_exception(db: Session):
+async def test_shout_subgroup_members_throws_not_group_chat_exception(db: AsyncSession):
     # Given: The telegram chat is not a group chat
     user_chat_id = 123
 
@@ -130,7 +135,7 @@ async def test_shout_subgroup_members_throws_not_group_chat_exception(db: Sessio
 
 
 @pytest.mark.asyncio
-async def test_shout_subgroup_members_throws_group_chat_does_not_exist_exception(db: Session):
+async def test_shout_subgroup_members_throws_group_chat_does_not_exist_exception(db: AsyncSession):
     # Given: The group chat does not exist
     non_existent_group_chat = -123
 
@@ -140,3 +145,141 @@ async def test_shout_subgroup_members_throws_group_chat_does_not_exist_exception
         await shout_subgroup_members(db, non_existent_group_chat, "Archery")
 
     assert str(non_existent_group_chat) in ex.value.message
+
+
+def test_create_messages_to_mention_members_splits_long_messages():
+    # Given: More members than fit in one message
+    members = [
+        UserModel(telegram_user_id=telegram_user_id, username=f"user{telegram_user_id}", first_name="User")
+        for telegram_user_id in range(1000, 1010)
+    ]
+
+    # When: We create the messages, with room for 3 mentions per message
+    messages = create_messages_to_mention_members(members, max_message_length=len("@user1000 ") * 3)
+
+    # Then: The mentions are split across messages without being cut
+    assert messages == [
+        "@user1000 @user1001 @user1002 ",
+        "@user1003 @user1004 @user1005 ",
+        "@user1006 @user1007 @user1008 ",
+        "@user1009 ",
+    ]
+
+
+def test_create_messages_to_mention_members_measures_escaped_utf16_length():
+    # Given: Members without usernames, whose names have emoji and markdown characters
+    members = [
+        UserModel(telegram_user_id=12345, username=None, first_name="John 🎯"),
+        UserModel(telegram_user_id=67890, username="jane_doe", first_name="Jane"),
+    ]
+
+    # When: We create the messages, with room for the first mention only
+    first_mention = "\\[John 🎯](tg://user?id=12345) "
+    messages = create_messages_to_mention_members(members, max_message_length=utf16_length(first_mention))
+
+    # Then: The emoji counts as 2, and the escape characters are counted
+    assert utf16_length(first_mention) == len(first_mention) + 1
+    assert messages == [first_mention, "@jane\\_doe "]
+
+
+async def create_test_subgroups_for_expressions(db: AsyncSession) -> int:
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username="janedoe", first_name="Jane", last_name="Doe")
+    sue = await create_test_user(db, telegram_user_id=13579, username="sue", first_name="Sue", last_name="Smith")
+
+    telegram_group_chat_id = -123456789
+    group_chat = await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane, sue])
+    await create_test_subgroup(db, group_chat.group_chat_id, "devs", [john, jane])
+    await create_test_subgroup(db, group_chat.group_chat_id, "ops", [jane, sue])
+    await create_test_subgroup(db, group_chat.group_chat_id, "managers", [jane])
+    return telegram_group_chat_id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("expression, expected_messages", [
+    ("devs+ops", ["@johndoe @sue @janedoe "]),
+    ("devs&ops", ["@janedoe "]),
+    ("devs-managers", ["@johndoe "]),
+    # Applied left to right
+    ("devs+ops-managers", ["@johndoe @sue "]),
+    ("devs-managers+ops", ["@johndoe @sue @janedoe "]),
+])
+async def test_shout_subgroup_expression(db: AsyncSession, expression, expected_messages):
+    # Given: A group chat with subgroups that share members
+    telegram_group_chat_id = await create_test_subgroups_for_expressions(db)
+
+    # When: We shout an expression over the subgroups
+    messages = await shout_subgroup_members(db, telegram_group_chat_id, expression)
+
+    # Then: Everyone in the result is mentioned once
+    assert messages == expected_messages
+
+
+@pytest.mark.asyncio
+async def test_shout_subgroup_expression_with_unknown_subgroups(db: AsyncSession):
+    # Given: A group chat with subgroups
+    telegram_group_chat_id = await create_test_subgroups_for_expressions(db)
+
+    # When: We shout an expression with a typo in it
+    messages = await shout_subgroup_members(db, telegram_group_chat_id, "devs-managrs+opz")
+
+    # Then: Nobody is shouted, and we're told which subgroups don't exist
+    assert messages == ["Didn't shout 'devs-managrs+opz', these subgroups don't exist: 'managrs', 'opz'. "
+                        "Put names with +, & or - in them in quotes, e.g. devs+\"on-call\"."]
+
+
+@pytest.mark.asyncio
+async def test_shout_subgroup_expression_with_a_hyphenated_subgroup(db: AsyncSession):
+    # Given: A subgroup with a hyphen in its name
+    telegram_group_chat_id = await create_test_subgroups_for_expressions(db)
+    group_chat = await find_group_chat_by_telegram_group_chat_id(db, telegram_group_chat_id)
+    bob = await create_test_user(db, telegram_user_id=24680, username="bob", first_name="Bob", last_name="Brown")
+    await create_test_subgroup(db, group_chat.group_chat_id, "on-call", [bob])
+
+    # When: We shout an expression with it quoted
+    messages = await shout_subgroup_members(db, telegram_group_chat_id, 'devs+"on-call"')
+
+    # Then: The hyphenated subgroup is one operand
+    assert messages == ["@johndoe @bob @janedoe "]
+
+
+@pytest.mark.asyncio
+async def test_shout_subgroup_expression_runs_a_single_query(db: AsyncSession):
+    # Given: A group chat with subgroups
+    telegram_group_chat_id = await create_test_subgroups_for_expressions(db)
+    group_chat = await find_group_chat_by_telegram_group_chat_id(db, telegram_group_chat_id)
+
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.bind.sync_engine, "before_cursor_execute", record_statement)
+    try:
+        # When: We find the members of an expression
+        members = await find_all_users_in_subgroup_expression(
+            db,
+            group_chat.group_chat_id,
+            parse_subgroup_expression("devs+ops-managers")
+        )
+    finally:
+        event.remove(db.bind.sync_engine, "before_cursor_execute", record_statement)
+
+    # Then: They were found with one statement
+    assert {member.username for member in members} == {"johndoe", "sue"}
+    assert len(statements) == 1
+
+
+@pytest.mark.asyncio
+async def test_shout_subgroup_named_like_an_expression(db: AsyncSession):
+    # Given: A subgroup with a dash in its name, and subgroups named like its parts
+    telegram_group_chat_id = await create_test_subgroups_for_expressions(db)
+    group_chat = await find_group_chat_by_telegram_group_chat_id(db, telegram_group_chat_id)
+    bob = await create_test_user(db, telegram_user_id=24680, username="bob", first_name="Bob", last_name="Brown")
+    await create_test_subgroup(db, group_chat.group_chat_id, "devs-ops", [bob])
+
+    # When: We shout it
+    messages = await shout_subgroup_members(db, telegram_group_chat_id, "devs-ops")
+
+    # Then: The subgroup wins over the expression
+    assert messages == ["@bob "]
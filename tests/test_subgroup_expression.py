@@ -0,0 +1,29 @@
+import pytest
+
+from shout_subgroup.subgroup_expression import parse_subgroup_expression, SubgroupExpression
+
+
+@pytest.mark.parametrize("text, expected_expression", [
+    ("devs", SubgroupExpression("devs", "devs")),
+    ("devs+ops", SubgroupExpression("devs+ops", "devs", (("+", "ops"),))),
+    ("devs&oncall", SubgroupExpression("devs&oncall", "devs", (("&", "oncall"),))),
+    ("devs-managers", SubgroupExpression("devs-managers", "devs", (("-", "managers"),))),
+    ("devs+ops-managers", SubgroupExpression("devs+ops-managers", "devs", (("+", "ops"), ("-", "managers")))),
+    # Quoted names can have operators in them
+    ('devs+"on-call"', SubgroupExpression('devs+"on-call"', "devs", (("+", "on-call"),))),
+    ('"on-call"-devs', SubgroupExpression('"on-call"-devs', "on-call", (("-", "devs"),))),
+    ('"on-call"', SubgroupExpression('"on-call"', "on-call")),
+    # Not expressions, so they're subgroup names
+    ("-devs", SubgroupExpression("-devs", "-devs")),
+    ("devs+", SubgroupExpression("devs+", "devs+")),
+    ("devs+-ops", SubgroupExpression("devs+-ops", "devs+-ops")),
+    ('devs+"on-call', SubgroupExpression('devs+"on-call', 'devs+"on-call')),
+    ('devs+""', SubgroupExpression('devs+""', 'devs+""')),
+    ('devs"ops"', SubgroupExpression('devs"ops"', 'devs"ops"')),
+])
+def test_parse_subgroup_expression(text, expected_expression):
+    # When: We parse the argument of /shout
+    expression = parse_subgroup_expression(text)
+
+    # Then: The subgroups and operations are found
+    assert expression == expected_expression
@@ -0,0 +1,169 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Update, Message, Chat
+
+from shout_subgroup.update_processor import ChatOrderedUpdateProcessor, load_update_processor, \
+    DEFAULT_MAX_CONCURRENT_UPDATES
+
+
+def create_update(update_id: int, telegram_chat_id: int) -> Update:
+    chat = Chat(id=telegram_chat_id, type=Chat.SUPERGROUP)
+    return Update(update_id=update_id, message=Message(message_id=update_id, date=datetime.now(), chat=chat))
+
+
+class FakeHandlers:
+    """
+    Records when each update starts and finishes. Updates wait for their gate before finishing.
+    """
+
+    def __init__(self):
+        self.events: list[tuple[str, int]] = []
+        self.gates: dict[int, asyncio.Event] = {}
+
+    def gate(self, update_id: int) -> asyncio.Event:
+        return self.gates.setdefault(update_id, asyncio.Event())
+
+    async def process(self, update_id: int) -> None:
+        self.events.append(("start", update_id))
+        await self.gate(update_id).wait()
+        self.events.append(("end", update_id))
+
+
+def start_processing(processor: ChatOrderedUpdateProcessor, handlers: FakeHandlers, update: Update) -> asyncio.Task:
+    # Like the application, every update is processed in its own task, in the order they arrive
+    return asyncio.create_task(processor.process_update(update, handlers.process(update.update_id)))
+
+
+@pytest.mark.asyncio
+async def test_updates_from_the_same_chat_are_processed_in_order():
+    # Given: Three updates from the same chat
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=10)
+    handlers = FakeHandlers()
+    tasks = [start_processing(processor, handlers, create_update(update_id, -1)) for update_id in (1, 2, 3)]
+    await asyncio.sleep(0)
+
+    # When: The first one is slow
+    # Then: The others wait for it
+    assert handlers.events == [("start", 1)]
+
+    # And: They run one after another, in order, once it's done
+    for update_id in (3, 2, 1):
+        handlers.gate(update_id).set()
+    await asyncio.gather(*tasks)
+    assert handlers.events == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+
+
+@pytest.mark.asyncio
+async def test_updates_from_different_chats_are_processed_concurrently():
+    # Given: A slow update in one chat
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=10)
+    handlers = FakeHandlers()
+    slow = start_processing(processor, handlers, create_update(1, -1))
+    await asyncio.sleep(0)
+
+    # When: Another chat sends an update
+    handlers.gate(2).set()
+    await start_processing(processor, handlers, create_update(2, -2))
+
+    # Then: It doesn't wait for the slow one
+    assert handlers.events == [("start", 1), ("start", 2), ("end", 2)]
+
+    handlers.gate(1).set()
+    await slow
+
+
+@pytest.mark.asyncio
+async def test_updates_waiting_on_a_busy_chat_dont_use_up_the_limit():
+    # Given: A chat with a slow update, and more updates waiting behind it than the limit allows
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2)
+    handlers = FakeHandlers()
+    busy = [start_processing(processor, handlers, create_update(update_id, -1)) for update_id in (1, 2, 3)]
+    await asyncio.sleep(0)
+
+    # When: Another chat sends an update
+    handlers.gate(4).set()
+    await asyncio.wait_for(start_processing(processor, handlers, create_update(4, -2)), timeout=1)
+
+    # Then: It's processed while the busy chat is still blocked
+    assert handlers.events == [("start", 1), ("start", 4), ("end", 4)]
+
+    for update_id in (1, 2, 3):
+        handlers.gate(update_id).set()
+    await asyncio.gather(*busy)
+
+
+@pytest.mark.asyncio
+async def test_the_limit_still_applies_across_chats():
+    # Given: A limit of one update at a time, and a slow update in one chat
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=1)
+    handlers = FakeHandlers()
+    slow = start_processing(processor, handlers, create_update(1, -1))
+    await asyncio.sleep(0)
+
+    # When: Another chat sends an update
+    handlers.gate(2).set()
+    other = start_processing(processor, handlers, create_update(2, -2))
+    await asyncio.sleep(0)
+
+    # Then: It waits for a free slot
+    assert handlers.events == [("start", 1)]
+
+    handlers.gate(1).set()
+    await asyncio.gather(slow, other)
+    assert handlers.events == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+
+
+@pytest.mark.asyncio
+async def test_chat_locks_are_dropped_once_idle():
+    # Given: Updates from a few chats
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=10)
+    handlers = FakeHandlers()
+    for update_id in range(5):
+        handlers.gate(update_id).set()
+
+    # When: They're all processed
+    await asyncio.gather(*(
+        start_processing(processor, handlers, create_update(update_id, -(update_id % 2))) for update_id in range(5)
+    ))
+
+    # Then: No lock is kept around
+    assert processor._chat_locks == {}
+    assert processor._chat_update_counts == {}
+
+
+@pytest.mark.asyncio
+async def test_updates_without_a_chat_are_processed_right_away():
+    # Given: A processor
+    processor = ChatOrderedUpdateProcessor(max_concurrent_updates=10)
+    processed = []
+
+    async def process() -> None:
+        processed.append("update")
+
+    # When: An update doesn't come from a chat
+    await processor.process_update(Update(update_id=1), process())
+
+    # Then: It's processed
+    assert processed == ["update"]
+
+
+def test_load_update_processor(monkeypatch):
+    # Given: No limit is set, and a single instance
+    monkeypatch.delenv('CONCURRENT_UPDATES', raising=False)
+    monkeypatch.delenv('MULTI_INSTANCE', raising=False)
+
+    # Then: The default is used
+    processor = load_update_processor()
+    assert processor.max_concurrent_updates == DEFAULT_MAX_CONCURRENT_UPDATES
+    assert processor.coordinator is None
+
+    # And: A limit can be set
+    monkeypatch.setenv('CONCURRENT_UPDATES', '1')
+    assert load_update_processor().max_concurrent_updates == 1
+
+    # But: It must be positive
+    monkeypatch.setenv('CONCURRENT_UPDATES', '-1')
+    with pytest.raises(ValueError):
+        load_update_processor()
@@ -1,13 +1,16 @@
 from unittest.mock import Mock
 
 import pytest
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from shout_subgroup.exceptions import UserDoesNotExistsError
+from shout_subgroup.models import UserModel
+from shout_subgroup.repository import upsert_user
 from shout_subgroup.utils import (is_group_chat, replace_me_mentions, get_user_id_from_mention,
                                   UserIdMentionMapping, get_mention_from_user_id_mention_mappings,
-                                  create_mention_from_user_id)
-from test_helpers import create_test_user
+                                  create_mention_from_user_id, get_user_ids_from_mentions)
+from test_helpers import create_test_user, create_test_group_chat
 
 
 @pytest.mark.asyncio
@@ -46,65 +49,144 @@ async def test_replace_me_mentions(usernames, expected_result):
 
 
 @pytest.mark.asyncio
-async def test_get_user_id_from_mention_with_username(db: Session):
-    # Given: A users exist within our system
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+async def test_get_user_id_from_mention_with_username(db: AsyncSession):
+    # Given: A user exists within a group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
 
-    # And: We mention them by username
-    mention = "@johndoe"
+    # And: We mention them by username, in a different case than Telegram gave us
+    mention = "@JohnDoe"
 
     # When: We convert from their mention text to their id
-    result = await get_user_id_from_mention(db, mention)
+    result = await get_user_id_from_mention(db, telegram_group_chat_id, mention)
 
     # Then: The correct user_id is found
     assert result == UserIdMentionMapping(mention=mention, user_id=john.user_id)
 
 
 @pytest.mark.asyncio
-async def test_get_user_id_from_mention_with_username_non_existent_user(db: Session):
-    # Given: A users exist within our system
-    john = create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+async def test_get_user_id_from_mention_with_username_non_existent_user(db: AsyncSession):
+    # Given: A user exists within a group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john])
 
-    # And: We mention them by username
+    # And: We mention someone else by username
     mention = "@sue"
 
     # When: We convert from their mention text to their id
-    result = await get_user_id_from_mention(db, mention)
+    result = await get_user_id_from_mention(db, telegram_group_chat_id, mention)
 
     # Then: The no user_id is found
     assert result == UserIdMentionMapping(mention=mention, user_id=None)
 
 
 @pytest.mark.asyncio
-async def test_get_user_id_from_mention_with_markdown(db: Session):
-    # Given: A users exist within our system
-    jane = create_test_user(db, telegram_user_id=12345, username=None, first_name="Jane", last_name="Doe")
+async def test_get_user_id_from_mention_with_markdown(db: AsyncSession):
+    # Given: A user without a username exists within a group chat
+    jane = await create_test_user(db, telegram_user_id=12345, username=None, first_name="Jane", last_name="Doe")
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [jane])
 
-    # And: We mention them by username
+    # And: We mention them by markdown
     mention = "[Jane](tg://user?id=12345)"
 
     # When: We convert from their mention text to their id
-    result = await get_user_id_from_mention(db, mention)
+    result = await get_user_id_from_mention(db, telegram_group_chat_id, mention)
 
     # Then: The correct user_id is found
     assert result == UserIdMentionMapping(mention=mention, user_id=jane.user_id)
 
 
 @pytest.mark.asyncio
-async def test_get_user_id_from_mention_with_markdown_non_existent_user(db: Session):
-    # Given: A users exist within our system
-    create_test_user(db, telegram_user_id=12345, username=None, first_name="Jane", last_name="Doe")
+async def test_get_user_id_from_mention_with_markdown_non_existent_user(db: AsyncSession):
+    # Given: A user without a username exists within a group chat
+    jane = await create_test_user(db, telegram_user_id=12345, username=None, first_name="Jane", last_name="Doe")
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [jane])
 
-    # And: We mention them by username
+    # And: We mention someone else by markdown
     mention = "[Jane](tg://user?id=98765)"
 
     # When: We convert from their mention text to their id
-    result = await get_user_id_from_mention(db, mention)
+    result = await get_user_id_from_mention(db, telegram_group_chat_id, mention)
 
-    # Then: The correct user_id is found
+    # Then: No user_id is found
     assert result == UserIdMentionMapping(mention=mention, user_id=None)
 
 
+@pytest.mark.asyncio
+async def test_get_user_id_from_mention_only_finds_users_in_group_chat(db: AsyncSession):
+    # Given: A user exists in another group chat
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    await create_test_group_chat(db, -987654321, "Group Chat B", [john])
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat A", [])
+
+    # When: We mention them in a group chat they aren't in
+    result = await get_user_id_from_mention(db, telegram_group_chat_id, "@johndoe")
+
+    # Then: They aren't found
+    assert result == UserIdMentionMapping(mention="@johndoe", user_id=None)
+
+
+@pytest.mark.asyncio
+async def test_usernames_are_stored_in_lower_case(db: AsyncSession):
+    # When: A user with a mixed case username is upserted
+    user, _ = await upsert_user(db, telegram_user_id=12345, username="JohnDoe", first_name="John", last_name="Doe")
+    await db.commit()
+
+    # Then: Their username is stored in lower case
+    stored_username = await db.scalar(select(UserModel.username).where(UserModel.user_id == user.user_id))
+    assert stored_username == "johndoe"
+
+
+@pytest.mark.asyncio
+async def test_get_user_ids_from_mentions(db: AsyncSession):
+    # Given: Users exist within a group chat, with and without usernames
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username=None, first_name="Jane", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat", [john, jane])
+
+    # And: We mention them, and some users we don't know
+    mentions = {"@JohnDoe", "[Jane](tg://user?id=67890)", "@sue", "[Sam](tg://user?id=98765)"}
+
+    # When: We convert from their mention texts to their ids
+    result = await get_user_ids_from_mentions(db, telegram_group_chat_id, mentions)
+
+    # Then: The correct user_ids are found
+    assert result == {
+        UserIdMentionMapping(mention="@JohnDoe", user_id=john.user_id),
+        UserIdMentionMapping(mention="[Jane](tg://user?id=67890)", user_id=jane.user_id),
+        UserIdMentionMapping(mention="@sue", user_id=None),
+        UserIdMentionMapping(mention="[Sam](tg://user?id=98765)", user_id=None),
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_user_ids_from_mentions_only_finds_users_in_group_chat(db: AsyncSession):
+    # Given: Users exist in different group chats
+    john = await create_test_user(db, telegram_user_id=12345, username="johndoe", first_name="John", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=67890, username=None, first_name="Jane", last_name="Doe")
+
+    telegram_group_chat_id = -123456789
+    await create_test_group_chat(db, telegram_group_chat_id, "Group Chat A", [john])
+    await create_test_group_chat(db, -987654321, "Group Chat B", [jane])
+
+    # When: We mention both of them in the first group chat
+    mentions = {"@johndoe", "[Jane](tg://user?id=67890)"}
+    result = await get_user_ids_from_mentions(db, telegram_group_chat_id, mentions)
+
+    # Then: Only the user in the group chat is found
+    assert result == {
+        UserIdMentionMapping(mention="@johndoe", user_id=john.user_id),
+        UserIdMentionMapping(mention="[Jane](tg://user?id=67890)", user_id=None),
+    }
+
+
 @pytest.mark.asyncio
 async def test_get_mention_from_user_id_single_match():
     # Given: We have mappings
@@ -143,9 +225,9 @@ async def test_get_mention_from_user_id_no_match():
 
 
 @pytest.mark.asyncio
-async def test_create_mention_from_user_id(db: Session):
+async def test_create_mention_from_user_id(db: AsyncSession):
     # Given: A users exist within our system
-    jane = create_test_user(db, telegram_user_id=12345, username="janey", first_name="Jane", last_name="Doe")
+    jane = await create_test_user(db, telegram_user_id=12345, username="janey", first_name="Jane", last_name="Doe")
 
     # When: We create a mention from the user ID
     result = await create_mention_from_user_id(db, jane.user_id)
@@ -155,9 +237,9 @@ async def test_create_mention_from_user_id(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_create_mention_from_user_id_without_username(db: Session):
+async def test_create_mention_from_user_id_without_username(db: AsyncSession):
     # Given: A user exists in the system without a username, but with a first name and Telegram user ID
-    john = create_test_user(db, telegram_user_id=67890, username=None, first_name="John", last_name="Doe")
+    john = await create_test_user(db, telegram_user_id=67890, username=None, first_name="John", last_name="Doe")
 
     # When: We create a mention from the user ID
     result = await create_mention_from_user_id(db, john.user_id)
@@ -167,7 +249,7 @@ async def test_create_mention_from_user_id_without_username(db: Session):
 
 
 @pytest.mark.asyncio
-async def test_create_mention_from_nonexistent_user_id(db: Session):
+async def test_create_mention_from_nonexistent_user_id(db: AsyncSession):
     # Given: A non-existent user ID is provided
     non_existent_user_id = "non_existent_user_id"
 
@@ -0,0 +1,36 @@
+from sqlalchemy import Uuid
+
+from shout_subgroup.models import Base
+from shout_subgroup.uuid_key_backfill import KEY_COLUMNS
+
+# Tables created after the keys moved to native UUID columns, they never had anything to backfill
+NATIVE_UUID_TABLES = {'subgroups_subgroups_join_table'}
+
+
+def test_key_columns_cover_every_uuid_column():
+    # Given: Every uuid column of the models
+    uuid_columns = {
+        (table.name, column.name)
+        for table in Base.metadata.sorted_tables
+        for column in table.columns
+        if isinstance(column.type, Uuid) and table.name not in NATIVE_UUID_TABLES
+    }
+
+    # When: We list the columns the backfill fills
+    backfilled_columns = {(table, column) for table, columns in KEY_COLUMNS for column in columns}
+
+    # Then: They're the same, so the migration doesn't miss any
+    assert backfilled_columns == uuid_columns
+
+
+def test_key_columns_list_referenced_tables_first():
+    # Given: The order the backfill goes through the tables
+    order = [table for table, _ in KEY_COLUMNS]
+
+    # Then: Every table comes after the tables it references
+    for table in Base.metadata.sorted_tables:
+        if table.name not in order:
+            continue
+
+        for foreign_key in table.foreign_keys:
+            assert order.index(foreign_key.column.table.name) < order.index(table.name)
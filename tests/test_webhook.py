@@ -0,0 +1,90 @@
+from unittest.mock import Mock
+
+import pytest
+
+from shout_subgroup.exceptions import InvalidWebhookConfigError
+from shout_subgroup.webhook import load_webhook_config, run_application, WebhookConfig
+
+WEBHOOK_ENVIRONMENT_VARIABLES = ['WEBHOOK_URL', 'WEBHOOK_SECRET_TOKEN', 'WEBHOOK_PORT', 'WEBHOOK_LISTEN', 'WEBHOOK_PATH']
+
+
+@pytest.fixture(autouse=True)
+def clear_webhook_environment(monkeypatch):
+    for name in WEBHOOK_ENVIRONMENT_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_load_webhook_config_without_url_polls():
+    # When: No webhook url is set
+    webhook_config = load_webhook_config()
+
+    # Then: We poll
+    assert webhook_config is None
+
+
+def test_load_webhook_config(monkeypatch):
+    # Given: A webhook url and secret token
+    monkeypatch.setenv('WEBHOOK_URL', 'https://bot.example.com/')
+    monkeypatch.setenv('WEBHOOK_SECRET_TOKEN', 'super_secret-token')
+    monkeypatch.setenv('WEBHOOK_PORT', '8443')
+
+    # When: We load the config
+    webhook_config = load_webhook_config()
+
+    # Then: The defaults are filled in
+    assert webhook_config == WebhookConfig(
+        url='https://bot.example.com/',
+        secret_token='super_secret-token',
+        listen='0.0.0.0',
+        port=8443,
+        url_path='telegram'
+    )
+    assert webhook_config.webhook_url == 'https://bot.example.com/telegram'
+
+
+@pytest.mark.parametrize("environment", [
+    {'WEBHOOK_URL': 'http://bot.example.com', 'WEBHOOK_SECRET_TOKEN': 'secret'},
+    {'WEBHOOK_URL': 'https://bot.example.com'},
+    {'WEBHOOK_URL': 'https://bot.example.com', 'WEBHOOK_SECRET_TOKEN': 'not so secret!'},
+    {'WEBHOOK_URL': 'https://bot.example.com', 'WEBHOOK_SECRET_TOKEN': 'secret', 'WEBHOOK_PORT': 'eighty'},
+])
+def test_load_webhook_config_invalid(monkeypatch, environment):
+    # Given: An invalid webhook config
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+
+    # When: We load the config
+    # Then: It's rejected instead of starting a webhook anyone can post to
+    with pytest.raises(InvalidWebhookConfigError):
+        load_webhook_config()
+
+
+def test_run_application_with_webhook():
+    # Given: A webhook config
+    app = Mock()
+    webhook_config = WebhookConfig(url='https://bot.example.com', secret_token='secret')
+
+    # When: We run the application
+    run_application(app, webhook_config)
+
+    # Then: It listens for updates with the secret token instead of polling
+    app.run_webhook.assert_called_once_with(
+        listen='0.0.0.0',
+        port=80,
+        url_path='telegram',
+        webhook_url='https://bot.example.com/telegram',
+        secret_token='secret'
+    )
+    app.run_polling.assert_not_called()
+
+
+def test_run_application_without_webhook():
+    # Given: No webhook config
+    app = Mock()
+
+    # When: We run the application
+    run_application(app, None)
+
+    # Then: It polls
+    app.run_polling.assert_called_once_with()
+    app.run_webhook.assert_not_called()